@@ -0,0 +1,435 @@
+"""
+Storage for the files analyses share rather than each creating their own copy.
+==============================================================================
+ArtifactCache is a content addressed cache of the files produced by snakemake rules.
+Each entry is keyed by the rule's name, a hash of its shell command, its parameters, the
+packages in its conda environment, and the hashes of its input files. Before a cached rule runs
+its command the cache is checked for an entry with the same key; if one exists its files are
+copied in as the rule's outputs instead. Otherwise the command runs and its outputs are added
+to the cache.
+
+ReferenceStore holds a single verified copy of each reference database, e.g. taxonomic
+classifiers, that analyses link to.
+
+OutputLedger records the checksums of the outputs an analysis has completed, so a restarted
+analysis only re-creates the outputs that are missing, incomplete, or have been modified.
+
+Cached rules run this module as a script from within their own conda environment, so it
+only depends on the standard library.
+"""
+import os
+import sys
+import json
+import fcntl
+import argparse
+from time import time
+from uuid import uuid4
+from shutil import copyfile, rmtree
+from subprocess import run, DEVNULL
+from hashlib import sha256, sha1
+from base64 import urlsafe_b64decode
+from pathlib import Path
+
+# Changing this invalidates every existing entry
+CACHE_VERSION = 1
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir):
+        """
+        :cache_dir: The directory the cache is stored in. It should be on the same
+            filesystem as the analyses so outputs can be hard linked rather than copied.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.entries = self.cache_dir / 'entries'
+        self.hashes = self.cache_dir / 'hashes'
+        self.temp = self.cache_dir / 'temp'
+        for directory in (self.entries, self.hashes, self.temp):
+            directory.mkdir(parents=True, exist_ok=True)
+
+    def hash_file(self, path):
+        """
+        Return the sha256 of the file at PATH. Hashes are remembered by inode, size, and
+        modification time, so files shared by analyses, e.g. sequencing runs or the hard linked
+        reference databases, are only read once however many places they're linked to.
+        """
+        stat = Path(path).stat()
+        memo = self.memo(stat)
+        try:
+            size, mtime, digest = json.loads(memo.read_text())
+            if size == stat.st_size and mtime == stat.st_mtime_ns:
+                return digest
+        except (OSError, ValueError):
+            pass
+
+        digest = hash_file(path)
+        self.remember_hash(path, digest)
+        return digest
+
+    def remember_hash(self, path, digest):
+        """ Record that the file at PATH, as it is now, has the sha256 DIGEST """
+        stat = Path(path).stat()
+        temp = self.temp / uuid4().hex
+        temp.write_text(json.dumps([stat.st_size, stat.st_mtime_ns, digest]))
+        os.replace(temp, self.memo(stat))
+
+    def memo(self, stat):
+        """ The location of the remembered hash of the file with STAT """
+        return self.hashes / sha1('{}:{}'.format(stat.st_dev, stat.st_ino).encode()).hexdigest()
+
+    def hash_input(self, path):
+        """ Return a hash of the input at PATH. Directories are hashed by the names and contents of their files. """
+        path = Path(path)
+        if not path.is_dir():
+            return self.hash_file(path)
+        digest = sha256()
+        for child in sorted(child for child in path.rglob('*') if child.is_file()):
+            digest.update('{}\0{}\0'.format(child.relative_to(path), self.hash_file(child)).encode())
+        return digest.hexdigest()
+
+    def key(self, rule, code, params, inputs, environment=None):
+        """
+        Return the key for running RULE, whose command hashes to CODE, with PARAMS on INPUTS in ENVIRONMENT.
+        :environment: A hash of the tools the rule runs with, by default those of the running python's environment.
+        """
+        if environment is None:
+            environment = environment_hash()
+        parts = [str(CACHE_VERSION), rule, code, environment] + list(params)
+        parts += [self.hash_input(path) for path in inputs]
+        return sha256('\0'.join(parts).encode()).hexdigest()
+
+    def entry(self, key):
+        return self.entries / key[:2] / key
+
+    def restore(self, key, outputs):
+        """ Copy the files cached under KEY to OUTPUTS. Returns False if there is no complete entry for KEY. """
+        entry = self.entry(key)
+        try:
+            manifest = json.loads((entry / 'manifest.json').read_text())
+        except (OSError, ValueError):
+            return False
+        if len(manifest['outputs']) != len(outputs):
+            return False
+
+        for (name, digest), output in zip(manifest['outputs'], outputs):
+            output = Path(output)
+            output.parent.mkdir(parents=True, exist_ok=True)
+            if output.exists() or output.is_symlink():
+                output.unlink()
+            # Each output gets its own copy, newer than its inputs. Linking would share the entry's inode
+            # with the analysis that stored it, and updating its time would make that analysis' outputs stale.
+            clone_or_copy(entry / name, output)
+            output.chmod(0o644)
+            self.remember_hash(output, digest)
+        return True
+
+    def store(self, key, outputs):
+        """ Add OUTPUTS to the cache under KEY. Does nothing if any of them is a directory. """
+        outputs = [Path(output) for output in outputs]
+        if any(output.is_dir() for output in outputs):
+            return False
+        entry = self.entry(key)
+        if entry.exists():
+            return True
+
+        # Build the entry in a temporary directory and move it in place once it's complete
+        temp = self.temp / uuid4().hex
+        temp.mkdir()
+        manifest = {'outputs': [], 'created': time()}
+        for i, output in enumerate(outputs):
+            name = '{}_{}'.format(i, output.name)
+            link_or_copy(output, temp / name)
+            # Cached files are shared so they mustn't be modified in place
+            (temp / name).chmod(0o444)
+            manifest['outputs'].append((name, self.hash_file(output)))
+        (temp / 'manifest.json').write_text(json.dumps(manifest))
+
+        entry.parent.mkdir(exist_ok=True)
+        try:
+            temp.rename(entry)
+        except OSError:
+            # Another analysis stored the same entry first
+            rmtree(temp)
+        return True
+
+
+class ReferenceStore:
+    """
+    Keeps one read only copy of each version of the reference databases analyses use.
+    ==================================================================================
+    A database is added to the store the first time it's requested and again whenever its
+    source file changes, with each version kept under its sha256. Whether the source has
+    changed is decided by its size and modification time, so it's only read in full when
+    a new version is added. Analyses are given links to the stored copy rather than copies.
+    """
+    def __init__(self, store_dir):
+        """
+        :store_dir: The directory the databases are stored in.
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = self.store_dir / 'manifest.json'
+
+    def load_manifest(self):
+        """ Return the versions of each database in the store, oldest first """
+        try:
+            return json.loads(self.manifest_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def versions(self, name):
+        """ Return the versions of database NAME that have been stored, oldest first """
+        return self.load_manifest().get(name, [])
+
+    def get(self, name, source):
+        """
+        Return the location in the store of the current version of database NAME, which is
+        read from SOURCE. The source is added as a new version if it has changed.
+        """
+        source = Path(source)
+        stat = source.stat()
+        versions = self.versions(name)
+        if versions:
+            current = versions[-1]
+            stored = self.store_dir / current['file']
+            # Check the stored copy is intact too, that's cheap as it can't be modified in place
+            if (current['source'], current['size'], current['mtime']) == \
+                    (str(source), stat.st_size, stat.st_mtime_ns) and stored.exists() and \
+                    stored.stat().st_size == stat.st_size:
+                return stored
+        return self.add(name, source)
+
+    def add(self, name, source):
+        """ Add the current contents of SOURCE as a version of database NAME, unless it's already stored """
+        source = Path(source)
+        # Only one process adds to the store at a time
+        with open(self.store_dir / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stat = source.stat()
+            digest = hash_file(source)
+            stored = self.store_dir / name / digest / source.name
+            if not stored.exists():
+                stored.parent.mkdir(parents=True, exist_ok=True)
+                temp = stored.with_name('.{}.tmp'.format(uuid4().hex))
+                copyfile(source, temp)
+                if hash_file(temp) != digest:
+                    temp.unlink()
+                    raise OSError('Copy of {} did not match its checksum'.format(source))
+                temp.chmod(0o444)
+                temp.rename(stored)
+
+            # Record the version, or move it to the end if it's been stored before
+            manifest = self.load_manifest()
+            versions = [version for version in manifest.get(name, []) if version['sha256'] != digest]
+            versions.append({
+                'sha256': digest,
+                'file': str(stored.relative_to(self.store_dir)),
+                'source': str(source),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'added': time()
+            })
+            manifest[name] = versions
+            temp = self.store_dir / '.manifest.tmp'
+            temp.write_text(json.dumps(manifest, indent=2))
+            os.replace(temp, self.manifest_file)
+        return stored
+
+    @staticmethod
+    def link(stored, destination):
+        """
+        Make the stored database STORED available at DESTINATION. A hard link is used if possible,
+        then a copy on write clone on filesystems that support them, and otherwise a symlink.
+        """
+        destination = Path(destination)
+        if destination.exists() and os.path.samefile(stored, destination):
+            # Already linked, leave it be so its modification time doesn't change
+            return
+        if destination.exists() or destination.is_symlink():
+            destination.unlink()
+        try:
+            os.link(stored, destination)
+            return
+        except OSError:
+            pass
+        clone = ['cp', '--reflink=always', '--preserve=timestamps', str(stored), str(destination)]
+        if run(clone, stdout=DEVNULL, stderr=DEVNULL).returncode:
+            # A failed clone can leave an empty file behind
+            if destination.exists():
+                destination.unlink()
+            destination.symlink_to(stored)
+
+
+class OutputLedger:
+    """
+    Records the outputs of the snakemake jobs an analysis has completed.
+    ====================================================================
+    Snakemake keeps a record of each output it creates under .snakemake/metadata, including
+    whether the job that created it finished. The ledger adds a checksum of every completed
+    output. When the analysis is restarted, outputs that were modified since they were completed
+    are removed so snakemake re-creates them, while the rest are kept as they are.
+    """
+    def __init__(self, analysis_dir):
+        """
+        :analysis_dir: The directory of the analysis, snakemake's working directory.
+        """
+        self.analysis_dir = Path(analysis_dir)
+        self.ledger_file = self.analysis_dir / 'output_ledger.json'
+
+    def load(self):
+        """ Return the completed outputs, by path relative to the analysis """
+        try:
+            return json.loads(self.ledger_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, ledger):
+        temp = self.analysis_dir / '.output_ledger.tmp'
+        temp.write_text(json.dumps(ledger, indent=2))
+        os.replace(temp, self.ledger_file)
+
+    def snakemake_records(self):
+        """ Yield the path of each output snakemake has created along with its record of it """
+        metadata = self.analysis_dir / '.snakemake' / 'metadata'
+        if not metadata.is_dir():
+            return
+        for record in metadata.rglob('*'):
+            if not record.is_file():
+                continue
+            # Records are named by the base64 of the output's path, split into directories if it's too long
+            try:
+                path = urlsafe_b64decode(''.join(record.relative_to(metadata).parts)).decode()
+                yield path, json.loads(record.read_text())
+            except (ValueError, OSError):
+                continue
+
+    def record(self):
+        """ Add the outputs of the jobs that have completed to the ledger and return it """
+        ledger = self.load()
+        for path, info in self.snakemake_records():
+            output = self.analysis_dir / path
+            if info.get('incomplete') or not output.exists():
+                ledger.pop(path, None)
+                continue
+            size, mtime = stat_path(output)
+            entry = ledger.get(path)
+            # Only hash outputs that are new or have changed since they were last recorded
+            if entry is None or (entry['size'], entry['mtime']) != (size, mtime):
+                ledger[path] = {'rule': info.get('rule'), 'sha256': hash_path(output), 'size': size, 'mtime': mtime}
+        self.save(ledger)
+        return ledger
+
+    def verify(self):
+        """
+        Check the completed outputs are as they were recorded, removing any that have been modified
+        so snakemake re-creates them. Returns the paths of the outputs that are no longer complete.
+        """
+        ledger = self.load()
+        changed = []
+        for path, entry in list(ledger.items()):
+            output = self.analysis_dir / path
+            if output.exists():
+                if stat_path(output) == (entry['size'], entry['mtime']) or hash_path(output) == entry['sha256']:
+                    continue
+                if output.is_dir():
+                    rmtree(output)
+                else:
+                    output.unlink()
+            changed.append(path)
+            del ledger[path]
+        if changed:
+            self.save(ledger)
+        return changed
+
+
+def stat_path(path):
+    """ Return the total size and latest modification time of the file or directory at PATH """
+    path = Path(path)
+    files = [child for child in path.rglob('*') if child.is_file()] if path.is_dir() else [path]
+    stats = [child.stat() for child in files]
+    return sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0)
+
+
+def hash_path(path):
+    """ Return the sha256 of the file at PATH, or of the names and contents of the files in it if it's a directory """
+    path = Path(path)
+    if not path.is_dir():
+        return hash_file(path)
+    digest = sha256()
+    for child in sorted(child for child in path.rglob('*') if child.is_file()):
+        digest.update('{}\0{}\0'.format(child.relative_to(path), hash_file(child)).encode())
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    """ Return the sha256 of the file at PATH """
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def environment_hash():
+    """
+    Return a hash of the packages installed in the environment of the running python. Conda records
+    each package it installs in conda-meta, so the hash changes whenever one is upgraded.
+    """
+    conda_meta = Path(sys.prefix) / 'conda-meta'
+    packages = sorted(path.name for path in conda_meta.glob('*.json')) if conda_meta.is_dir() else []
+    parts = [sys.prefix, sys.version] + packages
+    return sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def clone_or_copy(source, destination):
+    """ Copy SOURCE to DESTINATION, as a copy on write clone on filesystems that support them """
+    if run(['cp', '--reflink=auto', str(source), str(destination)], stdout=DEVNULL, stderr=DEVNULL).returncode:
+        copyfile(source, destination)
+
+
+def link_or_copy(source, destination):
+    """ Hard link SOURCE to DESTINATION, copying it instead if they're on different filesystems """
+    try:
+        os.link(source, destination)
+    except OSError:
+        copyfile(source, destination)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Restore or store the outputs of a snakemake rule')
+    parser.add_argument('--cache-dir', required=True, help='The directory the cache is stored in')
+    # Cached rules run this with the python of their conda environment, which may be as old as 3.6,
+    # where add_subparsers doesn't take required
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    restore = commands.add_parser('restore', help='Restore cached outputs. Exits with 1 and prints the key if missing.')
+    restore.add_argument('--rule', required=True, help='The name of the rule')
+    restore.add_argument('--code', required=True, help='A hash of the rule\'s command')
+    restore.add_argument('--input', nargs='*', default=[], help='The rule\'s input files')
+    restore.add_argument('--output', nargs='+', required=True, help='The rule\'s output files')
+    # Parameters are often command line flags themselves so they're given last, after --
+    restore.add_argument('params', nargs='*', help='The values of the rule\'s parameters')
+
+    store = commands.add_parser('store', help='Store outputs in the cache')
+    store.add_argument('key', help='The key printed by restore')
+    store.add_argument('--output', nargs='+', required=True, help='The rule\'s output files')
+
+    args = parser.parse_args(args)
+    cache = ArtifactCache(args.cache_dir)
+    if args.command == 'restore':
+        key = cache.key(args.rule, args.code, args.params, args.input)
+        if cache.restore(key, args.output):
+            print('Restored outputs of {} from the artifact cache'.format(args.rule), file=sys.stderr)
+            return 0
+        print(key)
+        return 1
+    elif not args.key:
+        print('No key provided, outputs not cached', file=sys.stderr)
+    elif not cache.store(args.key, args.output):
+        print('Directory outputs are not cached', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
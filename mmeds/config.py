@@ -67,6 +67,10 @@ STUDIES_DIR = DATABASE_DIR / 'studies'
 SEQUENCING_DIR = DATABASE_DIR / 'sequencing_runs'
 SESSION_PATH = DATABASE_DIR / 'CherryPySessions'
 TAXONOMIC_DATABASE_DIR = DATABASE_DIR / "taxonomic_databases"
+# Outputs of snakemake rules shared between analyses, see mmeds/artifacts.py
+ARTIFACT_CACHE_DIR = DATABASE_DIR / "artifact_cache"
+# A single copy of each version of the reference databases analyses link to, see mmeds/artifacts.py
+REFERENCE_STORE_DIR = DATABASE_DIR / "reference_store"
 SNAKEMAKE_WORKFLOWS_DIR = SNAKEMAKE_DIR / "workflows"
 SNAKEMAKE_RULES_DIR = SNAKEMAKE_DIR / "rules"
 
@@ -288,6 +292,21 @@ WORKFLOWS = {
     }
 }
 
+# Resources an analysis run directly on the node is expected to need, by workflow type.
+# Memory is in MB with memory_per_gb added for each GB of sequencing data being analyzed.
+# 10 cores matches the threads analyses were given before resources were tracked, so analyses
+# on the node run as they did before, it's reduced to the node's cores when there are fewer.
+ANALYSIS_RESOURCES = {
+    "default": {"cores": 10, "memory": 16000, "memory_per_gb": 4000},
+    "core_pipeline_taxonomic": {"cores": 10, "memory": 16000, "memory_per_gb": 4000},
+    "lefse": {"cores": 2, "memory": 4000, "memory_per_gb": 0}
+}
+# The cores and MB of memory analyses run on the node may reserve between them, None for all of it
+NODE_ANALYSIS_CORES = None
+NODE_ANALYSIS_MEMORY = None
+# The threads given to analyses that aren't reserved on the node
+ANALYSIS_THREADS = 10
+
 TAXONOMIC_DATABASES = {
     "greengenes": TAXONOMIC_DATABASE_DIR / "gg-13-8-99-nb-2020-8-0.qza",
     "greengenes2": TAXONOMIC_DATABASE_DIR / "greengenes2.2020-10.nb-classifier.qza",
@@ -297,6 +316,9 @@ TAXONOMIC_DATABASES = {
 if TESTING:
     TAXONOMIC_DATABASES["test"] = TAXONOMIC_DATABASE_DIR / "dummy_classifier.qza"
 
+# The QIIME types of the reference databases linked into analyses, which aren't recorded as their artifacts
+REFERENCE_ARTIFACT_TYPES = ('TaxonomicClassifier',)
+
 
 UPLOADED_FP = 'uploaded_file'
 ERROR_FP = 'error_log.tsv'
@@ -328,11 +350,26 @@ if not SESSION_PATH.exists():
         pass
 
 JOB_TEMPLATE = STORAGE_DIR / 'job_template.lsf'
+# Submit each snakemake rule of a cluster analysis as its own LSF job rather than running the
+# whole workflow within a single job, see mmeds/tools/lsf_submit.py
+CLUSTER_PER_RULE = True
+# The most jobs a single analysis may have submitted at once
+CLUSTER_MAX_JOBS = 50
+CLUSTER_QUEUE = 'premium'
+CLUSTER_PROJECT = 'acc_MMEDS'
+# The most threads a single rule of a cluster analysis may reserve
+CLUSTER_MAX_THREADS = 16
+# Seconds the graphs of an analysis' snakemake jobs may take to render when they're downloaded
+GRAPH_RENDER_TIMEOUT = 60
+# Seconds between samples of the CPU and memory use of analyses running locally
+ANALYSIS_SAMPLE_SECONDS = 30
 CUTIE_CONFIG_TEMPLATE = STORAGE_DIR / 'cutie_config_template.ini'
 MMEDS_LOG = DATABASE_DIR / 'mmeds_log.txt'
 SQL_LOG = DATABASE_DIR / 'sql_log.txt'
 DOCUMENT_LOG = DATABASE_DIR / 'document_log.txt'
 STAT_FILE = DATABASE_DIR / 'mmeds_stats.yaml'
+# Seconds between full recounts of the stats the watcher otherwise keeps current as documents are created
+STATS_RECONCILE_SECONDS = 6 * 60 * 60
 PROCESS_LOG_DIR = DATABASE_DIR / 'process_log_dir'
 LOG_CONFIG = STORAGE_DIR / 'log_config.yaml'
 if not PROCESS_LOG_DIR.exists():
@@ -349,6 +386,23 @@ if not LOG_DIR.exists():
         pass
 
 CURRENT_PROCESSES = DATABASE_DIR / 'current_processes.yaml'
+QUEUE_METRICS = DATABASE_DIR / 'queue_metrics.yaml'
+WATCHER_JOURNAL = DATABASE_DIR / 'watcher_journal.db'
+# Where the watcher serves its metrics and health check, only reachable from the node itself
+WATCHER_METRICS_ADDRESS = ('127.0.0.1', 52955)
+# How long the watcher can go without completing a loop before it's reported unhealthy
+WATCHER_STALL_SECONDS = 300
+# Seconds the server waits on each call to the watcher before giving up
+WATCHER_CALL_TIMEOUT = 10
+# Seconds to wait before retrying a failed connection to the watcher, doubling up to the maximum
+WATCHER_RECONNECT_BACKOFF = (1, 60)
+# The socket the server, analyses, and scripts send work to the watcher on
+WATCHER_SOCKET = DATABASE_DIR / 'watcher.sock'
+# Who may connect to the watcher's socket. The group lets the server connect when it runs as a different
+# user, in which case that user must share the watcher's group. Use 0o600 if they run as the same user.
+WATCHER_SOCKET_MODE = 0o660
+# Seconds a client may hold the database lock before it's released for them
+WATCHER_LOCK_LEASE = 60
 CONFIG_PARAMETERS = {
     'core_pipeline_taxonomic': [
         'sampling_depth',
@@ -375,6 +429,11 @@ CONFIG_PARAMETERS = {
     'test': []
 }
 
+# Parameters any workflow's config may include
+OPTIONAL_CONFIG_PARAMETERS = [
+    'resources'     # Overrides of the threads and memory snakemake rules are given, see common.smk
+]
+
 CONFIG_LISTS = [
     'metadata',
     'taxa_levels',
@@ -516,6 +575,19 @@ QIIME_FORWARD_BARCODE_CATS = ('BarcodeSequence', 'categorical')
 QIIME_REVERSE_BARCODE_CATS = ('BarcodeSequenceR', 'categorical')
 FASTQ_FILENAME_TEMPLATE = '{}_S1_L001_R{}_001.fastq.gz'
 SEQUENCING_DIRECTORY_FILE = 'directory.txt'
+UPLOAD_CHECKPOINT_FILE = 'upload_checkpoint.yaml'
+# Interrupted uploads are resumed until they've been attempted this many times, then marked failed
+UPLOAD_MAX_ATTEMPTS = 3
+
+# Upload worker pool. Workers are replaced after UPLOAD_WORKER_JOBS jobs,
+# jobs running longer than their timeout (in seconds) are killed.
+UPLOAD_WORKERS = 2
+UPLOAD_WORKER_JOBS = 50
+UPLOAD_TIMEOUTS = {
+    'MetaDataUploader': 6 * 60 * 60,
+    'DataUploader': 12 * 60 * 60,
+    'MetaDataAdder': 60 * 60
+}
 
 TEST_FILES = {
     'barcodes': TEST_BARCODES,
@@ -675,6 +747,7 @@ PUBLIC_TABLES = set(set(TABLE_ORDER) - set(PROTECTED_TABLES) - set(['AdditionalM
 # These are the columns for each table
 TABLE_COLS = {}
 ALL_TABLE_COLS = {}
+TABLE_KEY_COLS = {}
 ALL_COLS = []
 COL_SIZES = {}
 
@@ -737,6 +810,8 @@ if IS_PRODUCTION or (TESTING and DB_INSTALLED):
                 COL_SIZES[col] = (ctype, csize)
             TABLE_COLS[table] = [x for x in results if 'id' not in x]
             ALL_TABLE_COLS[table] = results
+            # Primary and foreign key columns, filled from the uploaded rows rather than the metadata
+            TABLE_KEY_COLS[table] = [x[0] for x in info if x[3] in ('PRI', 'MUL')]
             ALL_COLS += results
     c.close()
     TABLE_COLS['AdditionalMetaData'] = []
@@ -68,14 +68,6 @@ class DataUploader(Process):
                                      authentication_source=sec.MONGO_DATABASE,
                                      host=sec.MONGO_HOST)
 
-        if access_code is None:
-            self.access_code = fig.get_salt(50)
-            # Ensure a unique access code
-            while list(MMEDSDoc.objects(access_code=self.access_code)):
-                self.access_code = fig.get_salt(50)
-        else:
-            self.access_code = access_code
-
         # Create the document
         self.mdata = MMEDSDoc(created=datetime.utcnow(),
                               last_accessed=datetime.utcnow(),
@@ -84,11 +76,13 @@ class DataUploader(Process):
                               reads_type=self.reads_type,
                               barcodes_type=self.barcodes_type,
                               study_name=self.sequencing_run_name,
-                              access_code=self.access_code,
+                              access_code=access_code or fig.get_salt(50),
                               owner=self.owner,
                               public=self.public)
 
-        self.mdata.save()
+        # Generated access codes are replaced if they collide with an existing document
+        self.mdata.insert(None if access_code else lambda: fig.get_salt(50))
+        self.access_code = self.mdata.access_code
 
         count = 0
         new_dir = fig.SEQUENCING_DIR / ('{}_{}_{}'.format(self.owner, self.sequencing_run_name, count))
@@ -19,7 +19,8 @@ from mmeds.error import (TableAccessError, MissingUploadError, MissingFileError,
 from mmeds.util import (send_email, pyformat_translate, quote_sql, parse_ICD_codes)
 from mmeds.database.metadata_uploader import MetaDataUploader
 from mmeds.database.sql_builder import SQLBuilder
-from mmeds.database.documents import MMEDSDoc
+from mmeds.database.documents import MMEDSDoc, ArtifactDoc
+from mmeds.metrics import TimedCursor
 from mmeds.logging import Logger
 
 DAYS = 13
@@ -95,14 +96,16 @@ class Database:
                                       password=sec.TEST_USER_PASS,
                                       database=fig.SQL_DATABASE,
                                       autocommit=True,
-                                      local_infile=True)
+                                      local_infile=True,
+                                      cursorclass=TimedCursor)
             else:
                 self.db = pms.connect(host='localhost',
                                       user='root',
                                       password=sec.TEST_ROOT_PASS,
                                       database=fig.SQL_DATABASE,
                                       autocommit=True,
-                                      local_infile=True)
+                                      local_infile=True,
+                                      cursorclass=TimedCursor)
             # Connect to the mongo server
             self.mongo = men.connect(db='test',
                                      port=27017,
@@ -115,14 +118,16 @@ class Database:
                                       password=sec.SQL_USER_PASS,
                                       database=sec.SQL_DATABASE,
                                       autocommit=True,
-                                      local_infile=True)
+                                      local_infile=True,
+                                      cursorclass=TimedCursor)
             else:
                 self.db = pms.connect(host=sec.SQL_HOST,
                                       user=user,
                                       password=sec.SQL_ADMIN_PASS,
                                       database=sec.SQL_DATABASE,
                                       autocommit=True,
-                                      local_infile=True)
+                                      local_infile=True,
+                                      cursorclass=TimedCursor)
             self.mongo = men.connect(db=sec.MONGO_DATABASE,
                                      username=sec.MONGO_ADMIN_NAME,
                                      password=sec.MONGO_ADMIN_PASS,
@@ -813,9 +818,13 @@ class Database:
     #               MongoDB                #
     ########################################
     def create_access_code(self, check_code=None, length=20):
-        """ Creates a unique code for identifying a mongo db document """
+        """
+        Creates a unique code for identifying a mongo db document.
+        A freshly generated code isn't checked against the existing documents, the unique index
+        on access_code rejects the document if it somehow collides.
+        """
         if check_code is None:
-            check_code = fig.get_salt(20)
+            return fig.get_salt(length)
         code = check_code
         count = 0
         # Ensure no document exists with the given access code
@@ -1052,6 +1061,89 @@ class Database:
                         run_paths[run][key] = Path(doc.path) / val
         return run_paths
 
+    def get_doc_statuses(self, access_codes):
+        """
+        Return the MMEDSDocs for all of ACCESS_CODES in a single query, loading only the fields
+        describing the state of their processes.
+        """
+        return MMEDSDoc.objects(access_code__in=list(access_codes)).only(*MMEDSDoc.STATUS_FIELDS)
+
+    def get_study_listing(self, user=None):
+        """ Return the studies owned by USER, or all studies if USER is None, with only their listing fields. """
+        if user is None:
+            studies = MMEDSDoc.objects(doc_type='study')
+        else:
+            studies = MMEDSDoc.objects(doc_type='study', owner=user)
+        return studies.only(*MMEDSDoc.LISTING_FIELDS)
+
+    def get_sequencing_run_listing(self, user=None):
+        """ Return the sequencing runs owned by USER, or all runs if USER is None, with only their listing fields. """
+        if user is None:
+            runs = MMEDSDoc.objects(doc_type='sequencing_run')
+        else:
+            runs = MMEDSDoc.objects(doc_type='sequencing_run', owner=user)
+        return runs.only(*MMEDSDoc.LISTING_FIELDS)
+
+    def get_analysis_listing(self, **kwargs):
+        """ Return the analyses matching KWARGS with only their listing fields. """
+        return MMEDSDoc.objects(doc_type='analysis', **kwargs).only(*MMEDSDoc.LISTING_FIELDS)
+
+    def check_mongo_indexes(self, create=False):
+        """
+        Compare the indexes declared for MMEDSDoc and ArtifactDoc with those that exist in the database.
+        If CREATE is True build any that are missing.
+        Returns a dictionary with the 'missing' and 'extra' indexes found before any were created.
+        """
+        difference = {'missing': [], 'extra': []}
+        for document in (MMEDSDoc, ArtifactDoc):
+            doc_difference = document.compare_indexes()
+            if create and doc_difference['missing']:
+                document.ensure_indexes()
+            difference['missing'] += doc_difference['missing']
+            difference['extra'] += doc_difference['extra']
+        return difference
+
+    def add_artifacts(self, analysis_doc, artifacts):
+        """
+        Record the ARTIFACTS produced by the analysis described by ANALYSIS_DOC.
+        :artifacts: A list of tuples of the path and QIIME type of each artifact.
+        """
+        # Replace any records from a previous run of the analysis
+        ArtifactDoc.objects(analysis_code=analysis_doc.access_code).delete()
+        docs = [ArtifactDoc(created=datetime.now(),
+                            study_code=analysis_doc.study_code,
+                            analysis_code=analysis_doc.access_code,
+                            owner=analysis_doc.owner,
+                            kind=Path(path).stem,
+                            artifact_type=artifact_type,
+                            path=str(path),
+                            workflow_type=analysis_doc.workflow_type,
+                            params=analysis_doc.config)
+                for path, artifact_type in artifacts]
+        if docs:
+            ArtifactDoc.objects.insert(docs)
+
+    def get_artifacts(self, study_code, kind=None, artifact_type=None):
+        """ Return the artifacts produced by analyses of STUDY_CODE, newest first, optionally of one KIND or type """
+        query = {'study_code': study_code}
+        if kind is not None:
+            query['kind'] = kind
+        if artifact_type is not None:
+            query['artifact_type'] = artifact_type
+        return ArtifactDoc.objects(**query).order_by('-created')
+
+    def get_benchmarked_analyses(self, workflow_type=None, since=None):
+        """
+        Return the analyses with rule benchmarks recorded, optionally only those of WORKFLOW_TYPE
+        or those created after SINCE.
+        """
+        query = {'doc_type': 'analysis', 'rule_benchmarks__exists': True, 'rule_benchmarks__ne': []}
+        if workflow_type is not None:
+            query['workflow_type'] = workflow_type
+        if since is not None:
+            query['created__gte'] = since
+        return MMEDSDoc.objects(**query).order_by('created')
+
     def get_all_studies(self):
         """ Return all studies currently stored in the database. """
         return MMEDSDoc.objects(doc_type='study')
@@ -1,6 +1,11 @@
+import os
 import mongoengine as men
 from datetime import datetime
+from queue import Queue
+from threading import Thread
+from multiprocessing.util import Finalize
 from pathlib import Path
+from shutil import rmtree
 from copy import deepcopy
 from ppretty import ppretty
 from mmeds.config import DOCUMENT_LOG
@@ -8,6 +13,112 @@ from mmeds.util import copy_metadata, camel_case
 from mmeds.error import AnalysisError
 from mmeds.logging import Logger
 
+# Once a file index holds more than this many lines per entry it's rewritten from scratch
+FILE_INDEX_COMPACT_RATIO = 2
+
+# The contents of each file index this process has written, keyed by the index's path, along with
+# the index's inode, size, and modification time once written
+_file_indexes = {}
+
+
+def clear_file_indexes():
+    """ Forget the file indexes this process has written so they're read again when next written """
+    _file_indexes.clear()
+
+
+def write_file_index(index, header, entries):
+    """
+    Record the ENTRIES, a dictionary of file keys to paths, in the file index at INDEX.
+    The index is an append only journal, a key's latest line is its current path. Only the entries
+    that changed since this process last saw the index are appended. The index is rewritten when
+    HEADER changes, an entry is removed, or enough outdated lines have built up.
+    """
+    current = _file_indexes.get(index)
+    # Don't trust what this process last wrote if the index has been written since, e.g. by another process
+    if current is not None and not current['stat'] == index_stat(index):
+        current = None
+    # Load the index if it was written by another process
+    if current is None and index.exists():
+        lines = index.read_text().split('\n')
+        current = {'header': lines[0] + '\n', 'entries': {}, 'lines': 0}
+        for line in lines[2:]:
+            if line:
+                key, path = line.split('\t', 1)
+                current['entries'][key] = path
+                current['lines'] += 1
+
+    if (current is None or
+            not current['header'] == header or
+            not set(current['entries']).issubset(entries) or
+            current['lines'] > FILE_INDEX_COMPACT_RATIO * max(len(entries), 1)):
+        # Write the full index to a temporary file and swap it in
+        temp = index.with_suffix('.tmp.{}'.format(os.getpid()))
+        with open(temp, 'w') as f:
+            f.write(header)
+            f.write('Key\tPath\n')
+            f.write(''.join('{}\t{}\n'.format(key, path) for key, path in entries.items()))
+        os.replace(temp, index)
+        current = {'header': header, 'entries': dict(entries), 'lines': len(entries)}
+    else:
+        changed = {key: path for key, path in entries.items() if not current['entries'].get(key) == path}
+        if changed:
+            # Append the changes in a single write
+            with open(index, 'a') as f:
+                f.write(''.join('{}\t{}\n'.format(key, path) for key, path in changed.items()))
+            current['entries'].update(changed)
+            current['lines'] += len(changed)
+    current['stat'] = index_stat(index)
+    _file_indexes[index] = current
+
+
+def index_stat(index):
+    """ Return the inode, size, and modification time of the file INDEX, or None if it doesn't exist """
+    try:
+        stat = index.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class DocumentLogWriter:
+    """
+    Appends lines to the DOCUMENT_LOG from a background thread so saving a document doesn't wait on the log.
+    Each process gets its own thread, started on its first write, and the remaining lines are written
+    before the process exits.
+    """
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.pid = None
+
+    def write(self, line):
+        """ Queue LINE to be added to the log """
+        if not self.pid == os.getpid():
+            # Forked processes don't inherit the writer thread so start one for this process
+            self.pid = os.getpid()
+            self.lines = Queue()
+            Thread(target=self.run, daemon=True).start()
+            Finalize(None, self.flush, exitpriority=10)
+        self.lines.put(line)
+
+    def run(self):
+        """ Write all the queued lines each time there are new ones """
+        while True:
+            lines = [self.lines.get()]
+            while not self.lines.empty():
+                lines.append(self.lines.get())
+            with open(self.log_file, 'a') as f:
+                f.write(''.join(lines))
+            for line in lines:
+                self.lines.task_done()
+
+    def flush(self):
+        """ Wait until all queued lines have been written """
+        if self.pid == os.getpid():
+            self.lines.join()
+
+
+document_log = DocumentLogWriter(DOCUMENT_LOG)
+
 
 class MMEDSDoc(men.Document):
     """
@@ -30,7 +141,7 @@ class MMEDSDoc(men.Document):
     path = men.StringField(max_length=256)
     study_code = men.StringField(max_length=100)
     study_name = men.StringField(max_length=100)
-    access_code = men.StringField(max_length=50)
+    access_code = men.StringField(max_length=50, unique=True, sparse=True)
     reads_type = men.StringField(max_length=45)     # single_end or paired_end
     barcodes_type = men.StringField(max_length=45)  # Single or Paired
     data_type = men.StringField(max_length=45)  #
@@ -46,28 +157,63 @@ class MMEDSDoc(men.Document):
     exit_code = men.IntField()
     files = men.DictField()
     config = men.DictField()
+    rule_benchmarks = men.ListField(men.DictField())     # The time and resources used by each snakemake job
+    resource_samples = men.ListField(men.DictField())    # Samples of the CPU and memory used by the analysis
+
+    # Indexes covering the queries made by the listing pages and the watcher
+    meta = {
+        'indexes': [
+            ('owner', 'doc_type'),
+            ('doc_type', 'study_name'),
+            ('study_code', 'doc_type'),
+            ('doc_type', 'is_alive')
+        ]
+    }
+
+    # Fields loaded when only displaying a list of documents
+    LISTING_FIELDS = ('access_code', 'owner', 'study_name', 'study_code', 'doc_type',
+                      'created', 'workflow_type', 'analysis_type')
+    # Fields loaded when only checking on the process related to a document
+    STATUS_FIELDS = ('access_code', 'owner', 'study_code', 'created', 'restart_stage', 'analysis_type',
+                     'pid', 'path', 'name', 'is_alive', 'exit_code')
 
     # When the document is updated record the
-    # location of all files in a new file
+    # location of all files in the file index
     def save(self, **kwargs):
         super().save(**kwargs)
         if self.path is not None:
-            with open(str(Path(self.path) / 'file_index.tsv'), 'w') as f:
-                f.write('{}\t{}\t{}\n'.format(self.owner, self.email, self.access_code))
-                f.write('Key\tPath\n')
-                for key, file_path in self.files.items():
-                    # Skip non existent files
-                    if file_path is None:
-                        continue
-                    # If it's a key for an analysis point to the file index for that analysis
-                    elif isinstance(file_path, dict):
-                        f.write('{}\t{}\n'.format(key, Path(self.path) / key / 'file_index.tsv'))
-                    # Otherwise just write the value
-                    else:
-                        f.write('{}\t{}\n'.format(key, file_path))
-            with open(DOCUMENT_LOG, 'a') as f:
-                f.write('-\t'.join([str(type(self)), self.owner, 'Upload', 'Finished',
-                                    self.path, self.access_code]) + '\n')
+            entries = {}
+            for key, file_path in self.files.items():
+                # Skip non existent files
+                if file_path is None:
+                    continue
+                # If it's a key for an analysis point to the file index for that analysis
+                elif isinstance(file_path, dict):
+                    entries[key] = str(Path(self.path) / key / 'file_index.tsv')
+                # Otherwise just write the value
+                else:
+                    entries[key] = str(file_path)
+            write_file_index(Path(self.path) / 'file_index.tsv',
+                             '{}\t{}\t{}\n'.format(self.owner, self.email, self.access_code),
+                             entries)
+            document_log.write('-\t'.join([str(type(self)), self.owner, 'Upload', 'Finished',
+                                           self.path, self.access_code]) + '\n')
+
+    def insert(self, new_code=None):
+        """
+        Save a newly created document. Rather than checking for an existing document with the
+        same access code beforehand this relies on the unique index on access_code to reject
+        duplicates. If :new_code: is provided it's called to get a replacement code and
+        the insert is retried, otherwise the NotUniqueError is raised.
+        """
+        while True:
+            try:
+                self.save(force_insert=True)
+                return
+            except men.NotUniqueError:
+                if new_code is None:
+                    raise
+                self.access_code = new_code()
 
     def __str__(self):
         """ Return a printable string """
@@ -145,9 +291,39 @@ class MMEDSDoc(men.Document):
                        config=config,
                        files=string_files)
 
-        doc.save(check=True)
-        with open(DOCUMENT_LOG, 'a') as f:
-            f.write('-\t'.join([str(x) for x in [doc.study_name, doc.owner, doc.doc_type, doc.analysis_status,
-                                                 datetime.now(), doc.path, doc.access_code]]) + '\n')
-            Logger.debug('saved analysis doc')
+        # The code was chosen by the watcher before the process started so a collision is an error
+        try:
+            doc.insert()
+        except Exception:
+            # Don't leave behind a directory no document points to
+            rmtree(new_dir)
+            raise
+        document_log.write('-\t'.join([str(x) for x in [doc.study_name, doc.owner, doc.doc_type, doc.analysis_status,
+                                                        datetime.now(), doc.path, doc.access_code]]) + '\n')
+        Logger.debug('saved analysis doc')
         return doc
+
+
+class ArtifactDoc(men.Document):
+    """
+    A record of an artifact, e.g. a feature table, produced by a finished analysis.
+    ===============================================================================
+    Later analyses of the same study look up the artifacts they reuse here rather
+    than searching the directories of every previous analysis.
+    """
+    created = men.DateTimeField(required=True)
+    study_code = men.StringField(max_length=100, required=True)
+    analysis_code = men.StringField(max_length=50, required=True)
+    owner = men.StringField(max_length=100)
+    kind = men.StringField(max_length=100, required=True)  # The artifact's name without its extension
+    artifact_type = men.StringField(max_length=100)       # The QIIME semantic type, e.g. FeatureTable[Frequency]
+    path = men.StringField(max_length=256, required=True)
+    workflow_type = men.StringField(max_length=45)
+    params = men.DictField()                                # The config of the analysis that produced it
+
+    meta = {
+        'indexes': [
+            ('study_code', 'kind', '-created'),
+            'analysis_code'
+        ]
+    }
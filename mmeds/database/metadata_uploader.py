@@ -1,4 +1,7 @@
+import csv
+import os
 import warnings
+import yaml
 
 import mmeds.secrets as sec
 import mmeds.config as fig
@@ -18,12 +21,90 @@ from mmeds.database.documents import MMEDSDoc
 from mmeds.logging import Logger
 
 
+class UploadCheckpoint:
+    """
+    Records the progress of a metadata upload on disk so an interrupted upload can be resumed.
+    Each step of the upload is marked once it completes, along with any state later steps rely on.
+    """
+    def __init__(self, path, params=None):
+        """
+        Load the checkpoint at :path: if one exists, otherwise start a new one.
+        ===================================================================
+        :path: The location of the checkpoint file
+        :params: A dictionary. The arguments the MetaDataUploader was created with.
+        """
+        self.path = Path(path)
+        if self.path.exists():
+            self.state = yaml.safe_load(self.path.read_text())
+        else:
+            self.state = {
+                'params': params,
+                'pid': None,
+                'attempts': 0,
+                'metadata': None,
+                'completed': [],
+                'started': {},
+                'IDs': {}
+            }
+
+    @property
+    def params(self):
+        return self.state['params']
+
+    @property
+    def attempts(self):
+        """ The number of times the upload has been started """
+        return self.state.get('attempts', 0)
+
+    def is_complete(self, step):
+        """ Returns True if :step: finished in a previous attempt """
+        return step in self.state['completed']
+
+    def started(self, step):
+        """ Return the info recorded when :step: was started, None if it never was """
+        return self.state['started'].get(step)
+
+    def start(self, step, **kwargs):
+        """ Record that :step: is underway along with what's needed to undo it """
+        self.state['started'][step] = kwargs
+        self.save()
+
+    def complete(self, step, IDs=None):
+        """ Mark :step: as finished, storing the keys it resolved if there are any """
+        if IDs is not None:
+            self.state['IDs'][step] = {int(row): int(key) for row, key in IDs.items()}
+        self.state['started'].pop(step, None)
+        self.state['completed'].append(step)
+        self.save()
+
+    def get_ids(self, step):
+        """ Return the keys resolved by a completed step """
+        return self.state['IDs'].get(step, {})
+
+    def update(self, **kwargs):
+        """ Store additional values in the checkpoint """
+        self.state.update(kwargs)
+        self.save()
+
+    def save(self):
+        """ Write the checkpoint, replacing the previous one in a single step """
+        temp = self.path.with_suffix('.tmp')
+        with open(temp, 'w') as f:
+            yaml.safe_dump(self.state, f)
+        os.replace(temp, self.path)
+
+    def clear(self):
+        """ Remove the checkpoint once the upload has finished """
+        if self.path.exists():
+            self.path.unlink()
+
+
 class MetaDataUploader(Process):
     """
     This class handles the yprocessing and uploading of mmeds metadata files into the MySQL database.
     """
     def __init__(self, subject_metadata, subject_type, specimen_metadata, owner, study_type,
-                 study_name, meta_study, temporary, public, testing, access_code=None):
+                 study_name, meta_study, temporary, public, testing, access_code=None, resume=False):
         """
         Connect to the specified database.
         Initialize variables for this session.
@@ -33,6 +114,8 @@ class MetaDataUploader(Process):
         :user: A string. What account to login to the SQL server with (user or admin).
         :owner: A string. The mmeds user account uploading or retrieving files.
         :testing: A boolean. Changes the connection parameters for testing.
+        :resume: A boolean. If True continue the interrupted upload of the study with :access_code:
+            rather than creating a new study.
         """
         warnings.simplefilter('ignore')
         super().__init__()
@@ -90,35 +173,49 @@ class MetaDataUploader(Process):
                                      authentication_source=sec.MONGO_DATABASE,
                                      host=sec.MONGO_HOST)
 
-        if access_code is None:
-            self.access_code = fig.get_salt(50)
-            # Ensure a unique access code
-            while list(MMEDSDoc.objects(access_code=self.access_code)):
-                self.access_code = fig.get_salt(50)
-        else:
+        if resume:
+            # Pick up the document and directory of the interrupted upload
             self.access_code = access_code
-
-        # Create the document
-        self.mdata = MMEDSDoc(created=datetime.utcnow(),
-                              last_accessed=datetime.utcnow(),
-                              testing=self.testing,
-                              doc_type='study',
-                              workflow_type=self.study_type,
-                              study_name=self.study_name,
-                              access_code=self.access_code,
-                              owner=self.owner,
-                              public=self.public)
-
-        self.mdata.save()
-
-        count = 0
-        new_dir = fig.STUDIES_DIR / ('{}_{}_{}'.format(self.owner, self.study_name, count))
-        while new_dir.is_dir():
-            count += 1
+            self.mdata = MMEDSDoc.objects(access_code=self.access_code, doc_type='study').first()
+            new_dir = Path(self.mdata.path)
+        else:
+            count = 0
             new_dir = fig.STUDIES_DIR / ('{}_{}_{}'.format(self.owner, self.study_name, count))
-        new_dir.mkdir()
+            while new_dir.is_dir():
+                count += 1
+                new_dir = fig.STUDIES_DIR / ('{}_{}_{}'.format(self.owner, self.study_name, count))
+            new_dir.mkdir()
+
+            # Create the document
+            self.mdata = MMEDSDoc(created=datetime.utcnow(),
+                                  last_accessed=datetime.utcnow(),
+                                  testing=self.testing,
+                                  doc_type='study',
+                                  workflow_type=self.study_type,
+                                  study_name=self.study_name,
+                                  access_code=access_code or fig.get_salt(50),
+                                  owner=self.owner,
+                                  path=str(new_dir),
+                                  public=self.public)
+
+            # Generated access codes are replaced if they collide with an existing document
+            self.mdata.insert(None if access_code else lambda: fig.get_salt(50))
+            self.access_code = self.mdata.access_code
 
         self.path = Path(new_dir) / 'database_files'
+
+        # Track the progress of the upload so it can be resumed if interrupted
+        self.checkpoint = UploadCheckpoint(new_dir / fig.UPLOAD_CHECKPOINT_FILE, {
+            'subject_metadata': str(self.subject_metadata),
+            'subject_type': self.subject_type,
+            'specimen_metadata': str(self.specimen_metadata),
+            'owner': self.owner,
+            'study_type': self.study_type,
+            'study_name': self.study_name,
+            'meta_study': self.meta_study,
+            'temporary': self.temporary,
+            'public': self.public
+        })
         MMEDSDoc.objects.timeout(False)
 
     def get_info(self):
@@ -149,22 +246,28 @@ class MetaDataUploader(Process):
         self.mdata.update(is_alive=True)
         self.mdata.save()
         Logger.debug('Handling upload for study {} for user {}'.format(self.study_name, self.owner))
+        self.checkpoint.update(pid=os.getpid(), attempts=self.checkpoint.attempts + 1)
 
-        # Create a copy of the MetaData
-        with open(self.subject_metadata, 'rb') as f:
-            subject_metadata_copy = create_local_copy(f, self.subject_metadata.name, self.path.parent)
-
-        # Create a copy of the Specimen MetaData
-        with open(self.specimen_metadata, 'rb') as f:
-            specimen_metadata_copy = create_local_copy(f, self.specimen_metadata.name, self.path.parent)
-
-        # Merge the metadata files
-        metadata_copy = str(Path(subject_metadata_copy).parent / 'full_metadata.tsv')
-        metadata_df = join_metadata(load_metadata(subject_metadata_copy),
-                                    load_metadata(specimen_metadata_copy),
-                                    self.subject_type)
+        if self.checkpoint.is_complete('metadata'):
+            metadata_copy = self.checkpoint.state['metadata']
+        else:
+            # Create a copy of the MetaData
+            with open(self.subject_metadata, 'rb') as f:
+                subject_metadata_copy = create_local_copy(f, self.subject_metadata.name, self.path.parent)
+
+            # Create a copy of the Specimen MetaData
+            with open(self.specimen_metadata, 'rb') as f:
+                specimen_metadata_copy = create_local_copy(f, self.specimen_metadata.name, self.path.parent)
+
+            # Merge the metadata files
+            metadata_copy = str(Path(subject_metadata_copy).parent / 'full_metadata.tsv')
+            metadata_df = join_metadata(load_metadata(subject_metadata_copy),
+                                        load_metadata(specimen_metadata_copy),
+                                        self.subject_type)
+            write_metadata(metadata_df, metadata_copy)
+            self.checkpoint.state['metadata'] = metadata_copy
+            self.checkpoint.complete('metadata')
         self.metadata = metadata_copy
-        write_metadata(metadata_df, metadata_copy)
 
         if not self.temporary:
             # Read in the metadata file to import
@@ -206,6 +309,7 @@ class MetaDataUploader(Process):
         # Update the doc to reflect the successful upload
         self.mdata.update(is_alive=False, exit_code=0)
         self.mdata.save()
+        self.checkpoint.clear()
         return 0
 
     def import_metadata(self, **kwargs):
@@ -218,7 +322,9 @@ class MetaDataUploader(Process):
             self.path.mkdir()
 
         # Import the files into the mongo database
-        self.mongo_import(**kwargs)
+        if not self.checkpoint.is_complete('document'):
+            self.mongo_import(**kwargs)
+            self.checkpoint.complete('document')
 
         # If the metadata file is not temporary perform the import into the SQL database
         # If study is meta study also do not perform import, all data is already there
@@ -233,33 +339,55 @@ class MetaDataUploader(Process):
                 cursor.execute('SET @DISABLE_TRIGGERS = TRUE')
             self.db.commit()
 
-            # Create file and import data for each regular table
-            for table in tables:
-                # Upload the additional meta data to the NoSQL database
-                if not table == 'AdditionalMetaData':
-                    self.create_import_data(table)
-                    filename = self.create_import_file(table)
-                    if isinstance(filename, WindowsPath):
-                        filename = str(filename).replace('\\', '\\\\')
-                    # Load the newly created file into the database
-                    sql = quote_sql('LOAD DATA LOCAL INFILE %(file)s INTO TABLE {table} FIELDS TERMINATED BY "\\t"',
-                                    table=table)
-                    sql += ' LINES TERMINATED BY "\\n" IGNORE 1 ROWS'
-                    with self.db.cursor() as cursor:
-                        cursor.execute(sql, {'file': str(filename), 'table': table})
-                    # Commit the inserted data
-                    self.db.commit()
-
-            # Create csv files and import them for
-            # each junction table
-            self.fill_junction_tables()
-
-            # Remove all row information from the current input
-            self.IDs.clear()
-
-            # Reenable the table Weight Triggers
+            try:
+                # Create file and import data for each regular table
+                for table in tables:
+                    # Upload the additional meta data to the NoSQL database
+                    if not table == 'AdditionalMetaData':
+                        step = 'table:{}'.format(table)
+                        # Reuse the keys from a previous attempt if this table was already loaded
+                        if self.checkpoint.is_complete(step):
+                            self.IDs[table] = self.checkpoint.get_ids(step)
+                            continue
+                        self.remove_partial_import(table)
+                        self.create_import_data(table)
+                        filename = self.create_import_file(table)
+                        if isinstance(filename, WindowsPath):
+                            filename = str(filename).replace('\\', '\\\\')
+                        # Load the newly created file into the database
+                        sql = quote_sql('LOAD DATA LOCAL INFILE %(file)s INTO TABLE {table} FIELDS TERMINATED BY "\\t"',
+                                        table=table)
+                        sql += ' LINES TERMINATED BY "\\n" IGNORE 1 ROWS'
+                        with self.db.cursor() as cursor:
+                            cursor.execute(sql, {'file': str(filename), 'table': table})
+                        # Commit the inserted data
+                        self.db.commit()
+                        self.checkpoint.complete(step, self.IDs[table])
+
+                # Create csv files and import them for
+                # each junction table
+                self.fill_junction_tables()
+
+                # Remove all row information from the current input
+                self.IDs.clear()
+            finally:
+                # Reenable the table Weight Triggers
+                with self.db.cursor() as cursor:
+                    cursor.execute('SET @DISABLE_TRIGGERS = FALSE')
+                self.db.commit()
+
+    def remove_partial_import(self, table):
+        """
+        Remove any rows left in :table: by a previous attempt at this upload that
+        was interrupted before the table finished loading.
+        """
+        started = self.checkpoint.started('table:{}'.format(table))
+        if started is not None:
+            Logger.debug('Removing partial import of table {}'.format(table))
+            sql = quote_sql('DELETE FROM {table} WHERE {idtable} >= %(first_key)s',
+                            table=table, idtable='id' + table)
             with self.db.cursor() as cursor:
-                cursor.execute('SET @DISABLE_TRIGGERS = FALSE')
+                cursor.execute(sql, {'first_key': started['first_key']})
             self.db.commit()
 
     def create_import_data(self, table, verbose=True):
@@ -279,6 +407,8 @@ class MetaDataUploader(Process):
             current_key = int(vals[0]) + 1
         except TypeError:
             current_key = 1
+        # Any rows of this table with a key past this point will be created by this upload
+        self.checkpoint.start('table:{}'.format(table), first_key=current_key)
         # Track keys for repeated values in this file
         seen = {}
 
@@ -310,68 +440,58 @@ class MetaDataUploader(Process):
                     current_key += 1
                 cursor.close()
 
-    def create_import_line(self, table, structure, columns, row_index):
+    def create_import_frame(self, table):
         """
-        Creates a single line of the input file for the specified metadata table
+        Creates the rows of the input file for the specified metadata table as a single DataFrame
         :table: The name of the table the input is for
-        :structure: The structure of the SQL table the line will be imported into
-        :columns: A list. The columns of the table to fill out
-        :row_index: A int. The index of the row of the metadata this line corresponds to
+        ==========================================================================================
+        The columns follow the order of the SQL table as cached in `fig.ALL_TABLE_COLS`. Primary and
+        foreign keys are filled from self.IDs, every other column is taken directly from the metadata.
+        Null values are left as NaN/NA so they can be written as '\\N' when the frame is serialized.
         """
-        line = []
+        rows = pd.RangeIndex(len(self.df.index))
+        frame = pd.DataFrame(index=rows)
         # For each column in the table
-        for j, col in enumerate(columns):
+        for col in fig.ALL_TABLE_COLS[table]:
             # If the column is a primary key or foreign key
-            if structure[j][3] == 'PRI' or structure[j][3] == 'MUL':
+            if col in fig.TABLE_KEY_COLS[table]:
                 key_table = col.split('id')[-1]
-                # Get the approriate data from the dictionary
-                try:
-                    line.append(self.IDs[key_table][row_index])
-                except KeyError:
+                # Get the approriate keys from the dictionary
+                keys = pd.Series(self.IDs.get(key_table, {}), dtype='Int64').reindex(rows)
+                missing = keys.isna()
+                if missing.any():
                     # Depending on the type of the subject one of these keys should be NULL
                     # Check for that case before raising an Error
-                    if ((key_table == 'AnimalSubjects' and
-                         self.df['SubjectType']['SubjectType'].iloc[row_index] == 'Human') or
-                        (key_table == 'Subjects' and
-                         not self.df['SubjectType']['SubjectType'].iloc[row_index] == 'Human')):
-                        line.append('\\N')
+                    is_human = self.df['SubjectType']['SubjectType'].reset_index(drop=True) == 'Human'
+                    if key_table == 'AnimalSubjects':
+                        bad_rows = missing & ~is_human
+                    elif key_table == 'Subjects':
+                        bad_rows = missing & is_human
                     else:
-                        raise KeyError('Error getting key self.IDs[{}][{}]'.format(key_table, row_index))
-            elif structure[j][0] == 'user_id':
-                line.append(str(self.user_id))
-            elif structure[j][0] == 'AdditionalMetaDataRow':
-                line.append(str(row_index))
+                        bad_rows = missing
+                    if bad_rows.any():
+                        raise KeyError('Error getting key self.IDs[{}][{}]'.format(key_table,
+                                                                                   bad_rows.idxmax()))
+                frame[col] = keys
+            elif col == 'user_id':
+                frame[col] = str(self.user_id)
+            elif col == 'AdditionalMetaDataRow':
+                frame[col] = rows.astype(str)
+            elif col in self.df[table].columns:
+                frame[col] = self.df[table][col].reset_index(drop=True)
             else:
-                # Otherwise see if the entry already exists
-                try:
-                    if pd.isnull(self.df[table].loc[row_index][col]):
-                        line.append('\\N')
-                    else:
-                        line.append(self.df[table].loc[row_index][col])
-                except KeyError:
-                    line.append(col)
-        return line
+                frame[col] = col
+        return frame
 
     def create_import_file(self, table):
         """
         Create the file to load into each table referenced in the metadata input file
         """
-        # Get the structure of the table currently being filled out
-
-        cursor = self.db.cursor()
-        cursor.execute('DESCRIBE ' + table)
-        structure = cursor.fetchall()
-        cursor.close()
-        # Get the columns for the table
-        columns = list(map(lambda x: x[0], structure))
         filename = self.path / (table + '_input.csv')
-        # Create the input file
+        frame = self.create_import_frame(table)
+        # Write the header and every row in one pass
         with open(filename, 'w') as f:
-            f.write('\t'.join(columns) + '\n')
-            # For each row in the input file
-            for i in range(len(self.df.index)):
-                line = self.create_import_line(table, structure, columns, i)
-                f.write('\t'.join(list(map(str, line))) + '\n')
+            frame.to_csv(f, sep='\t', na_rep='\\N', index=False, quoting=csv.QUOTE_NONE, lineterminator='\n')
         return filename
 
     def fill_junction_tables(self):
@@ -380,6 +500,9 @@ class MetaDataUploader(Process):
         """
         # Import data for each junction table
         for table in fig.JUNCTION_TABLES:
+            step = 'junction:{}'.format(table)
+            if self.checkpoint.is_complete(step):
+                continue
             sql = quote_sql('DESCRIBE {table};', table=table)
 
             cursor = self.db.cursor()
@@ -387,28 +510,26 @@ class MetaDataUploader(Process):
             result = cursor.fetchall()
             cursor.close()
             columns = list(map(lambda x: x[0].split('_')[0], result))
-            key_pairs = []
-            # Only fill in tables where both foreign keys exist
-            try:
-                # Get the appropriate foreign keys from the IDs dict
-                for key in self.IDs[columns[0]].keys():
-                    keys_list = []
-                    # Ignore user_id column
-                    for column in columns[:-1]:
-                        keys_list.append(str(self.IDs[column][key]))
-                    # Add user_id
-                    keys_list.append(str(self.user_id))
-                    key_pairs.append('\t'.join(keys_list) + '\n')
+            parents = columns[:-1]
 
+            # Only fill in tables where both foreign keys exist
+            if all(self.IDs.get(parent) for parent in parents):
+                # Line up the keys each metadata row resolved to in the parent tables
+                pairs = pd.DataFrame({parent: pd.Series(self.IDs[parent], dtype='Int64') for parent in parents})
+                pairs = pairs.reindex(pd.Index(self.IDs[parents[0]].keys()))
+                # Add user_id
+                pairs[columns[-1]] = str(self.user_id)
                 # Remove any repeated pairs of foreign keys
-                unique_pairs = list(set(key_pairs))
-                filename = self.path / (table + '_input.csv')
+                pairs = pairs.dropna().drop_duplicates()
+                # A previous attempt may have loaded some of the pairs before it was interrupted
+                if self.checkpoint.started(step) is not None:
+                    pairs = self.remove_loaded_pairs(table, pairs)
+                self.checkpoint.start(step)
 
+                filename = self.path / (table + '_input.csv')
                 # Create the input file for the juntion table
                 with open(filename, 'w') as f:
-                    f.write('\t'.join(columns) + '\n')
-                    for pair in unique_pairs:
-                        f.write(pair)
+                    pairs.to_csv(f, sep='\t', index=False, quoting=csv.QUOTE_NONE, lineterminator='\n')
 
                 if isinstance(filename, WindowsPath):
                     filename = str(filename).replace('\\', '\\\\')
@@ -421,9 +542,20 @@ class MetaDataUploader(Process):
                     cursor.execute(sql, {'file': str(filename), 'table': table})
                 # Commit the inserted data
                 self.db.commit()
-            except KeyError as e:
-                e.args[1] += '\t{}\n'.format(str(filename))
-                raise e
+            self.checkpoint.complete(step)
+
+    def remove_loaded_pairs(self, table, pairs):
+        """
+        Return the rows of :pairs: that aren't already in the junction :table:, so a
+        retried upload doesn't load the pairs of an interrupted attempt a second time.
+        """
+        sql = quote_sql('SELECT * FROM {table} WHERE user_id = %(user_id)s', table=table)
+        with self.db.cursor() as cursor:
+            cursor.execute(sql, {'user_id': self.user_id})
+            loaded = set(cursor.fetchall())
+        Logger.debug('Skipping pairs already loaded into junction table {}'.format(table))
+        keep = [tuple(int(value) for value in row) not in loaded for row in pairs.itertuples(index=False)]
+        return pairs[keep]
 
     def mongo_import(self, **kwargs):
         """ Imports additional columns into the NoSQL database. """
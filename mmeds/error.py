@@ -164,3 +164,27 @@ class StudyNameError(MmedsError):
     def __init__(self, message):
         self.message = message
         super().__init__()
+
+
+class WatcherUnavailableError(MmedsError):
+    """ Exception for when the watcher can't be reached or doesn't respond in time """
+
+    def __init__(self, message='Unable to reach the watcher'):
+        self.message = message
+        super().__init__()
+
+
+class WatcherRequestError(MmedsError):
+    """ Exception for requests the watcher received but failed to handle """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__()
+
+
+class GraphRenderError(MmedsError):
+    """ Exception for analysis graphs that couldn't be rendered """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__()
@@ -0,0 +1,295 @@
+import os
+import pickle
+import socket
+import struct
+import selectors
+from time import time
+from pathlib import Path
+from itertools import count
+from collections import defaultdict
+from queue import Queue
+from threading import Thread, Lock, Event, get_ident
+
+from mmeds.error import WatcherUnavailableError, WatcherRequestError
+from mmeds.logging import Logger
+
+# Each message is prefixed with its length
+HEADER = struct.Struct('!I')
+
+
+def send_frame(sock, message):
+    """ Send MESSAGE on SOCK as a single length prefixed frame """
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+class FrameReader:
+    """ Collects the bytes received on a socket and splits them back into messages """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Add DATA to the buffer and return any messages that are now complete """
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < HEADER.size + length:
+                break
+            messages.append(pickle.loads(self.buffer[HEADER.size:HEADER.size + length]))
+            del self.buffer[:HEADER.size + length]
+        return messages
+
+
+class LeaseTable:
+    """
+    Grants time limited leases on locks. A lease that isn't renewed before it expires, or
+    whose holder disconnects, is released so a client that dies can't leave a lock held.
+    """
+    def __init__(self, locks):
+        """
+        :locks: A dict. The locks that can be leased by name, each with acquire and release methods.
+        """
+        self.locks = locks
+        # The holder and expiry time of each lease, by lock name
+        self.leases = {}
+        self.lock = Lock()
+
+    def acquire(self, name, holder, ttl):
+        """ Lease lock NAME to HOLDER for TTL seconds. Returns False if it's held by someone else. """
+        with self.lock:
+            current = self.leases.get(name)
+            if current is not None and current[0] == holder:
+                # Renew the existing lease
+                self.leases[name] = (holder, time() + ttl)
+                return True
+            if current is None and self.locks[name].acquire(False):
+                self.leases[name] = (holder, time() + ttl)
+                return True
+            return False
+
+    def release(self, name, holder):
+        """ Release lock NAME if it's leased to HOLDER """
+        with self.lock:
+            if name in self.leases and self.leases[name][0] == holder:
+                del self.leases[name]
+                self.unlock(name)
+                return True
+            return False
+
+    def release_where(self, condition):
+        """ Release every lease for which CONDITION(holder, expires) is true """
+        with self.lock:
+            for name, (holder, expires) in list(self.leases.items()):
+                if condition(holder, expires):
+                    Logger.debug('Releasing lease on {} held by {}'.format(name, holder))
+                    del self.leases[name]
+                    self.unlock(name)
+
+    def unlock(self, name):
+        """ Release lock NAME, which something else may have released while it was leased """
+        try:
+            self.locks[name].release()
+        except (ValueError, RuntimeError) as e:
+            Logger.error('Lock {} was released while leased: {}'.format(name, e))
+
+    def expire(self):
+        """ Release all the leases that have expired """
+        now = time()
+        self.release_where(lambda holder, expires: expires < now)
+
+
+class IPCServer:
+    """
+    Serves requests from IPCClients on a Unix domain socket.
+    ========================================================
+    Each message is a pickled tuple sent as a length prefixed frame. Requests are
+    (request id, command, arguments) and are answered with (request id, success, result).
+    Besides the commands in HANDLERS the server handles 'subscribe', 'lease', and 'release'.
+    Messages published to a topic are sent to its subscribers as (None, topic, message).
+    All requests are handled on a single background thread, so handlers should be quick.
+    """
+    def __init__(self, path, handlers, locks, mode=0o600):
+        """
+        :path: The location of the socket file.
+        :handlers: A dict. The function to call with the arguments of each command.
+        :locks: A dict. The locks clients can lease by name.
+        :mode: An int. The permissions of the socket file, which decide who may connect.
+        """
+        self.path = Path(path)
+        self.mode = mode
+        self.handlers = handlers
+        self.leases = LeaseTable(locks)
+        self.subscribers = defaultdict(set)
+        self.readers = {}
+        self.selector = selectors.DefaultSelector()
+        self.send_lock = Lock()
+        self.sock = None
+
+    def start(self):
+        """ Start listening for clients """
+        if self.path.exists():
+            self.path.unlink()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(str(self.path))
+        # Messages are pickled so only trusted users may connect
+        os.chmod(self.path, self.mode)
+        self.sock.listen()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            # An error handling one client mustn't stop the server for the rest
+            try:
+                for key, events in self.selector.select(timeout=1):
+                    if key.fileobj is self.sock:
+                        client, _ = self.sock.accept()
+                        # Don't let a client that stops reading hold up the server
+                        client.settimeout(5)
+                        self.readers[client] = FrameReader()
+                        self.selector.register(client, selectors.EVENT_READ)
+                    else:
+                        self.receive(key.fileobj)
+                self.leases.expire()
+            except Exception as e:
+                Logger.error('Error serving watcher clients: {}: {}'.format(type(e).__name__, e))
+
+    def receive(self, client):
+        """ Handle the messages waiting on CLIENT """
+        try:
+            data = client.recv(2 ** 16)
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client)
+            return
+
+        for request_id, command, args in self.readers[client].feed(data):
+            try:
+                result = True, self.handle(client, command, args)
+            except Exception as e:
+                result = False, '{}: {}'.format(type(e).__name__, e)
+            self.send(client, (request_id,) + result)
+
+    def handle(self, client, command, args):
+        if command == 'subscribe':
+            self.subscribers[args[0]].add(client)
+        elif command == 'lease':
+            name, token, ttl = args
+            return self.leases.acquire(name, (client, token), ttl)
+        elif command == 'release':
+            name, token = args
+            return self.leases.release(name, (client, token))
+        else:
+            return self.handlers[command](*args)
+
+    def publish(self, topic, message):
+        """ Send MESSAGE to every client subscribed to TOPIC """
+        for client in list(self.subscribers[topic]):
+            self.send(client, (None, topic, message))
+
+    def send(self, client, message):
+        try:
+            with self.send_lock:
+                send_frame(client, message)
+        except OSError:
+            self.drop(client)
+
+    def drop(self, client):
+        """ Disconnect CLIENT, releasing any leases it holds """
+        if self.readers.pop(client, None) is None:
+            return
+        self.selector.unregister(client)
+        for subscribers in self.subscribers.values():
+            subscribers.discard(client)
+        self.leases.release_where(lambda holder, expires: holder[0] is client)
+        client.close()
+
+
+class IPCClient:
+    """
+    A connection to an IPCServer that can be shared by multiple threads. Requests from
+    each thread are matched to their responses by ID so they don't wait on each other.
+    """
+    def __init__(self, path):
+        """
+        :path: The location of the server's socket file.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(path))
+        self.send_lock = Lock()
+        self.ids = count()
+        # The event and result of each request waiting on a response
+        self.pending = {}
+        self.topics = defaultdict(Queue)
+        self.closed = False
+        Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        """ Pass the messages received to the requests and topics they belong to """
+        reader = FrameReader()
+        while True:
+            try:
+                data = self.sock.recv(2 ** 16)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            for request_id, first, second in reader.feed(data):
+                if request_id is None:
+                    self.topics[first].put(second)
+                elif request_id in self.pending:
+                    waiter = self.pending.pop(request_id)
+                    waiter[1] = (first, second)
+                    waiter[0].set()
+        self.close()
+
+    def request(self, command, *args, timeout=None):
+        """ Send COMMAND with ARGS to the server and return the result """
+        request_id = next(self.ids)
+        waiter = [Event(), None]
+        self.pending[request_id] = waiter
+        try:
+            with self.send_lock:
+                send_frame(self.sock, (request_id, command, args))
+        except OSError as e:
+            self.close()
+            raise WatcherUnavailableError('Lost connection to the watcher: {}'.format(e))
+
+        if not waiter[0].wait(timeout):
+            self.pending.pop(request_id, None)
+            raise WatcherUnavailableError('The watcher did not respond to {} in time'.format(command))
+        if waiter[1] is None:
+            raise WatcherUnavailableError('Lost connection to the watcher')
+        success, result = waiter[1]
+        if not success:
+            raise WatcherRequestError('The watcher failed to handle {}. {}'.format(command, result))
+        return result
+
+    def subscribe(self, topic, timeout=None):
+        """ Receive the messages published to TOPIC. Returns the queue they'll be put in. """
+        self.request('subscribe', topic, timeout=timeout)
+        return self.topics[topic]
+
+    def lease(self, name, ttl, timeout=None):
+        """ Try to lease lock NAME for TTL seconds on behalf of the current thread """
+        return self.request('lease', name, get_ident(), ttl, timeout=timeout)
+
+    def release(self, name, timeout=None):
+        """ Release the current thread's lease on lock NAME """
+        return self.request('release', name, get_ident(), timeout=timeout)
+
+    def close(self):
+        """ Close the connection, failing any requests still waiting on a response """
+        self.closed = True
+        try:
+            # Shut down first so the server sees the disconnect while the reader is still waiting on the socket
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        except OSError:
+            pass
+        for request_id in list(self.pending):
+            waiter = self.pending.pop(request_id, None)
+            if waiter is not None:
+                waiter[0].set()
@@ -0,0 +1,189 @@
+"""
+Metrics on how the watcher and the databases are performing.
+============================================================
+MetricsRegistry collects counters, gauges, and summaries of durations for the current process,
+e.g. the watcher's queue depths and how long each message took to handle, along with the time
+taken by SQL queries and MongoDB commands. serve_metrics serves them in the Prometheus text
+format on /metrics, with the watcher's health check on /health.
+"""
+import json
+from time import perf_counter
+from threading import Lock, Thread
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pymongo import monitoring
+from pymysql.cursors import Cursor
+
+from mmeds.logging import Logger
+
+
+class MetricsRegistry:
+    """
+    Collects the metrics for the current process and renders them in the Prometheus text format.
+    =============================================================================================
+    Counters only go up, gauges are set to their current value, and summaries record the
+    count, total, and maximum of observed values such as durations. Each metric may have labels.
+    Summaries have no maximum in the Prometheus format, so it's rendered as a separate gauge, NAME_max.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.help = {}
+        self.types = {}
+        self.values = defaultdict(dict)
+        self.health_check = None
+
+    def describe(self, name, metric_type, text):
+        """ Set the type and help text of the metric NAME """
+        self.types[name] = metric_type
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        """ Increase the counter NAME by AMOUNT """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """ Set the gauge NAME to VALUE """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.types.setdefault(name, 'gauge')
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        """ Record VALUE in the summary NAME """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.types.setdefault(name, 'summary')
+            count, total, maximum = self.values[name].get(key, (0, 0, 0))
+            self.values[name][key] = (count + 1, total + value, max(maximum, value))
+
+    def get(self, name, **labels):
+        """ Return the current value of metric NAME, None if it hasn't been recorded """
+        return self.values[name].get(tuple(sorted(labels.items())))
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for name in sorted(self.values):
+                metric_type = self.types[name]
+                if name in self.help:
+                    lines.append('# HELP {} {}'.format(name, self.help[name]))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                values = sorted(self.values[name].items())
+                if metric_type == 'summary':
+                    for key, (count, total, maximum) in values:
+                        lines.append('{}_count{} {}'.format(name, format_labels(key), count))
+                        lines.append('{}_sum{} {}'.format(name, format_labels(key), total))
+                    lines.append('# HELP {}_max Largest value observed in {}'.format(name, name))
+                    lines.append('# TYPE {}_max gauge'.format(name))
+                    for key, (count, total, maximum) in values:
+                        lines.append('{}_max{} {}'.format(name, format_labels(key), maximum))
+                else:
+                    for key, value in values:
+                        lines.append('{}{} {}'.format(name, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+    def health(self):
+        """ Return whether the process is healthy along with the details of the check """
+        if self.health_check is None:
+            return True, {}
+        return self.health_check()
+
+
+def format_labels(key):
+    """ Format a sorted tuple of label pairs as Prometheus labels """
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('"', '\\"')) for label, value in key) + '}'
+
+
+# The metrics for this process
+REGISTRY = MetricsRegistry()
+for name, metric_type, text in [
+        ('mmeds_watcher_messages_total', 'counter', 'Messages received by the watcher by type'),
+        ('mmeds_watcher_queue_depth', 'gauge', 'Messages waiting to be handled by type'),
+        ('mmeds_watcher_queue_wait_mean_seconds', 'gauge', 'Mean time recent messages waited in each lane'),
+        ('mmeds_watcher_queue_wait_max_seconds', 'gauge', 'Longest time recent messages waited in each lane'),
+        ('mmeds_watcher_handle_seconds', 'summary', 'Time spent handling messages by type'),
+        ('mmeds_watcher_process_run_seconds', 'summary', 'Run time of finished uploads and analyses by type'),
+        ('mmeds_watcher_active_uploads', 'gauge', 'Uploads currently running'),
+        ('mmeds_watcher_active_analyses', 'gauge', 'Analyses currently running'),
+        ('mmeds_watcher_waiting_analyses', 'gauge', 'Analyses waiting for resources on the node'),
+        ('mmeds_watcher_reserved_cores', 'gauge', 'Cores reserved by analyses running on the node'),
+        ('mmeds_watcher_tick_seconds', 'summary', 'Time taken by each loop of the watcher, excluding sleep'),
+        ('mmeds_watcher_last_tick_timestamp_seconds', 'gauge', 'When the watcher last completed a loop'),
+        ('mmeds_sql_query_seconds', 'summary', 'Time taken by SQL queries'),
+        ('mmeds_mongo_command_seconds', 'summary', 'Time taken by MongoDB commands by command'),
+        ('mmeds_mongo_command_failures_total', 'counter', 'MongoDB commands that failed by command')]:
+    REGISTRY.describe(name, metric_type, text)
+
+
+class Timer:
+    """ Context manager that records how long its block took in the summary NAME """
+    def __init__(self, name, registry=REGISTRY, **labels):
+        self.name = name
+        self.registry = registry
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+class TimedCursor(Cursor):
+    """ A pymysql cursor that records the number and duration of the SQL queries it executes """
+    def execute(self, query, args=None):
+        with Timer('mmeds_sql_query_seconds'):
+            return super().execute(query, args)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """ Records the number and duration of the commands sent to MongoDB """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        REGISTRY.observe('mmeds_mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        REGISTRY.observe('mmeds_mongo_command_seconds', event.duration_micros / 1e6, command=event.command_name)
+        REGISTRY.inc('mmeds_mongo_command_failures_total', command=event.command_name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves /metrics in the Prometheus format and /health as JSON """
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.respond(200, 'text/plain; version=0.0.4', REGISTRY.render())
+        elif self.path == '/health':
+            healthy, details = REGISTRY.health()
+            details['healthy'] = healthy
+            self.respond(200 if healthy else 503, 'application/json', json.dumps(details, default=str))
+        else:
+            self.respond(404, 'text/plain', 'Not found\n')
+
+    def respond(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        """ Requests are frequent so don't log them """
+        pass
+
+
+def serve_metrics(address):
+    """ Serve the metrics for this process on ADDRESS from a background thread """
+    monitoring.register(MongoCommandListener())
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    Logger.debug('Serving metrics on {}'.format(address))
+    return server
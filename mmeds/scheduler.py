@@ -0,0 +1,188 @@
+import pickle
+import sqlite3
+from time import time
+from collections import defaultdict, deque
+
+
+class WorkScheduler:
+    """
+    Orders the work items sent to the Watcher. Items are sorted into lanes by their type and
+    within each lane kept in a separate queue for each user.
+    =========================================================================================
+    Control messages go first, followed by interactive work (emails) which is quick and has
+    someone waiting on it. The batch lanes (uploads, including ID generation since it writes
+    to the database, and analyses) take turns so neither starves the other. Within a lane the
+    user who was served longest ago goes next, so one user submitting many items doesn't hold
+    up everyone else.
+    """
+    # Lanes in order of priority
+    PRIORITY_LANES = ('control', 'interactive')
+    BATCH_LANES = ('upload', 'analysis')
+
+    def __init__(self, history=100):
+        """
+        :history: An int. How many of the most recent wait times to keep for each lane.
+        """
+        self.lanes = {lane: defaultdict(deque) for lane in self.PRIORITY_LANES + self.BATCH_LANES}
+        self.last_served = defaultdict(float)
+        self.waits = {lane: deque(maxlen=history) for lane in self.lanes}
+        self.batch_turn = 0
+        self.last_pop = None
+
+    @staticmethod
+    def classify(item):
+        """ Return the lane ITEM belongs in and the user it's on behalf of """
+        if isinstance(item, str):
+            return 'control', None
+        ptype = item[0]
+        if ptype in ('connected', 'count'):
+            return 'control', None
+        elif ptype == 'email':
+            return 'interactive', item[2]
+        elif ptype == 'upload-ids':
+            return 'upload', item[1]
+        elif ptype == 'upload-run':
+            return 'upload', item[2]
+        elif ptype == 'upload-resume':
+            return 'upload', None
+        elif 'upload' in ptype:
+            return 'upload', item[5]
+        # Analyses and restarts
+        return 'analysis', item[1]
+
+    def put(self, item, enqueued=None, ticket=None):
+        """
+        Add ITEM to the scheduler. ENQUEUED is when it was first submitted, defaults to now.
+        TICKET identifies the item in the WorkJournal, if it was recorded there.
+        """
+        lane, user = self.classify(item)
+        self.lanes[lane][user].append((enqueued or time(), item, ticket))
+
+    def get(self, skip=()):
+        """
+        Return the ticket and the next item to handle, or (None, None) if there isn't one.
+        Batch lanes listed in SKIP are passed over, e.g. uploads while another upload is running.
+        """
+        for lane in self.PRIORITY_LANES:
+            if self.depth(lane):
+                return self.pop(lane)
+
+        ready = [lane for lane in self.BATCH_LANES if lane not in skip and self.depth(lane)]
+        if not ready:
+            return None, None
+        lane = ready[self.batch_turn % len(ready)]
+        self.batch_turn += 1
+        return self.pop(lane)
+
+    def pop(self, lane):
+        """ Take the oldest item, and its ticket, from the user in LANE who was served longest ago """
+        users = self.lanes[lane]
+        user = min(users, key=lambda user: self.last_served[(lane, user)])
+        enqueued, item, ticket = users[user].popleft()
+        if not users[user]:
+            del users[user]
+        now = time()
+        self.last_pop = (lane, user, enqueued, item, ticket, self.last_served[(lane, user)])
+        self.last_served[(lane, user)] = now
+        self.waits[lane].append(now - enqueued)
+        return ticket, item
+
+    def unget(self):
+        """ Return the last item taken to the front of its queue, keeping when it was first submitted """
+        lane, user, enqueued, item, ticket, last_served = self.last_pop
+        self.lanes[lane][user].appendleft((enqueued, item, ticket))
+        self.last_served[(lane, user)] = last_served
+        self.waits[lane].pop()
+        self.last_pop = None
+
+    def depth(self, lane):
+        """ Return the number of items waiting in LANE """
+        return sum(len(items) for items in self.lanes[lane].values())
+
+    def depth_by_type(self):
+        """ Return the number of items waiting of each message type """
+        depths = defaultdict(int)
+        for users in self.lanes.values():
+            for items in users.values():
+                for enqueued, item, ticket in items:
+                    depths[item if isinstance(item, str) else item[0]] += 1
+        return dict(depths)
+
+    def __len__(self):
+        return sum(self.depth(lane) for lane in self.lanes)
+
+    def metrics(self):
+        """ Return the depth and recent wait times, in seconds, of each lane """
+        metrics = {}
+        for lane, waits in self.waits.items():
+            metrics[lane] = {
+                'depth': self.depth(lane),
+                'users': len(self.lanes[lane]),
+                'mean_wait': round(sum(waits) / len(waits), 3) if waits else 0,
+                'max_wait': round(max(waits), 3) if waits else 0
+            }
+        return metrics
+
+
+class WorkJournal:
+    """
+    Records the work sent to the Watcher in a SQLite database so none of it is lost if the Watcher stops.
+    =====================================================================================================
+    Items are added as 'pending' when they're received. Items that spawn a process are marked 'started'
+    along with the access code of that process, and removed once the process finishes. Everything else
+    is removed as soon as it's been handled. After a restart the pending items are delivered again and the
+    started ones are checked against their processes, so finished work isn't repeated. Senders can give an
+    item an idempotency key, an item with the same key as unfinished work is a duplicate and isn't added.
+    """
+    def __init__(self, path):
+        """
+        :path: The location of the SQLite database file.
+        """
+        self.db = sqlite3.connect(str(path), isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS work (id INTEGER PRIMARY KEY, key TEXT, item BLOB, '
+                        'status TEXT, access_code TEXT, enqueued REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS work_key ON work (key)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS work_code ON work (access_code)')
+
+    def add(self, item, key=None):
+        """
+        Record ITEM as pending. Returns its ticket, or None if its idempotency KEY matches unfinished work.
+        Items without a key are always added, identical items can be legitimate, e.g. the same email twice.
+        """
+        if key is not None and self.db.execute('SELECT id FROM work WHERE key = ?', (key,)).fetchone():
+            return None
+        cursor = self.db.execute('INSERT INTO work (key, item, status, enqueued) VALUES (?, ?, ?, ?)',
+                                 (key, pickle.dumps(item), 'pending', time()))
+        return cursor.lastrowid
+
+    def start(self, ticket, access_code):
+        """ Mark the item with TICKET as started, running as the process with ACCESS_CODE """
+        if ticket is not None:
+            self.db.execute('UPDATE work SET status = ?, access_code = ? WHERE id = ?',
+                            ('started', access_code, ticket))
+
+    def requeue(self, ticket):
+        """ Return the item with TICKET to pending so it's delivered again """
+        if ticket is not None:
+            self.db.execute('UPDATE work SET status = ?, access_code = NULL WHERE id = ?', ('pending', ticket))
+
+    def ack(self, ticket):
+        """ Remove the item with TICKET now that it's been handled """
+        if ticket is not None:
+            self.db.execute('DELETE FROM work WHERE id = ?', (ticket,))
+
+    def finish(self, access_code):
+        """ Remove the started item whose process had ACCESS_CODE now that it's finished """
+        self.db.execute('DELETE FROM work WHERE status = ? AND access_code = ?', ('started', access_code))
+
+    def pending(self):
+        """ Return the ticket, item, and time received of each pending item in the order they were received """
+        rows = self.db.execute('SELECT id, item, enqueued FROM work WHERE status = ? ORDER BY id', ('pending',))
+        return [(ticket, pickle.loads(data), enqueued) for ticket, data, enqueued in rows]
+
+    def started(self):
+        """ Return the ticket, item, and process access code of each started item """
+        rows = self.db.execute('SELECT id, item, access_code FROM work WHERE status = ? ORDER BY id', ('started',))
+        return [(ticket, pickle.loads(data), access_code) for ticket, data, access_code in rows]
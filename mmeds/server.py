@@ -6,6 +6,7 @@ from pathlib import Path
 from functools import wraps
 from inspect import isfunction
 from copy import deepcopy
+from hashlib import sha1
 
 import mmeds.error as err
 import mmeds.util as util
@@ -19,7 +20,7 @@ from mmeds.authentication import (validate_password, check_username, check_passw
                                   add_user, reset_password, change_password)
 from mmeds.database.database import Database
 from mmeds.database.documents import MMEDSDoc
-from mmeds.spawn import handle_modify_data, Watcher
+from mmeds.spawn import handle_modify_data, get_watcher_client
 from mmeds.logging import Logger
 
 
@@ -71,17 +72,13 @@ class MMEDSbase:
 
     def __init__(self):
         """
-        Creates a connection from the webpage to the watcher process to allow
-        for information transfer via the queue
+        Gets the connection from the webpage to the watcher process that allows
+        for information transfer via the queue. It's shared by every section and
+        only connects once the watcher is first needed.
         """
         self.db = None
         self.testing = fig.TESTING
-        self.monitor = Watcher()
-        cp.log("{} Connecting to monitor".format(id(self)))
-        self.monitor.connect()
-        cp.log("{} Connected to monitor".format(id(self)))
-        self.q = self.monitor.get_queue()
-        cp.log("{} Got Queue".format(id(self)))
+        self.monitor = get_watcher_client()
 
     def get_user(self):
         """
@@ -118,6 +115,14 @@ class MMEDSbase:
             cp.session['privilege'] = privilege
         return privilege
 
+    def work_key(self, *parts):
+        """
+        Return the idempotency key of work the current user sends to the watcher, identified by PARTS.
+        The watcher ignores work whose key matches unfinished work, so a form that's submitted twice,
+        or a request that's retried after reconnecting, is only run once.
+        """
+        return '/'.join([self.get_user()] + [str(part) for part in parts])
+
     def check_upload(self, access_code):
         """ Raise an error if the upload does not exist or is currently in use. """
         try:
@@ -234,6 +239,11 @@ class MMEDSdownload(MMEDSbase):
         the path to the file on disk as the value.
         """
         Logger.debug(f"avail: {cp.session['download_files']}")
+        if file_name in util.SNAKEMAKE_GRAPHS:
+            try:
+                util.render_snakemake_graph(cp.session['download_files'][file_name])
+            except err.GraphRenderError as e:
+                return self.load_webpage('home', error=e.message)
         return static.serve_file(cp.session['download_files'][file_name], 'application/x-download',
                                  'attachment', Path(cp.session['download_files'][file_name]).name)
 
@@ -292,19 +302,19 @@ class MMEDSstudy(MMEDSbase):
         # If user has elevated privileges show them all uploaded studies
         if check_privileges(self.get_user(), self.testing):
             with Database(path='.', testing=self.testing) as db:
-                studies = db.get_all_studies()
-                runs = db.get_all_sequencing_runs()
+                studies = db.get_study_listing()
+                runs = db.get_sequencing_run_listing()
         # Otherwise only show studies they've uploaded
         else:
             with Database(path='.', testing=self.testing) as db:
-                studies = db.get_all_user_studies(self.get_user())
-                runs = db.get_all_user_sequencing_runs(self.get_user())
-        cp.log("Found {} studies".format(len(studies)))
+                studies = db.get_study_listing(self.get_user())
+                runs = db.get_sequencing_run_listing(self.get_user())
+        cp.log("Found {} studies".format(studies.count()))
 
         study_list = []
         for study in studies:
             with Database(path='.', testing=self.testing) as db:
-                analyses_count = len(db.get_docs(doc_type='analysis', study_name=study.study_name))
+                analyses_count = db.get_docs(doc_type='analysis', study_name=study.study_name).count()
             study_list.append(study_html.format(study_name=study.study_name,
                                                 view_study_page=SERVER_PATH + 'study/view_study',
                                                 access_code=study.access_code,
@@ -333,7 +343,7 @@ class MMEDSstudy(MMEDSbase):
             with Database(path='.', testing=self.testing, owner=self.get_user()) as db:
                 # Check the study belongs to the user only if the user doesn't have elevated privileges
                 study = db.get_doc(access_code, not check_privileges(self.get_user(), self.testing))
-                docs = db.get_docs(study_code=access_code)
+                docs = db.get_analysis_listing(study_code=access_code)
 
             option_template = '<option value="{}">{}</option>'
 
@@ -805,7 +815,8 @@ class MMEDSupload(MMEDSbase):
             if valid_additional_file(data_file['idFile'], idType, generateID):
 
                 # Pass it to the watcher
-                self.q.put(('upload-ids', self.get_user(), accessCode, data_file['idFile'], idType, generateID))
+                self.monitor.put(('upload-ids', self.get_user(), accessCode, data_file['idFile'], idType, generateID),
+                                 key=self.work_key('upload-ids', accessCode, idType))
                 success = f'{idType.capitalize()} Data Upload Initiated.' +\
                     'You will receive an email when it finishes'
             else:
@@ -893,11 +904,12 @@ class MMEDSupload(MMEDSbase):
                 datafiles = self.load_data_files(for_reads=kwargs['for_reads'],
                                                  barcodes=kwargs['barcodes'])
 
-        cp.log("Server putting upload in queue {}".format(id(self.q)))
+        cp.log("Server putting upload in queue")
         # Add the files to be uploaded to the queue for uploads
         # This will be handled by the Watcher class found in spawn.py
-        self.q.put(('upload-run', cp.session['run_name'], self.get_user(),
-                    reads_type, barcodes_type, datafiles, public))
+        self.monitor.put(('upload-run', cp.session['run_name'], self.get_user(),
+                          reads_type, barcodes_type, datafiles, public),
+                         key=self.work_key('upload-run', cp.session['run_name']))
 
         return self.load_webpage('home', success='Upload Initiated. You will receive an email when this finishes')
 
@@ -907,7 +919,7 @@ class MMEDSupload(MMEDSbase):
         subject_metadata = Path(cp.session['uploaded_files']['subject'])
         specimen_metadata = Path(cp.session['uploaded_files']['specimen'])
 
-        cp.log("Server putting upload in queue {}".format(id(self.q)))
+        cp.log("Server putting upload in queue")
         # Add the files to be uploaded to the queue for uploads
         # This will be handled by the Watcher class found in spawn.py
         Logger.debug(f"\nstudy_name: {cp.session['study_name']}\n \
@@ -916,8 +928,9 @@ class MMEDSupload(MMEDSbase):
                      specimen_metadata: {specimen_metadata.name}\n \
                      user: {self.get_user()}\n \
                      ")
-        self.q.put(('upload', cp.session['study_name'], subject_metadata, cp.session['subject_type'],
-                    specimen_metadata, self.get_user(), False, False, public))
+        self.monitor.put(('upload', cp.session['study_name'], subject_metadata, cp.session['subject_type'],
+                          specimen_metadata, self.get_user(), False, False, public),
+                         key=self.work_key('upload', cp.session['study_name']))
 
         return self.load_webpage('home', success='Upload Initiated. You will receive an email when this finishes')
 
@@ -980,12 +993,13 @@ class MMEDSupload(MMEDSbase):
             cp.log(f"Upload is LeFSe data with reads type {reads_type}")
             barcodes_type = None
 
-        cp.log("Server putting upload in queue {}".format(id(self.q)))
+        cp.log("Server putting upload in queue")
         # Add the files to be uploaded to the queue for uploads
         # This will be handled by the Watcher class found in spawn.py
-        self.q.put(('upload', cp.session['study_name'], subject_metadata, cp.session['subject_type'],
-                    specimen_metadata, self.get_user(), reads_type, barcodes_type, datafiles,
-                    cp.session['subject_type'], public))
+        self.monitor.put(('upload', cp.session['study_name'], subject_metadata, cp.session['subject_type'],
+                          specimen_metadata, self.get_user(), reads_type, barcodes_type, datafiles,
+                          cp.session['subject_type'], public),
+                         key=self.work_key('upload', cp.session['study_name']))
 
         return self.load_webpage('home', success='Upload Initiated. You will receive an email when this finishes')
 
@@ -1041,6 +1055,11 @@ class MMEDSauthentication(MMEDSbase):
             check_password(password1, password2)
             check_username(username, testing=self.testing)
             add_user(username, password1, email, testing=self.testing)
+            try:
+                self.monitor.put(('count', 'user_count'))
+            except (err.WatcherUnavailableError, err.WatcherRequestError) as e:
+                # The stats are recounted periodically so the account shouldn't fail over this
+                Logger.error(e.message)
             page = self.load_webpage('login', success='Account created successfully!')
         except (err.InvalidPasswordErrors, err.InvalidUsernameError) as e:
             cp.log('error, invalid something.\n{}'.format(e.message))
@@ -1127,9 +1146,11 @@ class MMEDSanalysis(MMEDSbase):
         option_template = '<option value="{}">{}</option>'
 
         # Get files downloadable from this study
+        # The snakemake graphs are listed once their DAG has been dumped, they're rendered when downloaded
         analysis_files = [option_template.format(key, key.capitalize())
                           for key, path in analysis.files.items()
-                          if Path(path).exists()]
+                          if Path(path).exists() or
+                          (key in util.SNAKEMAKE_GRAPHS and Path(path).with_name('snakemake_dag.dot').exists())]
 
         # Get analyses performed on this study
         for key, path in analysis.files.items():
@@ -1218,8 +1239,13 @@ class MMEDSanalysis(MMEDSbase):
 
             # -1 is the kill_stage (used when testing)
             if not analysis_method == 'test':
-                self.q.put(('analysis', self.get_user(), access_code, workflow_type,
-                            analysis_type, config_path, sequencing_runs, -1, runOnNode))
+                # Uploaded configs are copied to a new file each time, so identify them by their contents
+                config_id = config_path
+                if config_path and Path(config_path).is_file():
+                    config_id = sha1(Path(config_path).read_bytes()).hexdigest()
+                self.monitor.put(('analysis', self.get_user(), access_code, workflow_type,
+                                  analysis_type, config_path, sequencing_runs, -1, runOnNode),
+                                 key=self.work_key('analysis', access_code, analysis_method, config_id))
             page = self.load_webpage('home', title='Welcome to MMEDS',
                                      success='Analysis started you will receive an email shortly')
         except (err.InvalidConfigError, err.MissingUploadError,
@@ -1401,10 +1427,13 @@ class MMEDSquery(MMEDSbase):
                 # Check that the value provided is numeric
                 if kwargs['AliquotWeight'].replace('.', '').isnumeric():
                     doc = db.get_docs(access_code=AccessCode, owner=self.get_user()).first()
-                    self.monitor.get_db_lock().acquire()
-                    new_id = db.generate_aliquot_id(True, doc.study_name, SpecimenID, **kwargs)
-                    self.monitor.get_db_lock().release()
-                    success = f'New ID is {new_id} for Aliquot with weight {kwargs["AliquotWeight"]}'
+                    try:
+                        with self.monitor.db_lock():
+                            new_id = db.generate_aliquot_id(True, doc.study_name, SpecimenID, **kwargs)
+                    except err.WatcherUnavailableError as e:
+                        error = e.message
+                    else:
+                        success = f'New ID is {new_id} for Aliquot with weight {kwargs["AliquotWeight"]}'
                 else:
                     error = f'Weight {kwargs["AliquotWeight"]} is not a number'
 
@@ -1464,13 +1493,17 @@ class MMEDSquery(MMEDSbase):
 
         # Create the new ID and add it to the database
         success = ''
+        error = ''
         if kwargs.get('SampleToolVersion') is not None:
             with Database(testing=self.testing, owner=self.get_user()) as db:
                 doc = db.get_docs(access_code=AccessCode).first()
-                self.monitor.get_db_lock().acquire()
-                new_id = db.generate_sample_id(True, doc.study_name, AliquotID, **kwargs)
-                self.monitor.get_db_lock().release()
-            success = f'New ID is {new_id} for Sample with processor {kwargs["SampleProcessor"]}'
+                try:
+                    with self.monitor.db_lock():
+                        new_id = db.generate_sample_id(True, doc.study_name, AliquotID, **kwargs)
+                except err.WatcherUnavailableError as e:
+                    error = e.message
+                else:
+                    success = f'New ID is {new_id} for Sample with processor {kwargs["SampleProcessor"]}'
 
         # Build the table of Samples
         with Database(testing=self.testing) as db:
@@ -1487,6 +1520,7 @@ class MMEDSquery(MMEDSbase):
 
         page = self.load_webpage('query_generate_sample_id_page',
                                  success=success,
+                                 error=error,
                                  access_code=AccessCode,
                                  sample_table=sample_table,
                                  AliquotID=AliquotID)
@@ -1,24 +1,82 @@
-import pandas as pd
+import os
+import json
+from math import ceil
 from copy import deepcopy
 from pathlib import Path
-from mmeds.config import TOOLS_DIR
+from hashlib import sha256
+from mmeds import artifacts
 
 """
 This common.smk file, following snakemake conventions, contains all the python logic necessary for generating the snakemake rule DAG
 """
 
-metadata = pd.read_csv("tables/qiime_mapping_file.tsv", sep='\t', header=[0], skiprows=[1])
+def config_list(key):
+    """ Return the list in the config under KEY, empty lists are written to the config as 'none' """
+    value = config.get(key)
+    return value if isinstance(value, list) else []
+
+# The values of the mapping file columns the rules group samples by, written by Analysis.create_snakemake_file
+# so the mapping file isn't parsed by every snakemake process, e.g. each cluster job
+with open("tables/mapping_summary.json") as f:
+    mapping_summary = json.load(f)
+
+# The locations of MMEDS' tools and artifact cache are set in the Snakefile, so snakemake doesn't
+# import mmeds.config, which needs the whole server environment and connects to the databases
+TOOLS_DIR = Path(config["tools_dir"])
+ARTIFACT_CACHE_DIR = Path(config["artifact_cache_dir"])
+
+# Resource model. Rules scale their threads and memory with the size of their input, capped by
+# the cores each job may use. Both can be set for a rule in the analysis config, e.g.
+# resources:
+#   cores: 16
+#   dada2_denoise:
+#     threads: 4
+#     mem_mb: 16000
+RESOURCE_OVERRIDES = config.get("resources") or {}
+CORE_BUDGET = int(RESOURCE_OVERRIDES.get("cores") or workflow.cores or os.cpu_count())
+SAMPLE_COUNT = mapping_summary["samples"]
+
+SEQUENCING_RUNS = config_list("sequencing_runs")
+# Each run is processed concurrently, so when the jobs share the analysis' cores each run gets
+# an equal share. Jobs submitted to the cluster separately each have the full budget.
+RUN_CORE_BUDGET = CORE_BUDGET if config.get("cluster_jobs") else max(1, CORE_BUDGET // max(1, len(SEQUENCING_RUNS)))
+
+def samples(input):
+    """ Size jobs by the number of samples in the study """
+    return SAMPLE_COUNT
+
+def input_mb(input):
+    """ Size jobs by the total size of their inputs """
+    return input.size_mb
+
+def scaled_threads(rule, size, per_thread, most=None):
+    """
+    Return the threads function for RULE, giving a job one thread per PER_THREAD units of work,
+    as measured by SIZE(input), up to MOST threads and the core budget
+    """
+    def threads(wildcards, input):
+        if "threads" in RESOURCE_OVERRIDES.get(rule, {}):
+            return int(RESOURCE_OVERRIDES[rule]["threads"])
+        wanted = ceil(size(input) / per_thread)
+        return max(1, min(wanted, most or CORE_BUDGET, CORE_BUDGET))
+    return threads
+
+def scaled_memory(rule, base, per_thread=0, per_sample=0):
+    """ Return the mem_mb function for RULE, giving a job BASE MB plus PER_THREAD for each thread and PER_SAMPLE for each sample """
+    def mem_mb(wildcards, input, threads):
+        if "mem_mb" in RESOURCE_OVERRIDES.get(rule, {}):
+            return int(RESOURCE_OVERRIDES[rule]["mem_mb"])
+        return int(base + per_thread * threads + per_sample * SAMPLE_COUNT)
+    return mem_mb
 
 def lefse_splits(wildcards):
     """ Calculates all the pairwise splits that should be compared by LEfSe. Will not include groups with an insufficient number of comparisons """
     splits = []
     for lefse_class in config["classes"]:
         # 'classes' in this case refer to metadata columns, whereas categories refer to the possible values of those columns
-        categories = list(metadata[lefse_class].unique())
-
-        # Discard samples with a 'nan' for the selected class. This will only work while the input has been run through MMEDS already
-        categories = [c for c in categories if str(c) != "nan"]
-        value_counts = metadata[lefse_class].value_counts()
+        # Samples with a 'nan' for the selected class are left out of the summary
+        value_counts = mapping_summary["columns"][lefse_class]
+        categories = list(value_counts)
 
         subclasses = []
         if "subclasses" in config and config["subclasses"]:
@@ -82,5 +140,49 @@ def demux_single_option(wildcards):
         return "--p-no-golay-error-correction"
     return "--p-rev-comp-mapping-barcodes"
 
+def cached(command):
+    """
+    Wrap the shell COMMAND of a rule so its outputs are taken from the artifact cache when another
+    analysis has already run the rule with the same command, params, and inputs, and added to it otherwise
+    """
+    cache = f"python {artifacts.__file__} --cache-dir {ARTIFACT_CACHE_DIR}"
+    code = sha256(command.encode()).hexdigest()
+    return (
+        f"key=$({cache} restore --rule {{rule}} --code {code} "
+        f"--input {{input:q}} --output {{output:q}} -- {{params:q}}) || {{{{\n"
+        f"{command}\n"
+        f"{cache} store \"$key\" --output {{output:q}} || echo \"Outputs of {{rule}} were not cached\" >&2\n"
+        f"}}}}"
+    )
+
+def plan_run_merges(runs):
+    """
+    Plan a balanced tree of pairwise merges of the feature tables and representative sequences
+    of RUNS, so studies with many runs don't wait on a single merge of all of them. Each input is
+    a path with {} in place of 'table' or 'rep_seqs'. Returns the inputs of each intermediate
+    merge by name, and the inputs of the final merge, of which there are at most two.
+    """
+    merges = {}
+    level = [f"section_{run}/{{}}_dada2.qza" for run in runs]
+    depth = 0
+    while len(level) > 2:
+        depth += 1
+        merged = []
+        for i in range(0, len(level) - 1, 2):
+            name = f"L{depth}_{i // 2}"
+            merges[name] = level[i:i + 2]
+            merged.append(f"merged_runs/{name}/{{}}.qza")
+        # An odd one out is merged at the next level up
+        if len(level) % 2:
+            merged.append(level[-1])
+        level = merged
+    return merges, level
+
+RUN_MERGES, FINAL_RUN_MERGE = plan_run_merges(SEQUENCING_RUNS)
+
+def merge_inputs(kind, inputs):
+    """ Fill in the KIND of output, 'table' or 'rep_seqs', in the paths of a merge's INPUTS """
+    return [path.format(kind) for path in inputs]
+
 def get_tool_dir():
     return TOOLS_DIR
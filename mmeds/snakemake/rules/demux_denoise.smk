@@ -1,30 +1,40 @@
 rule demux_single_barcodes:
     """ Demultiplex a paired-end single-barcoded sequencing run with QIIME EMP"""
+    resources:
+        mem_mb = 8000,
+        runtime = 240
     input:
         seqs = "section_{sequencing_run}/qiime_import_artifact.qza",
         barcodes = "section_{sequencing_run}/qiime_mapping_file_{sequencing_run}.tsv"
     output:
         error_correction = "section_{sequencing_run}/error_correction.qza",
         demux_file = "section_{sequencing_run}/demux_file.qza"
+    benchmark:
+        "benchmarks/demux_single_barcodes.{sequencing_run}.tsv"
     conda:
         "qiime2-2020.8.0"
     params:
         option = demux_single_option
     shell:
-        "qiime demux emp-paired "
-        "--i-seqs {input.seqs} "
-        "--m-barcodes-file {input.barcodes} "
-        "--m-barcodes-column BarcodeSequence "
-        "{params.option} "
-        "--o-error-correction-details {output.error_correction} "
-        "--o-per-sample-sequences {output.demux_file}"
+        cached("qiime demux emp-paired "
+               "--i-seqs {input.seqs} "
+               "--m-barcodes-file {input.barcodes} "
+               "--m-barcodes-column BarcodeSequence "
+               "{params.option} "
+               "--o-error-correction-details {output.error_correction} "
+               "--o-per-sample-sequences {output.demux_file}")
 
 rule demux_dual_barcodes_pheniqs:
     """ Demultiplex a paired-end dual-barcoded sequencing run with Pheniqs """
+    resources:
+        mem_mb = 8000,
+        runtime = 240
     input:
         "section_{sequencing_run}/pheniqs_config.json"
     output:
         "section_{sequencing_run}/pheniqs_output"
+    benchmark:
+        "benchmarks/demux_dual_barcodes_pheniqs.{sequencing_run}.tsv"
     conda:
         "pheniqs"
     shell:
@@ -37,6 +47,8 @@ rule strip_error_barcodes:
         mapping_file = "section_{sequencing_run}/qiime_mapping_file_{sequencing_run}.tsv",
     output:
         dir = "section_{sequencing_run}/stripped_output"
+    benchmark:
+        "benchmarks/strip_error_barcodes.{sequencing_run}.tsv"
     conda:
         "mmeds"
     shell:
@@ -48,7 +60,10 @@ rule strip_error_barcodes:
 
 rule dada2_denoise:
     """ Denoise demultiplexed sequencing using QIIME and DADA2 with default params """
-    threads: 10
+    threads: scaled_threads("dada2_denoise", input_mb, 250, most=RUN_CORE_BUDGET)
+    resources:
+        mem_mb = scaled_memory("dada2_denoise", 4000, per_thread=2000),
+        runtime = 720
     input:
         "section_{sequencing_run}/demux_file.qza"
     output:
@@ -56,16 +71,18 @@ rule dada2_denoise:
         feature_table = "section_{sequencing_run}/table_dada2.qza",
         stats = "section_{sequencing_run}/stats_dada2.qza",
         stats_viz = "section_{sequencing_run}/stats_dada2_viz.qzv"
+    benchmark:
+        "benchmarks/dada2_denoise.{sequencing_run}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime dada2 denoise-paired "
-        "--i-demultiplexed-seqs {input} "
-        "--p-trim-left-f 0 --p-trim-left-r 0 --p-trunc-len-f 0 --p-trunc-len-r 0 "
-        "--o-representative-sequences {output.rep_seqs} "
-        "--o-table {output.feature_table} "
-        "--o-denoising-stats {output.stats} "
-        "--p-n-threads {threads}; "
-        "qiime metadata tabulate "
-        "--m-input-file {output.stats} "
-        "--o-visualization {output.stats_viz}"
+        cached("qiime dada2 denoise-paired "
+               "--i-demultiplexed-seqs {input} "
+               "--p-trim-left-f 0 --p-trim-left-r 0 --p-trunc-len-f 0 --p-trunc-len-r 0 "
+               "--o-representative-sequences {output.rep_seqs} "
+               "--o-table {output.feature_table} "
+               "--o-denoising-stats {output.stats} "
+               "--p-n-threads {threads}; "
+               "qiime metadata tabulate "
+               "--m-input-file {output.stats} "
+               "--o-visualization {output.stats_viz}")
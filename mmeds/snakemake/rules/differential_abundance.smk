@@ -6,6 +6,8 @@ rule differential_abundance_ancom_bc:
     output:
         diffs = "differential_abundance/{var}/ancom-bc_{table}_{var}_diffs.qza",
         barplot = "differential_abundance/{var}/ancom-bc_{table}_{var}_barplot.qzv"
+    benchmark:
+        "benchmarks/differential_abundance_ancom_bc.{var}.{table}.tsv"
     conda:
         "qiime2-2023.9"
     shell:
@@ -21,6 +23,8 @@ rule differential_abundance_lefse:
     output:
         lefse_input = "tables/{class}/lefse_input.{table}.{class}.{subclass}.lefse",
         lefse_results = "results/{class}/lefse_results.{table}.{class}.{subclass}.tsv"
+    benchmark:
+        "benchmarks/differential_abundance_lefse.{class}.{table}.{subclass}.tsv"
     conda:
         "lefse"
     shell:
@@ -36,6 +40,8 @@ rule differential_abundance_lefse_strict:
     output:
         lefse_input = "tables/{class}/lefse_input_strict.{table}.{class}.{subclass}.lefse",
         lefse_results = "results/{class}/lefse_results_strict.{table}.{class}.{subclass}.tsv"
+    benchmark:
+        "benchmarks/differential_abundance_lefse_strict.{class}.{table}.{subclass}.tsv"
     conda:
         "lefse"
     shell:
@@ -50,6 +56,8 @@ rule plot_lefse_results:
         "results/{class}/lefse_results.{table}.{class}.{subclass}.tsv"
     output:
         "results/{class}/lefse_plot.{table}.{class}.{subclass}.pdf"
+    benchmark:
+        "benchmarks/plot_lefse_results.{class}.{table}.{subclass}.tsv"
     params:
         tool_dir = get_tool_dir()
     shell:
@@ -64,6 +72,8 @@ rule plot_lefse_results_strict:
         "results/{class}/lefse_results_strict.{table}.{class}.{subclass}.tsv"
     output:
         "results/{class}/lefse_plot_strict.{table}.{class}.{subclass}.pdf"
+    benchmark:
+        "benchmarks/plot_lefse_results_strict.{class}.{table}.{subclass}.tsv"
     params:
         tool_dir = get_tool_dir()
     shell:
@@ -4,13 +4,18 @@ ruleorder: alpha_rarefaction_phylogenetic > alpha_rarefaction
 
 rule diversity_core_metrics_phylogenetic:
     """ Generate standard diversity metrics with q2-diversity, including phylogenetic metrics """
-    threads: 10
+    threads: scaled_threads("diversity_core_metrics_phylogenetic", samples, 50)
+    resources:
+        mem_mb = scaled_memory("diversity_core_metrics_phylogenetic", 4000, per_sample=10),
+        runtime = 120
     input:
         feature_table = "tables/asv_table.qza",
         rooted_tree = "tables/rooted_tree.qza",
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/core_metrics_results"
+    benchmark:
+        "benchmarks/diversity_core_metrics_phylogenetic.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -24,12 +29,17 @@ rule diversity_core_metrics_phylogenetic:
 
 rule diversity_core_metrics:
     """ Generate standard diversity metrics with q2-diversity, without phylogenetic metrics """
-    threads: 10
+    threads: scaled_threads("diversity_core_metrics", samples, 50)
+    resources:
+        mem_mb = scaled_memory("diversity_core_metrics", 4000, per_sample=10),
+        runtime = 120
     input:
         feature_table = "tables/asv_table.qza",
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/core_metrics_results"
+    benchmark:
+        "benchmarks/diversity_core_metrics.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -48,6 +58,8 @@ rule alpha_rarefaction_phylogenetic:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/alpha_rarefaction.qzv"
+    benchmark:
+        "benchmarks/alpha_rarefaction_phylogenetic.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -65,6 +77,8 @@ rule alpha_rarefaction:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/alpha_rarefaction.qzv"
+    benchmark:
+        "benchmarks/alpha_rarefaction.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -81,6 +95,8 @@ rule alpha_diversity_ANOVA_test:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/ANOVA/{metric}_group_ANOVA.qzv",
+    benchmark:
+        "benchmarks/alpha_diversity_ANOVA_test.{metric}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -90,12 +106,14 @@ rule alpha_diversity_ANOVA_test:
 
 rule beta_diversity_PERMANOVA_test:
     """ Perform standard PERMANOVA with q2-diversity against provided beta metric pairwise across specified category """
-    threads: 3
+    threads: scaled_threads("beta_diversity_PERMANOVA_test", samples, 200, most=3)
     input:
         div = "diversity/core_metrics_results",
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "diversity/PERMANOVA/{var}/{metric}_{var}_PERMANOVA.qzv",
+    benchmark:
+        "benchmarks/beta_diversity_PERMANOVA_test.{var}.{metric}.tsv"
     shell:
         """
         qiime diversity beta-group-significance --i-distance-matrix {input.div}/{wildcards.metric}_distance_matrix.qza --m-metadata-file {input.mapping_file} --m-metadata-column {wildcards.var} --p-pairwise --o-visualization {output}
@@ -4,6 +4,8 @@ rule extract_feature_table_tsv:
         "tables/{table}.qza"
     output:
         "tables/{table}.tsv"
+    benchmark:
+        "benchmarks/extract_feature_table_tsv.{table}.tsv"
     conda:
         "mmeds_test"
     shell:
@@ -19,6 +21,8 @@ rule format_metadata_qiime_to_lefse:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "tables/{class}/lefse_format.{table}.{class}.{subclass}.tsv"
+    benchmark:
+        "benchmarks/format_metadata_qiime_to_lefse.{class}.{table}.{subclass}.tsv"
     params:
         subclass = lefse_get_subclass
     conda:
@@ -1,21 +1,46 @@
+rule merge_run_pair:
+    """ Merge the results of two sequencing runs, or of two earlier merges, as one step of merging all of a study's runs """
+    input:
+        feature_tables = lambda wildcards: merge_inputs("table", RUN_MERGES[wildcards.merge]),
+        rep_seqs = lambda wildcards: merge_inputs("rep_seqs", RUN_MERGES[wildcards.merge])
+    output:
+        feature_table = "merged_runs/{merge}/table.qza",
+        rep_seqs_table = "merged_runs/{merge}/rep_seqs.qza"
+    wildcard_constraints:
+        merge = r"L\d+_\d+"
+    benchmark:
+        "benchmarks/merge_run_pair.{merge}.tsv"
+    conda:
+        "qiime2-2020.8.0"
+    shell:
+        cached("""
+        qiime feature-table merge --i-tables {input.feature_tables} --o-merged-table {output.feature_table}
+        qiime feature-table merge-seqs --i-data {input.rep_seqs} --o-merged-data {output.rep_seqs_table}
+        """)
+
 rule merge_sequencing_runs:
     """ Merge the results of all sequencing runs included in a study into a single table for downstream analysis """
     input:
-        feature_tables = expand("section_{sequencing_run}/table_dada2.qza", sequencing_run=config['sequencing_runs']),
-        rep_seqs = expand("section_{sequencing_run}/rep_seqs_dada2.qza", sequencing_run=config['sequencing_runs'])
+        feature_tables = merge_inputs("table", FINAL_RUN_MERGE),
+        rep_seqs = merge_inputs("rep_seqs", FINAL_RUN_MERGE)
     output:
         feature_table = "tables/asv_table_no_reads_threshold.qza",
         rep_seqs_table = "tables/rep_seqs_table.qza"
+    benchmark:
+        "benchmarks/merge_sequencing_runs.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        """
+        cached("""
         qiime feature-table merge --i-tables {input.feature_tables} --o-merged-table {output.feature_table}
         qiime feature-table merge-seqs --i-data {input.rep_seqs} --o-merged-data {output.rep_seqs_table}
-        """
+        """)
 
 rule import_single_barcodes:
     """ Import paired-end single-barcoded multiplexed fastq data from MMEDS sequencing_runs into QIIME2 format """
+    resources:
+        mem_mb = 4000,
+        runtime = 120
     input:
         import_dir = "section_{sequencing_run}/import_dir",
         forward_reads = "section_{sequencing_run}/import_dir/forward.fastq.gz",
@@ -23,28 +48,35 @@ rule import_single_barcodes:
         barcodes = "section_{sequencing_run}/import_dir/barcodes.fastq.gz"
     output:
         "section_{sequencing_run}/qiime_import_artifact.qza"
+    benchmark:
+        "benchmarks/import_single_barcodes.{sequencing_run}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime tools import "
-        "--type EMPPairedEndSequences "
-        "--input-path {input.import_dir} "
-        "--output-path {output}"
+        cached("qiime tools import "
+               "--type EMPPairedEndSequences "
+               "--input-path {input.import_dir} "
+               "--output-path {output}")
 
 rule import_pheniqs_sample_data:
     """ Import paired-end pheniqs-demultiplexed fastq data into QIIME2 format """
+    resources:
+        mem_mb = 4000,
+        runtime = 120
     input:
         dir = "section_{sequencing_run}/stripped_output",
     output:
         "section_{sequencing_run}/demux_file.qza"
+    benchmark:
+        "benchmarks/import_pheniqs_sample_data.{sequencing_run}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime tools import "
-        "--type SampleData[PairedEndSequencesWithQuality] "
-        "--input-format CasavaOneEightSingleLanePerSampleDirFmt "
-        "--input-path {input.dir} "
-        "--output-path {output}"
+        cached("qiime tools import "
+               "--type SampleData[PairedEndSequencesWithQuality] "
+               "--input-format CasavaOneEightSingleLanePerSampleDirFmt "
+               "--input-path {input.dir} "
+               "--output-path {output}")
 
 rule make_pheniqs_config:
     """ Create YAML file describing all barcodes and samples to Pheniqs """
@@ -57,6 +89,8 @@ rule make_pheniqs_config:
         mapping_file = "section_{sequencing_run}/qiime_mapping_file_{sequencing_run}.tsv"
     output:
         "section_{sequencing_run}/pheniqs_config.json",
+    benchmark:
+        "benchmarks/make_pheniqs_config.{sequencing_run}.tsv"
     conda:
         "mmeds"
     shell:
@@ -71,19 +105,24 @@ rule make_pheniqs_config:
 
 rule build_phylogenetic_tree:
     """ Perform all QIIME2 steps necessary for building and rooting the phylogenetic tree from DADA2 sequence data """
+    resources:
+        mem_mb = 16000,
+        runtime = 240
     input:
         feature_table = "tables/asv_table.qza",
         rep_seqs = "tables/rep_seqs_table.qza"
     output:
         feature_table_viz = "tables/asv_table_viz.qzv",
         rooted_tree = "tables/rooted_tree.qza"
+    benchmark:
+        "benchmarks/build_phylogenetic_tree.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        """
+        cached("""
         qiime feature-table summarize --i-table {input.feature_table} --o-visualization {output.feature_table_viz}
         qiime alignment mafft --i-sequences {input.rep_seqs} --o-alignment temp_files/alignment.qza
         qiime alignment mask --i-alignment temp_files/alignment.qza --o-masked-alignment temp_files/masked_alignment.qza
         qiime phylogeny fasttree --i-alignment temp_files/masked_alignment.qza --o-tree temp_files/unrooted_tree.qza
         qiime phylogeny midpoint-root --i-tree temp_files/unrooted_tree.qza --o-rooted-tree tables/rooted_tree.qza
-        """
+        """)
@@ -5,14 +5,18 @@ rule filter_table_by_threshold:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "tables/asv_table.qza"
+    benchmark:
+        "benchmarks/filter_table_by_threshold.tsv"
+    params:
+        min_frequency = config['sampling_depth']
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime feature-table filter-samples "
-        "--i-table {input.feature_table} "
-        "--m-metadata-file {input.mapping_file} "
-        "--p-min-frequency {config[sampling_depth]} "
-        "--o-filtered-table {output}"
+        cached("qiime feature-table filter-samples "
+               "--i-table {input.feature_table} "
+               "--m-metadata-file {input.mapping_file} "
+               "--p-min-frequency {params.min_frequency} "
+               "--o-filtered-table {output}")
 
 rule filter_table_to_two_classes:
     """ Filter a table to two specific classes in a metadata category for explicit comparison """
@@ -21,6 +25,8 @@ rule filter_table_to_two_classes:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "tables/{table}_{category}_{class1}_or_{class2}.qza"
+    benchmark:
+        "benchmarks/filter_table_to_two_classes.{table}.{category}.{class1}.{class2}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
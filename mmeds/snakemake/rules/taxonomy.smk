@@ -1,71 +1,88 @@
 # TODO: programmatically make classifiers one rule
 rule classify_taxonomy_greengenes:
     """ Classify sequences with GreenGenes """
-    threads: 10
+    threads: scaled_threads("classify_taxonomy_greengenes", samples, 25)
+    resources:
+        mem_mb = 32000,
+        runtime = 360
     input:
         classifier = "tables/gg-13-8-99-nb-2020-8-0.qza",
         rep_seqs = "tables/rep_seqs_table.qza"
     output:
         "tables/taxonomy.qza"
+    benchmark:
+        "benchmarks/classify_taxonomy_greengenes.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime feature-classifier classify-sklearn "
-        "--i-classifier {input.classifier} "
-        "--i-reads {input.rep_seqs} "
-        "--p-n-jobs {threads} "
-        "--o-classification {output}"
+        cached("qiime feature-classifier classify-sklearn "
+               "--i-classifier {input.classifier} "
+               "--i-reads {input.rep_seqs} "
+               "--p-n-jobs {threads} "
+               "--o-classification {output}")
 
 rule classify_taxonomy_greengenes2:
     """ Classify sequences with GreenGenes2 """
-    threads: 10
+    threads: scaled_threads("classify_taxonomy_greengenes2", samples, 25)
+    resources:
+        mem_mb = 48000,
+        runtime = 360
     input:
         classifier = "tables/greengenes2.2020-10.nb-classifier.qza",
         rep_seqs = "tables/rep_seqs_table.qza"
     output:
         "tables/taxonomy.qza"
+    benchmark:
+        "benchmarks/classify_taxonomy_greengenes2.tsv"
     conda:
         "qiime2-2023.9"
     shell:
-        "qiime feature-classifier classify-sklearn "
-        "--i-classifier {input.classifier} "
-        "--i-reads {input.rep_seqs} "
-        "--p-n-jobs {threads} "
-        "--o-classification {output}"
+        cached("qiime feature-classifier classify-sklearn "
+               "--i-classifier {input.classifier} "
+               "--i-reads {input.rep_seqs} "
+               "--p-n-jobs {threads} "
+               "--o-classification {output}")
 
 rule classify_taxonomy_silva:
     """ Classify sequences with SILVA """
-    threads: 10
+    threads: scaled_threads("classify_taxonomy_silva", samples, 25)
+    resources:
+        mem_mb = 64000,
+        runtime = 360
     input:
         classifier = "tables/silva-138-99-nb-classifier.qza",
         rep_seqs = "tables/rep_seqs_table.qza"
     output:
         "tables/taxonomy.qza"
+    benchmark:
+        "benchmarks/classify_taxonomy_silva.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime feature-classifier classify-sklearn "
-        "--i-classifier {input.classifier} "
-        "--i-reads {input.rep_seqs} "
-        "--p-n-jobs {threads} "
-        "--o-classification {output}"
+        cached("qiime feature-classifier classify-sklearn "
+               "--i-classifier {input.classifier} "
+               "--i-reads {input.rep_seqs} "
+               "--p-n-jobs {threads} "
+               "--o-classification {output}")
 
 rule classify_taxonomy_test:
     """ Dummy classification for automated testing """
-    threads: 10
+    threads: scaled_threads("classify_taxonomy_test", samples, 25)
     input:
         classifier = "tables/dummy_classifier.qza",
         rep_seqs = "tables/rep_seqs_table.qza"
     output:
         "tables/taxonomy.qza"
+    benchmark:
+        "benchmarks/classify_taxonomy_test.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
-        "qiime feature-classifier classify-sklearn "
-        "--i-classifier {input.classifier} "
-        "--i-reads {input.rep_seqs} "
-        "--p-n-jobs {threads} "
-        "--o-classification {output}"
+        cached("qiime feature-classifier classify-sklearn "
+               "--i-classifier {input.classifier} "
+               "--i-reads {input.rep_seqs} "
+               "--p-n-jobs {threads} "
+               "--o-classification {output}")
 
 rule taxonomy_collapse:
     """ Collapse table to a particular taxonomic level using q2-taxa """
@@ -74,6 +91,8 @@ rule taxonomy_collapse:
         taxonomy = "tables/taxonomy.qza"
     output:
         "tables/taxa_table_L{level}.qza"
+    benchmark:
+        "benchmarks/taxonomy_collapse.{level}.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -91,6 +110,8 @@ rule taxonomic_barplot:
         mapping_file = "tables/qiime_mapping_file.tsv"
     output:
         "tables/taxa_barplot.qzv"
+    benchmark:
+        "benchmarks/taxonomic_barplot.tsv"
     conda:
         "qiime2-2020.8.0"
     shell:
@@ -1,27 +1,38 @@
+import os
 import yaml
+import psutil
 
-from time import sleep
+from time import sleep, time
 from shutil import rmtree
 from pathlib import Path
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from multiprocessing import Queue, Pipe, Lock
-from multiprocessing.managers import BaseManager
+from multiprocessing import Lock, cpu_count
+from threading import Lock as ThreadLock
+from queue import SimpleQueue
 
 import mmeds.config as fig
-import mmeds.secrets as sec
 from mmeds.util import create_local_copy, load_config, send_email
 
 from mmeds.database.database import Database
-from mmeds.database.metadata_uploader import MetaDataUploader
-from mmeds.database.data_uploader import DataUploader
-from mmeds.database.metadata_adder import MetaDataAdder
-from mmeds.error import AnalysisError, MissingUploadError
+from mmeds.database.metadata_uploader import UploadCheckpoint
+from mmeds.error import AnalysisError, InvalidUploadError, WatcherUnavailableError, WatcherRequestError
 
 from mmeds.tools.analysis import Analysis
+from mmeds.scheduler import WorkScheduler, WorkJournal
+from mmeds.workers import UploadPool
+from mmeds.metrics import REGISTRY, Timer, serve_metrics
+from mmeds.ipc import IPCServer, IPCClient
 from mmeds.logging import Logger
 
 # The amount of steps with no jobs before the watcher will sleep
 TIMEOUT = 20
+# The kinds of work the watcher accepts
+MESSAGE_TYPES = {'analysis', 'restart', 'upload', 'upload-run', 'upload-ids', 'upload-resume', 'email',
+                 'count', 'connected', 'terminate'}
+# The stat counting the documents each type of process creates, counted once the process succeeds
+PROCESS_STATS = {'analysis': 'analysis_count', 'upload': 'study_count', 'upload-resume': 'study_count',
+                 'upload-run': 'sequencing_run_count'}
 
 
 def handle_modify_data(access_code, myData, user, data_type, testing):
@@ -37,53 +48,93 @@ def killall(processes):
         p.kill()
 
 
-class Watcher(BaseManager):
+class NodeResources:
+    """
+    Tracks the cores and memory reserved by the analyses running directly on the node,
+    so new analyses only start once there is room for them.
+    """
+    def __init__(self, cores=None, memory=None):
+        """
+        :cores: An int. The number of cores analyses may use, defaults to all of them.
+        :memory: An int. The MB of memory analyses may use, defaults to all of it.
+        """
+        self.cores = cores or cpu_count()
+        self.memory = memory or psutil.virtual_memory().total // 2 ** 20
+        self.reserved = {}
+
+    def estimate(self, workflow_type, sequencing_runs):
+        """
+        Estimate the cores and memory an analysis will need from its workflow type and the
+        size of the sequencing data it analyzes.
+        """
+        needs = fig.ANALYSIS_RESOURCES.get(workflow_type, fig.ANALYSIS_RESOURCES['default'])
+        data_size = sum(Path(path).stat().st_size for run in sequencing_runs.values()
+                        for path in run.values() if Path(path).exists())
+        memory = needs['memory'] + needs['memory_per_gb'] * data_size / 2 ** 30
+        # An analysis that needs more than the whole node is given the whole node
+        return min(needs['cores'], self.cores), min(int(memory), self.memory)
+
+    def fits(self, cores, memory):
+        """ Returns True if there are enough unreserved resources to start an analysis """
+        used_cores = sum(reserved[0] for reserved in self.reserved.values())
+        used_memory = sum(reserved[1] for reserved in self.reserved.values())
+        return used_cores + cores <= self.cores and used_memory + memory <= self.memory
 
-    def __init__(self, address=("", sec.WATCHER_PORT), authkey=sec.AUTH_KEY):
+    def reserve(self, access_code, cores, memory):
+        self.reserved[access_code] = (cores, memory)
+
+    def release(self, access_code):
+        self.reserved.pop(access_code, None)
+
+
+class Watcher:
+
+    def __init__(self):
         """
-        Initialize an instance of the Watcher class. It inherits from multiprocessing.Process
-        =====================================================================================
-        :queue: A multiprocessing.Queue object. When the Watcher process needs to start some other process
-            the necessary information will be added to this queue.
+        Initialize an instance of the Watcher class. Work is sent to it over its socket, see WatcherClient.
+        ===================================================================================================
         :testing: A boolean. If true run in testing configuration, otherwise run in deployment configuration.
         """
-        super().__init__(address, authkey)
         self.testing = fig.TESTING
         Logger.debug(f"WATCHER SELF.TESTING: {self.testing}")
         self.count = 0
         self.processes = []
         self.running_processes = []
+        # The most recent info on each running process, keyed by access code
+        self.process_info = {}
+        # The type and start time of each running process, keyed by access code
+        self.process_started = {}
+        self.written_processes = None
+        # Orders the work taken from the queue
+        self.scheduler = WorkScheduler()
+        self.written_metrics = None
+        # Persistent record of unfinished work, opened in run so it isn't shared with the manager process
+        self.journal = None
+        # Workers that uploads are run on, started in run
+        self.upload_pool = UploadPool(self.testing)
+        # Serves clients on the watcher's socket, started in run
+        self.ipc = None
+        # Work received on the socket waiting to be scheduled
+        self.inbox = SimpleQueue()
         self.started = []
-        self.running_on_node = set()
+        self.node = NodeResources(fig.NODE_ANALYSIS_CORES, fig.NODE_ANALYSIS_MEMORY)
+        # Analyses waiting for resources on the node along with what they need
+        self.waiting_analyses = []
         self.logger = Logger
         self.current_upload = None
         self.checked_stats = None
+        self.stats = None
         self.cleaned_temp = None
-
-        queue = Queue()
-        self.register('get_queue', callable=lambda: queue)
-        pipe_ends = Pipe()
-        self.pipe = pipe_ends[0]
-        self.register('get_pipe', callable=lambda: pipe_ends[1])
+        # When the watcher last completed a loop
+        self.last_tick = None
+        # Held while uploads are running, clients lease it over the socket
         self.db_lock = Lock()
-        self.register('get_db_lock', callable=lambda: self.db_lock)
 
     def start(self):
-        super().start()
-        self.set_queue()
         self.run()
 
-    def set_queue(self):
-        self.q = self.get_queue()
-
-    def print_queue(self):
-        print('My queue is {}'.format(self.q))
-        while True:
-            print(self.q.get())
-            sleep(1)
-
     def spawn_analysis(self, workflow_type, analysis_type, analysis_name, user, parent_code,
-                       config_file, testing, sequencing_runs, run_on_node, kill_stage=-1):
+                       config_file, testing, sequencing_runs, run_on_node, kill_stage=-1, threads=10):
         """ Start running the analysis in a new process """
         # Create access code for this analysis
         with Database('.', owner=user, testing=testing) as db:
@@ -93,8 +144,10 @@ class Watcher(BaseManager):
 
         # Switch statment will go here
         try:
-            tool = Analysis(self.q, user, access_code, parent_code, workflow_type, analysis_type, analysis_name,
-                            config, testing, sequencing_runs, run_on_node, kill_stage=kill_stage)
+            # Analyses send the emails they trigger back over the watcher's socket
+            tool = Analysis(get_watcher_client(), user, access_code, parent_code, workflow_type, analysis_type,
+                            analysis_name, config, testing, sequencing_runs, run_on_node, threads=threads,
+                            kill_stage=kill_stage)
         except KeyError:
             raise AnalysisError('Tool type did not match any')
         return tool
@@ -113,7 +166,7 @@ class Watcher(BaseManager):
                 rmtree(ad.path)
         # Create the appropriate tool
         try:
-            tool = Analysis(self.q, ad.owner, analysis_code, ad.study_code, ad.workflow_type,
+            tool = Analysis(get_watcher_client(), ad.owner, analysis_code, ad.study_code, ad.workflow_type,
                                        ad.analysis_type, ad.analysis_name, ad.config, testing, {}, run_on_node,
                                        analysis=run_analysis, restart_stage=restart_stage, kill_stage=kill_stage)
         except KeyError:
@@ -126,67 +179,99 @@ class Watcher(BaseManager):
         child = tool.create_sub_analysis(category, value)
         return child
 
-    def add_process(self, ptype, process_code):
+    def add_process(self, ptype, process_code, info=None):
         """ Add a process to the list of currently running processes. """
         self.running_processes.append(process_code)
+        self.process_started[process_code] = (ptype, time())
+        if info is not None:
+            self.process_info[process_code] = info
         self.write_running_processes()
 
     def check_processes(self):
         """
         Updates the list of currently running processes. It does this by checking
-        the mongo documents for he processes. Completed processes are removed from
-        current_processes and written to the completed process log
+        the mongo documents for the processes, all in one query. Completed processes
+        are removed from current_processes and written to the completed process log
         """
+        if not self.running_processes:
+            return
+
+        with Database(testing=self.testing) as db:
+            docs = {doc.access_code: doc for doc in db.get_doc_statuses(self.running_processes)}
+
         still_running = []
+        for process_code in self.running_processes:
+            process_doc = docs.get(process_code)
+            # If the document doesn't exist yet check again next time
+            if process_doc is None:
+                still_running.append(process_code)
+            # Record the processes that are still alive
+            elif process_doc.is_alive:
+                still_running.append(process_code)
+                self.process_info[process_code] = process_doc.get_info()
+            else:
+                self.processes.append(process_doc)
+                self.process_info.pop(process_code, None)
+                ptype, started = self.process_started.pop(process_code, (None, None))
+                if started is not None:
+                    REGISTRY.observe('mmeds_watcher_process_run_seconds', time() - started, type=ptype)
+                self.count_finished(ptype, process_doc.exit_code)
+                # Free up anything it had reserved on the node
+                self.node.release(process_code)
+                # The work that started it is complete
+                self.journal.finish(process_code)
+                # Send the exitcode of the process
+                self.notify(process_doc.exit_code)
+        self.running_processes = still_running
+
+    def resume_uploads(self):
+        """
+        Queue any study uploads that were interrupted before they finished, e.g. by the
+        watcher or server being restarted. These are the studies still marked alive that
+        have an upload checkpoint whose process is no longer running. Uploads that have already
+        been attempted UPLOAD_MAX_ATTEMPTS times are marked as failed instead.
+        """
         with Database(testing=self.testing) as db:
-            # For each type of process 'upload', 'analysis', 'etc'
-            # Check each process is still alive
-            while self.running_processes:
-                process_code = self.running_processes.pop()
-                process_doc = None
-                while process_doc is None:
-                    try:
-                        process_doc = db.get_doc(process_code, False)
-                    except MissingUploadError:
-                        sleep(1)
-                # Record the processes that are still alive
-                if process_doc.is_alive:
-                    still_running.append(process_code)
+            studies = db.get_all_studies().filter(is_alive=True)
+        for study in studies:
+            if study.path is None:
+                continue
+            checkpoint_file = Path(study.path) / fig.UPLOAD_CHECKPOINT_FILE
+            if checkpoint_file.exists():
+                checkpoint = UploadCheckpoint(checkpoint_file)
+                if checkpoint.state['pid'] is not None and psutil.pid_exists(checkpoint.state['pid']):
+                    continue
+                # Stop retrying uploads that keep failing, e.g. because of a problem with their metadata
+                if checkpoint.attempts >= fig.UPLOAD_MAX_ATTEMPTS:
+                    Logger.error('Upload of study {} failed after {} attempts'.format(study.access_code,
+                                                                                      checkpoint.attempts))
+                    study.update(is_alive=False, exit_code=1)
+                    checkpoint.clear()
                 else:
-                    self.processes.append(process_doc)
-                    # Send the exitcode of the process
-                    self.pipe.send(process_doc.exit_code)
-        for process in still_running:
-            self.running_processes.append(process)
+                    Logger.debug('Resuming upload of study {}'.format(study.access_code))
+                    self.inbox.put((('upload-resume', study.access_code), None))
 
     def check_upload(self):
         """ Check the status of the current upload. Release the lock if it's finished """
         # Check that there isn't another process currently uploading
-        if self.current_upload is None or not self.current_upload.is_alive():
+        if self.current_upload is not None and not self.current_upload.is_alive():
+            # Only release the lock when an upload took it, otherwise it may be leased to a client
             self.current_upload = None
-            try:
-                self.db_lock.release()
-            except ValueError:
-                pass
+            self.db_lock.release()
 
     def write_running_processes(self):
         """
-        Writes the currently running processes to the process log
+        Writes the currently running processes to the process log if they've changed since it was last written
         """
-        writeable = []
-        for process_code in self.running_processes:
-            try:
-                with Database(testing=self.testing) as db:
-                    doc = db.get_doc(process_code, False)
-                info = doc.get_info()
-                writeable.append(info)
-            # If the upload doesn't exist yet, just proceed
-            except MissingUploadError:
-                continue
-        with open(fig.CURRENT_PROCESSES, 'w+') as f:
-            yaml.dump(sorted(writeable, key=lambda x: x['created']), f)
-        with open(fig.CURRENT_PROCESSES, 'r') as f:
-            Logger.error(yaml.safe_load(f))
+        writeable = sorted(self.process_info.values(), key=lambda x: x['created'])
+        if writeable == self.written_processes:
+            return
+        # Write to a temporary file and swap it in so readers never see a partial file
+        temp = fig.CURRENT_PROCESSES.with_suffix('.tmp')
+        with open(temp, 'w') as f:
+            yaml.dump(writeable, f)
+        os.replace(temp, fig.CURRENT_PROCESSES)
+        self.written_processes = writeable
 
     def log_processes(self):
         """
@@ -237,26 +322,43 @@ class Watcher(BaseManager):
             self.cleaned_temp = datetime.utcnow()
 
     def update_stats(self):
-        """ Update the mmeds stats to their most recent values """
-
-        # Update when the watcher starts and every five minutes thereafter
-        if self.checked_stats is None or (datetime.utcnow() - self.checked_stats) > timedelta(minutes=5):
+        """
+        Recount the mmeds stats from the databases. Between recounts the stats are kept
+        current by count_stat as uploads and analyses succeed and users are created.
+        """
+        # Update when the watcher starts and periodically thereafter to catch changes made elsewhere
+        if self.checked_stats is None or \
+                (datetime.utcnow() - self.checked_stats).total_seconds() > fig.STATS_RECONCILE_SECONDS:
             # Get stats for MMEDs server
             with Database(testing=self.testing) as db:
-                args = {
-                    'study_count': len(db.get_all_studies()),
-                    'analysis_count': len(db.get_all_analyses()),
+                self.stats = {
+                    'study_count': db.get_all_studies().count(),
+                    'analysis_count': db.get_all_analyses().count(),
+                    'sequencing_run_count': db.get_all_sequencing_runs().count(),
                     'user_count': len(db.get_all_usernames()),
                     'query_count': 42,
                 }
-            # If there's already a file remove it
-            if fig.STAT_FILE.exists():
-                fig.STAT_FILE.unlink()
-            # Write the new stats
-            with open(fig.STAT_FILE, 'w') as f:
-                yaml.safe_dump(args, f)
+            self.write_stats()
             self.checked_stats = datetime.utcnow()
 
+    def count_stat(self, stat):
+        """ Increment one of the mmeds stats when a new document of that kind is created """
+        if self.stats is not None and stat in self.stats:
+            self.stats[stat] += 1
+            self.write_stats()
+
+    def count_finished(self, ptype, exit_code):
+        """ Count the document created by a process of PTYPE that finished with EXIT_CODE, if it succeeded """
+        if exit_code == 0 and ptype in PROCESS_STATS:
+            self.count_stat(PROCESS_STATS[ptype])
+
+    def write_stats(self):
+        """ Write the stats to STAT_FILE, swapping in the new file so the server never reads a partial one """
+        temp = fig.STAT_FILE.with_suffix('.tmp')
+        with open(temp, 'w') as f:
+            yaml.safe_dump(self.stats, f)
+        os.replace(temp, fig.STAT_FILE)
+
     def any_running(self, ptype):
         """ Returns true if there is a process running """
         return bool(self.running_processes['ptype'])
@@ -264,9 +366,10 @@ class Watcher(BaseManager):
     def get_processes(self):
         return self.running_processes, self.processes
 
-    def handle_analysis(self, process):
+    def handle_analysis(self, process, ticket=None):
         """
         :process: A n-tuple containing information on what process to spawn.
+        :ticket: The process's entry in the work journal.
         ====================================================================
         Handles the creation of analysis processes
         """
@@ -275,35 +378,56 @@ class Watcher(BaseManager):
 
         # If running directly on the server node
         if run_on_node:
-            # Inform the user if there are too many processes already running
-            if len(self.running_on_node) > 3:
-                self.pipe.send('Analysis Not Started')
+            needs = self.node.estimate(workflow_type, sequencing_runs)
+            # Wait if there isn't room, or analyses requested earlier are still waiting
+            if self.waiting_analyses or not self.node.fits(*needs):
+                self.waiting_analyses.append((process, needs, ticket))
+                self.notify('Analysis Queued')
                 with Database(testing=self.testing) as db:
                     toaddr = db.get_email(user)
-                send_email(toaddr, user, 'too_many_on_node', self.testing, analysis=workflow_type)
+                send_email(toaddr, user, 'analysis_queued', self.testing, analysis=workflow_type)
                 return
+            self.start_analysis(process, *needs, ticket=ticket)
+        else:
+            self.start_analysis(process, ticket=ticket)
+
+    def start_waiting_analyses(self):
+        """ Start the analyses waiting on the node, in the order requested, for as long as they fit """
+        while self.waiting_analyses and self.node.fits(*self.waiting_analyses[0][1]):
+            process, needs, ticket = self.waiting_analyses.pop(0)
+            self.start_analysis(process, *needs, ticket=ticket)
+
+    def start_analysis(self, process, cores=None, memory=None, ticket=None):
+        """
+        Spawn and start the analysis described by PROCESS. If CORES and MEMORY are
+        provided they're reserved on the node until the analysis finishes.
+        """
+        ptype, user, access_code, workflow_type, analysis_type, analysis_name, \
+            config, sequencing_runs, kill_stage, run_on_node = process
 
         self.logger.debug("spawn analysis")
-        # Otherwise continue
         p = self.spawn_analysis(workflow_type, analysis_type, analysis_name, user, access_code,
-                                config, self.testing, sequencing_runs, kill_stage, run_on_node)
+                                config, self.testing, sequencing_runs, kill_stage, run_on_node,
+                                threads=cores or fig.ANALYSIS_THREADS)
         # Start the analysis running
         p.start()
+        self.journal.start(ticket, p.access_code)
         self.logger.debug("analysis started")
         sleep(1)
         with Database(testing=self.testing, owner=user) as db:
             doc = db.get_doc(p.access_code)
 
-        # Store the access code
-        if run_on_node:
-            self.running_on_node.add(p.access_code)
-        self.pipe.send(doc.get_info())
+        # Hold the resources it needs on the node
+        if cores is not None:
+            self.node.reserve(p.access_code, cores, memory)
+        self.notify(doc.get_info())
         # Add it to the list of analysis processes
-        self.add_process(ptype, p.access_code)
+        self.add_process(ptype, p.access_code, doc.get_info())
 
-    def handle_upload(self, process):
+    def handle_upload(self, process, ticket=None):
         """
         :process: A n-tuple containing information on what process to spawn.
+        :ticket: The process's entry in the work journal.
         ====================================================================
         Handles the creation of uploader processes
         """
@@ -312,50 +436,77 @@ class Watcher(BaseManager):
 
         # If there is nothing uploading currently start the new upload process
         if self.current_upload is None:
-            # Check what type of upload this is
-
-            # Add metadata to existing study
-            if 'ids' in process[0]:
-                (ptype, owner, access_code, aliquot_table, id_type, generate_id) = process
-                p = MetaDataAdder(owner, access_code, aliquot_table, id_type, generate_id, self.testing)
-                self.db_lock.acquire()
-
-            # Add new sequencing run
-            elif 'run' in process[0]:
-                (ptype, sequencing_run_name, username, reads_type, barcodes_type,
-                 datafiles, public) = process
-
-                p = DataUploader(username, reads_type, barcodes_type, sequencing_run_name,
-                                 datafiles, public, self.testing)
-                self.db_lock.acquire()
-
-            # Add new study
-            else:
-                Logger.debug(f"length: {len(process)}")
-                (ptype, study_name, subject_metadata, subject_type, specimen_metadata,
-                 username, meta_study, temporary, public) = process
-                # Start a process to handle loading the data
-                p = MetaDataUploader(subject_metadata, subject_type, specimen_metadata, username, 'qiime',
-                                     study_name, meta_study, temporary, public, self.testing)
-                self.db_lock.acquire()
-            p.start()
-            self.add_process(ptype, p.access_code)
+            # The lock is released by check_upload once this upload finishes
+            self.db_lock.acquire()
+            try:
+                # Check what type of upload this is
+
+                # Continue an interrupted study upload
+                if 'resume' in process[0]:
+                    (ptype, access_code) = process
+                    with Database(testing=self.testing) as db:
+                        doc = db.get_doc(access_code, False)
+                    checkpoint = UploadCheckpoint(Path(doc.path) / fig.UPLOAD_CHECKPOINT_FILE)
+                    params = checkpoint.params
+                    p = self.upload_pool.submit('MetaDataUploader', Path(params['subject_metadata']),
+                                                params['subject_type'], Path(params['specimen_metadata']),
+                                                params['owner'], params['study_type'], params['study_name'],
+                                                params['meta_study'], params['temporary'], params['public'],
+                                                self.testing, access_code=access_code, resume=True)
+
+                # Add metadata to existing study
+                elif 'ids' in process[0]:
+                    (ptype, owner, access_code, aliquot_table, id_type, generate_id) = process
+                    p = self.upload_pool.submit('MetaDataAdder', owner, access_code, aliquot_table, id_type,
+                                                generate_id, self.testing)
+
+                # Add new sequencing run
+                elif 'run' in process[0]:
+                    (ptype, sequencing_run_name, username, reads_type, barcodes_type,
+                     datafiles, public) = process
+
+                    p = self.upload_pool.submit('DataUploader', username, reads_type, barcodes_type,
+                                                sequencing_run_name, datafiles, public, self.testing)
+
+                # Add new study
+                else:
+                    Logger.debug(f"length: {len(process)}")
+                    (ptype, study_name, subject_metadata, subject_type, specimen_metadata,
+                     username, meta_study, temporary, public) = process
+                    p = self.upload_pool.submit('MetaDataUploader', subject_metadata, subject_type, specimen_metadata,
+                                                username, 'qiime', study_name, meta_study, temporary, public,
+                                                self.testing)
+            except InvalidUploadError as e:
+                # Retrying won't help an upload that can't be created, so report it as failed
+                self.db_lock.release()
+                self.logger.error(e.message)
+                self.journal.ack(ticket)
+                self.notify(1)
+                return
+            except BaseException:
+                self.db_lock.release()
+                raise
+            self.current_upload = p
+            self.journal.start(ticket, p.access_code)
             with Database(testing=self.testing) as db:
                 doc = db.get_doc(p.access_code, False)
+            self.add_process(ptype, p.access_code, doc.get_info())
             Logger.debug(doc.get_info())
-            self.pipe.send(doc.get_info())
+            # Resumed uploads weren't requested by a client so no one is waiting on the pipe
+            if 'resume' not in ptype:
+                self.notify(doc.get_info())
             # Keep track of this new process
             self.started.append(p.access_code)
-            self.current_upload = p
             if self.testing:
                 p.join()
         else:
-            # If there is another upload return the process info to the queue
-            self.q.put(process)
+            # If there is another upload return the process info to the scheduler
+            self.scheduler.unget()
 
-    def handle_restart(self, process):
+    def handle_restart(self, process, ticket=None):
         """
         :process: A n-tuple containing information on what process to spawn.
+        :ticket: The process's entry in the work journal.
         ====================================================================
         Handles creating new processes to restart previous analyses.
         """
@@ -364,67 +515,329 @@ class Watcher(BaseManager):
                                   run_on_node, kill_stage=kill_stage, run_analysis=True)
         # Start the analysis running
         p.start()
+        self.journal.start(ticket, p.access_code)
         sleep(1)
         with Database(testing=self.testing, owner=user) as db:
             doc = db.get_doc(p.access_code)
-        self.pipe.send(doc.get_info())
+        self.notify(doc.get_info())
         # Add it to the list of analysis processes
-        self.add_process(ptype, p.access_code)
+        self.add_process(ptype, p.access_code, doc.get_info())
+
+    def notify(self, message):
+        """ Send MESSAGE to the clients subscribed to process status """
+        if self.ipc is not None:
+            self.ipc.publish('status', message)
+
+    def receive(self, process, key=None):
+        """
+        Accept PROCESS sent over the watcher's socket with the idempotency KEY of its sender, if any.
+        Called from the socket's thread.
+        """
+        ptype = process if isinstance(process, str) else process[0]
+        if ptype not in MESSAGE_TYPES:
+            raise WatcherRequestError('Unknown message type {}'.format(ptype))
+        self.inbox.put((process, key))
+
+    def received(self):
+        """ Yield the work sent to the watcher's socket, with its idempotency key """
+        while not self.inbox.empty():
+            yield self.inbox.get()
+
+    def schedule_queued(self):
+        """ Move everything sent to the watcher's socket into the scheduler """
+        for process, key in self.received():
+            # Record it before anything else so it isn't lost if the watcher stops
+            ticket = self.journal.add(process, key)
+            REGISTRY.inc('mmeds_watcher_messages_total', type=process if isinstance(process, str) else process[0])
+            if ticket is None:
+                self.logger.error('Skipping duplicate of unfinished work {}'.format(process))
+            else:
+                self.scheduler.put(process, ticket=ticket)
+
+    def recover_work(self):
+        """
+        Pick up the work left unfinished by the last watcher. Pending work is scheduled again.
+        Started work whose process finished is complete, work whose process is still running
+        is tracked again, and work whose process died is scheduled again. Study uploads are
+        the exception, those continue from their checkpoint through resume_uploads. Analyses whose
+        process died are marked as failed and restarted from the stage they reached.
+        """
+        for ticket, process, enqueued in self.journal.pending():
+            self.scheduler.put(process, enqueued, ticket)
+
+        started = self.journal.started()
+        if not started:
+            return
+        with Database(testing=self.testing) as db:
+            docs = {doc.access_code: doc for doc in db.get_doc_statuses([code for _, _, code in started])}
+        for ticket, process, access_code in started:
+            doc = docs.get(access_code)
+            if doc is not None and not doc.is_alive:
+                self.journal.ack(ticket)
+            elif doc is not None and (doc.pid is None or psutil.pid_exists(doc.pid)):
+                self.add_process(process[0], access_code, doc.get_info())
+            elif process[0] == 'upload':
+                self.journal.ack(ticket)
+            elif doc is not None and process[0] in ('analysis', 'restart'):
+                # Scheduling the analysis again would start a new one, leaving this one alive forever
+                self.journal.ack(ticket)
+                doc.update(is_alive=False, exit_code=1)
+                run_on_node = process[9] if process[0] == 'analysis' else process[3]
+                restart = ('restart', doc.owner, access_code, run_on_node, doc.restart_stage or 0, -1)
+                self.scheduler.put(restart, ticket=self.journal.add(restart))
+            else:
+                self.journal.requeue(ticket)
+                self.scheduler.put(process, ticket=ticket)
+
+    def write_queue_metrics(self):
+        """ Write the scheduler's queue depths and wait times if they've changed since last written """
+        metrics = self.scheduler.metrics()
+        if metrics == self.written_metrics:
+            return
+        temp = fig.QUEUE_METRICS.with_suffix('.tmp')
+        with open(temp, 'w') as f:
+            yaml.safe_dump(metrics, f)
+        os.replace(temp, fig.QUEUE_METRICS)
+        self.written_metrics = metrics
+
+    def update_metrics(self):
+        """ Update the gauges in the metrics registry from the watcher's current state """
+        depths = self.scheduler.depth_by_type()
+        # Types that have emptied out are reset rather than left at their last depth
+        for key in list(REGISTRY.values['mmeds_watcher_queue_depth']):
+            REGISTRY.set('mmeds_watcher_queue_depth', 0, **dict(key))
+        for ptype, depth in depths.items():
+            REGISTRY.set('mmeds_watcher_queue_depth', depth, type=ptype)
+        for lane, lane_metrics in self.scheduler.metrics().items():
+            REGISTRY.set('mmeds_watcher_queue_wait_mean_seconds', lane_metrics['mean_wait'], lane=lane)
+            REGISTRY.set('mmeds_watcher_queue_wait_max_seconds', lane_metrics['max_wait'], lane=lane)
+
+        types = [ptype for ptype, started in self.process_started.values()]
+        REGISTRY.set('mmeds_watcher_active_uploads', sum('upload' in ptype for ptype in types))
+        REGISTRY.set('mmeds_watcher_active_analyses', sum('upload' not in ptype for ptype in types))
+        REGISTRY.set('mmeds_watcher_waiting_analyses', len(self.waiting_analyses))
+        REGISTRY.set('mmeds_watcher_reserved_cores', sum(cores for cores, _ in self.node.reserved.values()))
+        REGISTRY.set('mmeds_watcher_last_tick_timestamp_seconds', self.last_tick or 0)
+
+    def health(self):
+        """
+        Returns whether the watcher is healthy along with the details it's based on. The watcher
+        is unhealthy if it hasn't completed a loop recently or no upload workers are running,
+        workers that exit are replaced every loop so that means they can't be started.
+        """
+        since_tick = None if self.last_tick is None else time() - self.last_tick
+        workers = sum(worker.is_alive() for worker in self.upload_pool.workers)
+        details = {
+            'seconds_since_tick': since_tick,
+            'upload_workers': workers,
+            'queued': len(self.scheduler),
+            'running': len(self.running_processes)
+        }
+        healthy = since_tick is not None and since_tick < fig.WATCHER_STALL_SECONDS and workers > 0
+        return healthy, details
 
     def run(self):
         """ The loop to run when a Watcher is started """
+        # Upload workers take a while to load everything they need, so start them first
+        self.upload_pool.start()
+        REGISTRY.health_check = self.health
+        serve_metrics(fig.WATCHER_METRICS_ADDRESS)
+        self.ipc = IPCServer(fig.WATCHER_SOCKET, {'put': self.receive}, {'db': self.db_lock}, fig.WATCHER_SOCKET_MODE)
+        self.ipc.start()
+        self.journal = WorkJournal(fig.WATCHER_JOURNAL)
+        self.recover_work()
+        # Pick up any uploads left unfinished by the last watcher
+        self.resume_uploads()
         # Continue until it's parent process is killed
         while True:
+            tick_start = time()
             self.update_stats()
             self.clean_temp_folders()
             self.check_processes()
+            self.start_waiting_analyses()
             self.check_upload()
+            # Replace upload workers that exited after a failed job or their last job
+            self.upload_pool.start()
             self.write_running_processes()
             self.log_processes()
             self.count += 1
-            # If there is nothing in the process queue, sleep
-            if self.q.empty():
+            self.schedule_queued()
+            # Uploads wait while another upload is running
+            ticket, process = self.scheduler.get(skip=('upload',) if self.current_upload is not None else ())
+            self.write_queue_metrics()
+            if process is not None:
+                process_type = process if isinstance(process, str) else process[0]
+                try:
+                    with Timer('mmeds_watcher_handle_seconds', type=process_type):
+                        self.handle_process(process, ticket)
+                except Exception:
+                    # Drop work that fails so it isn't retried every time the watcher restarts
+                    self.journal.ack(ticket)
+                    raise
+            self.last_tick = time()
+            REGISTRY.observe('mmeds_watcher_tick_seconds', self.last_tick - tick_start)
+            self.update_metrics()
+            # If there was nothing ready to handle, sleep
+            if process is None:
                 if self.count >= TIMEOUT:
                     self.count = 0
                 sleep(3)
-            else:
-                # Otherwise get the queued item
-                process = self.q.get()
-                self.logger.error("got something {}".format(process))
-                print("Got something {}".format(process))
-                self.logger.error('Got process requirements')
-                self.logger.error(process)
-                # Whenever it's acceptable to move to Python 3.10 this needs to be turned into a switch statement
-                # If the watcher needs to shut down
-                if process == 'terminate':
-                    self.logger.error('Terminating')
-                    # Kill all the processes currently running
-                    for process in self.processes:
-                        self.logger.error('Killing process {}'.format(process))
-                        while process.is_alive():
-                            process.kill()
-                    # Notify other processes the watcher is exiting
-                    self.pipe.send('Watcher exiting')
-                    # Send email notification of watcher termination to admin
-                    send_email(fig.CONTACT_EMAIL, 'admin', 'watcher_termination', self.testing)
-                    exit()
-                # If it's an analysis
-                elif process[0] == 'analysis':
-                    self.handle_analysis(process)
-                # If it's a restart of an analysis
-                elif process[0] == 'restart':
-                    self.handle_restart(process)
-                # If it's an upload
-                elif 'upload' in process[0]:
-                    Logger.error("Got an upload, processing")
-                    self.handle_upload(process)
-                elif process[0] == 'email':
-                    self.logger.error('Sending email')
-                    ptype, toaddr, user, message, kwargs = process
-                    # If the analysis that finished was running directly on the node remove it from the set
-                    if kwargs.get('access_code') in self.running_on_node:
-                        self.running_on_node.remove(kwargs.get('access_code'))
-
-                    send_email(toaddr, user, message, self.testing, **kwargs)
-                elif process[0] == 'connected':
-                    self.logger.error('Someone connected')
+
+    def handle_process(self, process, ticket):
+        """
+        :process: A n-tuple containing information on what process to spawn.
+        :ticket: The process's entry in the work journal.
+        ====================================================================
+        Hands the work item off to the appropriate handler.
+        """
+        self.logger.error("got something {}".format(process))
+        print("Got something {}".format(process))
+        self.logger.error('Got process requirements')
+        self.logger.error(process)
+        # Whenever it's acceptable to move to Python 3.10 this needs to be turned into a switch statement
+        # If the watcher needs to shut down
+        if process == 'terminate':
+            self.logger.error('Terminating')
+            self.journal.ack(ticket)
+            self.upload_pool.stop()
+            # Kill all the processes currently running
+            for process in self.processes:
+                self.logger.error('Killing process {}'.format(process))
+                while process.is_alive():
+                    process.kill()
+            # Notify other processes the watcher is exiting
+            self.notify('Watcher exiting')
+            # Send email notification of watcher termination to admin
+            send_email(fig.CONTACT_EMAIL, 'admin', 'watcher_termination', self.testing)
+            exit()
+        # If it's an analysis
+        elif process[0] == 'analysis':
+            self.handle_analysis(process, ticket)
+        # If it's a restart of an analysis
+        elif process[0] == 'restart':
+            self.handle_restart(process, ticket)
+        # If it's an upload
+        elif 'upload' in process[0]:
+            Logger.error("Got an upload, processing")
+            self.handle_upload(process, ticket)
+        elif process[0] == 'email':
+            self.logger.error('Sending email')
+            ptype, toaddr, user, message, kwargs = process
+            send_email(toaddr, user, message, self.testing, **kwargs)
+            self.journal.ack(ticket)
+        # If one of the stats needs counting, e.g. when a user is created
+        elif process[0] == 'count':
+            self.count_stat(process[1])
+            self.journal.ack(ticket)
+        elif process[0] == 'connected':
+            self.logger.error('Someone connected')
+            self.journal.ack(ticket)
+
+
+class WatcherClient:
+    """
+    A connection to the watcher shared by every thread in a process.
+    =================================================================
+    Calls from all threads are sent over a single connection to the watcher's socket, made
+    on the first call rather than at startup. If the watcher can't be reached calls fail
+    straight away, and the connection is only retried after a delay that doubles with each
+    failure, so an outage doesn't leave every thread waiting to reconnect. Each call has a timeout.
+    A client that's inherited by a forked process, e.g. by an analysis, makes its own connection.
+    """
+    def __init__(self, path=fig.WATCHER_SOCKET, timeout=fig.WATCHER_CALL_TIMEOUT,
+                 backoff=fig.WATCHER_RECONNECT_BACKOFF, lease=fig.WATCHER_LOCK_LEASE):
+        """
+        :path: The location of the watcher's socket.
+        :timeout: A number. The seconds to wait on each call by default.
+        :backoff: A pair of numbers. The initial and maximum seconds to wait before reconnecting.
+        :lease: A number. The seconds the database lock is held for before it's released automatically.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.min_backoff, self.max_backoff = backoff
+        self.backoff = self.min_backoff
+        self.lease = lease
+        self.retry_at = 0
+        self.client = None
+        self.lock = ThreadLock()
+        self.pid = os.getpid()
+
+    def connect(self):
+        """ Return the connection to the watcher, connecting if there isn't one """
+        if self.pid != os.getpid():
+            # The parent's connection belongs to the parent, closing it here would close it for the parent too
+            self.pid = os.getpid()
+            self.client = None
+            self.lock = ThreadLock()
+        with self.lock:
+            if self.client is not None and not self.client.closed:
+                return self.client
+            if time() < self.retry_at:
+                raise WatcherUnavailableError('Unable to reach the watcher, retrying in {:.0f}s'.format(
+                    self.retry_at - time()))
+            try:
+                self.client = IPCClient(self.path)
+            except OSError as e:
+                self.retry_at = time() + self.backoff
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                raise WatcherUnavailableError('Unable to reach the watcher: {}'.format(e))
+            self.backoff = self.min_backoff
+            Logger.debug('Connected to watcher')
+            return self.client
+
+    def call(self, method, *args, timeout=None):
+        """ Call METHOD of the connection, raising a WatcherUnavailableError if it doesn't complete within TIMEOUT """
+        return getattr(self.connect(), method)(*args, timeout=timeout or self.timeout)
+
+    def put(self, item, key=None, timeout=None):
+        """
+        Send ITEM to the watcher's queue. If KEY is given the item is ignored while
+        earlier work sent with the same key is unfinished, so it's safe to send again.
+        """
+        self.call('request', 'put', item, key, timeout=timeout)
+
+    def subscribe(self, topic='status', timeout=None):
+        """
+        Receive the messages the watcher publishes to TOPIC, by default the status of the processes it starts.
+        Returns the queue they'll be put in. Messages published while disconnected are missed.
+        """
+        return self.call('subscribe', topic, timeout=timeout)
+
+    def acquire_db_lock(self, timeout=None):
+        """
+        Acquire the lock the watcher holds while uploads are running. The lock is leased, so
+        it's released for this thread if it isn't released within the lease or the process dies.
+        """
+        deadline = time() + (timeout or self.timeout)
+        while not self.call('lease', 'db', self.lease):
+            if time() > deadline:
+                raise WatcherUnavailableError('Timed out waiting for the database lock')
+            sleep(0.1)
+
+    def release_db_lock(self):
+        """ Release the database lock. If the watcher can't be reached the lease is left to expire. """
+        try:
+            self.call('release', 'db')
+        except WatcherUnavailableError as e:
+            Logger.error('Unable to release the database lock: {}'.format(e.message))
+
+    @contextmanager
+    def db_lock(self, timeout=None):
+        """ Hold the database lock for the duration of the block """
+        self.acquire_db_lock(timeout)
+        try:
+            yield
+        finally:
+            self.release_db_lock()
+
+
+_watcher_clients = {}
+
+
+def get_watcher_client():
+    """ Return the WatcherClient for this process, creating it on first use """
+    # Forked processes need their own client as the connection can't be shared
+    client = _watcher_clients.get(os.getpid())
+    if client is None:
+        client = _watcher_clients.setdefault(os.getpid(), WatcherClient())
+    return client
@@ -0,0 +1,135 @@
+"""
+Records of the time and resources analyses use.
+===============================================
+Every snakemake rule writes a benchmark file with the wall clock time, peak memory, CPU time,
+and IO of each of its jobs. Analyses running locally also sample the CPU and memory use of
+their whole process tree. Both are stored in the analysis' MMEDSDoc so they can be compared
+across analyses, see scripts/benchmark_report.py.
+"""
+import csv
+import psutil
+from time import time
+from pathlib import Path
+from threading import Thread, Event
+from statistics import mean, median
+from collections import defaultdict
+
+# The columns of snakemake's benchmark files that are kept, with the names they're stored under
+BENCHMARK_COLUMNS = {
+    's': 'seconds',
+    'max_rss': 'max_rss_mb',
+    'max_vms': 'max_vms_mb',
+    'io_in': 'io_in_mb',
+    'io_out': 'io_out_mb',
+    'mean_load': 'mean_load',
+    'cpu_time': 'cpu_seconds'
+}
+
+
+def to_number(value):
+    """ Convert VALUE to a float, snakemake writes NA for measurements it couldn't take """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_benchmarks(directory):
+    """
+    Read the benchmark files snakemake wrote to DIRECTORY. Each is named after its rule and the
+    wildcards of the job, e.g. dada2_denoise.run1.tsv. Returns a record for each job.
+    """
+    records = []
+    for benchmark in sorted(Path(directory).glob('*.tsv')):
+        rule, _, wildcards = benchmark.stem.partition('.')
+        with open(benchmark, newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                record = {'rule': rule, 'wildcards': wildcards}
+                for column, key in BENCHMARK_COLUMNS.items():
+                    record[key] = to_number(row.get(column))
+                records.append(record)
+    return records
+
+
+def summarize_benchmarks(records):
+    """ Return the number of jobs and the typical and peak time and memory use of each rule in RECORDS """
+    by_rule = defaultdict(list)
+    for record in records:
+        by_rule[record['rule']].append(record)
+
+    summary = {}
+    for rule, jobs in sorted(by_rule.items()):
+        seconds = [job['seconds'] for job in jobs if job.get('seconds') is not None]
+        memory = [job['max_rss_mb'] for job in jobs if job.get('max_rss_mb') is not None]
+        cpu = [job['cpu_seconds'] for job in jobs if job.get('cpu_seconds') is not None]
+        summary[rule] = {
+            'jobs': len(jobs),
+            'median_seconds': median(seconds) if seconds else None,
+            'max_seconds': max(seconds) if seconds else None,
+            'max_rss_mb': max(memory) if memory else None,
+            'mean_cpu_seconds': mean(cpu) if cpu else None
+        }
+    return summary
+
+
+class ProcessTreeSampler:
+    """
+    Samples the CPU time and memory used by a process and all of its descendants from a
+    background thread. Once MAX_SAMPLES have been taken every other sample is dropped and
+    the interval doubled, so long analyses are covered at a lower resolution.
+    """
+    MAX_SAMPLES = 1000
+
+    def __init__(self, pid, interval):
+        """
+        :pid: The ID of the process at the root of the tree.
+        :interval: The seconds between samples.
+        """
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start = time()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        """ Return the current resource use of the process tree, or None if it has exited """
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return None
+        cpu, rss, count = 0, 0, 0
+        for process in processes:
+            try:
+                times = process.cpu_times()
+                cpu += times.user + times.system
+                rss += process.memory_info().rss
+                count += 1
+            except psutil.NoSuchProcess:
+                # Exited between listing the tree and measuring it
+                pass
+        return {
+            'seconds': round(time() - self.start, 1),
+            'cpu_seconds': round(cpu, 1),
+            'rss_mb': round(rss / 2 ** 20, 1),
+            'processes': count
+        }
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            sample = self.sample()
+            if sample is None:
+                break
+            self.samples.append(sample)
+            if len(self.samples) >= self.MAX_SAMPLES:
+                self.samples = self.samples[::2]
+                self.interval *= 2
@@ -10,7 +10,7 @@ import mmeds.secrets as sec
 import mmeds.error as err
 from mmeds.authentication import add_user, remove_user
 from mmeds.util import receive_email, send_email
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from mmeds.logging import Logger
 from mmeds.database.database import Database
 
@@ -20,11 +20,9 @@ from cherrypy.test import helper
 
 
 testing = True
-monitor = Watcher()
-monitor.connect()
+monitor = get_watcher_client()
 server = MMEDSserver()
-pipe = monitor.get_pipe()
-queue = monitor.get_queue()
+status = monitor.subscribe()
 
 
 def check_page(page):
@@ -261,12 +259,12 @@ class TestServer(helper.CPWebCase):
         # Send an email at the end to ensure there aren't issues with
         # accessing the correct email in future test runs
         send_email(fig.TEST_EMAIL, 'tester', 'error', testing=testing)
-        queue.put('terminate')
-        Logger.error('Waiting on pipe')
-        result = pipe.recv()
+        monitor.put('terminate')
+        Logger.error('Waiting on status')
+        result = status.get()
         while not result == 'Watcher exiting':
-            result = pipe.recv()
-        Logger.error('Got {} from pipe'.format(result))
+            result = status.get()
+        Logger.error('Got {} from status'.format(result))
         self.assertEqual(result, 'Watcher exiting')
 
     ####################
@@ -10,7 +10,7 @@ import mmeds.secrets as sec
 import mmeds.error as err
 from mmeds.authentication import add_user, remove_user
 from mmeds.util import receive_email, send_email
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from mmeds.logging import Logger
 
 import cherrypy as cp
@@ -25,11 +25,8 @@ Logged output of this test can be found in /mmeds_server_data/MMEDS_log.txt
 """
 
 testing = True
-monitor = Watcher()
-monitor.connect()
+monitor = get_watcher_client()
 server = MMEDSserver()
-pipe = monitor.get_pipe()
-queue = monitor.get_queue()
 
 
 def check_page(page):
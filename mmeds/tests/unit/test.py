@@ -13,7 +13,8 @@ import mmeds.secrets as sec
 """
 - To run all the tests: python test.py
 - To run a specific set of test: python test.py test_name1 test_name2 etc
-  - possible test names: authentication, database, documents, spawn, snakemake, tools, util, validate
+  - possible test names: authentication, database, artifacts, documents, ipc, lsf, metrics, scheduler, telemetry,
+    spawn, snakemake, tools, util, validate
 - To run all tests with the pudb pytest plugin python test.py pudb
 """
 
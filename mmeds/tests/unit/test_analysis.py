@@ -4,7 +4,7 @@ import mmeds.config as fig
 from time import sleep
 
 from mmeds.util import run_analysis, load_config, upload_sequencing_run_local
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from mmeds.logging import Logger
 from mmeds.tools.analysis import Analysis
 from mmeds.database.database import Database
@@ -19,9 +19,7 @@ class AnalysisTests(TestCase):
         # path to an example study, created from a MMEDs upload of existing test files
         # definied in config.py
         self.test_study = fig.TEST_STUDY
-        self.watcher = Watcher()
-        self.watcher.connect()
-        self.queue = self.watcher.get_queue()
+        self.queue = get_watcher_client()
         self.config = load_config(fig.DEFAULT_CONFIG, fig.TEST_MIXED_METADATA, 'core_pipeline_taxonomic')
         self.config_lefse = load_config(fig.DEFAULT_CONFIG_LEFSE, fig.TEST_MIXED_METADATA, 'lefse')
         self.analysis = []
@@ -108,3 +106,10 @@ class AnalysisTests(TestCase):
         analysis.update_doc(study_name='Test_Update')
         self.assertEqual(analysis.doc.study_name, 'Test_Update')
 
+    def test_i_failed_restart_stage(self):
+        """ Test an analysis that didn't finish keeps the stage to restart it from """
+        analysis = self.analysis[0]
+        analysis.get_file('errorlog', True).write_text('MMEDS_STAGE_1\n')
+        analysis.post_analysis()
+        self.assertGreaterEqual(analysis.doc.restart_stage, 1)
+        self.assertEqual(analysis.doc.exit_code, 1)
@@ -0,0 +1,128 @@
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from shutil import which
+from subprocess import run, PIPE, DEVNULL
+from base64 import urlsafe_b64encode
+import json
+import sys
+import os
+
+import mmeds.artifacts as artifacts
+from mmeds.artifacts import ArtifactCache, ReferenceStore, OutputLedger
+
+
+class ArtifactsTests(TestCase):
+    """ Tests of the artifact cache shared by analyses """
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+        self.cache = ArtifactCache(self.path / 'cache')
+        self.input = self.path / 'demux_file.qza'
+        self.input.write_text('sequences')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_a_key(self):
+        """ Test keys change with the rule's inputs and params """
+        key = self.cache.key('dada2_denoise', 'code', [], [self.input])
+        self.assertEqual(key, self.cache.key('dada2_denoise', 'code', [], [self.input]))
+        self.assertNotEqual(key, self.cache.key('dada2_denoise', 'code', ['10'], [self.input]))
+        self.input.write_text('other sequences')
+        self.assertNotEqual(key, self.cache.key('dada2_denoise', 'code', [], [self.input]))
+
+    def test_b_restore(self):
+        """ Test stored outputs are restored for another analysis """
+        key = self.cache.key('dada2_denoise', 'code', [], [self.input])
+        first = [self.path / 'first' / 'table_dada2.qza', self.path / 'first' / 'rep_seqs_dada2.qza']
+        second = [self.path / 'second' / 'table_dada2.qza', self.path / 'second' / 'rep_seqs_dada2.qza']
+        self.assertFalse(self.cache.restore(key, second))
+
+        for output in first:
+            output.parent.mkdir(exist_ok=True)
+            output.write_text(output.name)
+        self.assertTrue(self.cache.store(key, first))
+        self.assertTrue(self.cache.restore(key, second))
+        self.assertEqual([output.read_text() for output in second], ['table_dada2.qza', 'rep_seqs_dada2.qza'])
+
+    def test_c_reference_store(self):
+        """ Test reference databases are stored once and versioned when they change """
+        store = ReferenceStore(self.path / 'store')
+        source = self.path / 'classifier.qza'
+        source.write_text('classifier')
+
+        stored = store.get('silva', source)
+        self.assertEqual(store.get('silva', source), stored)
+        self.assertEqual(len(store.versions('silva')), 1)
+
+        link = self.path / 'analysis' / 'classifier.qza'
+        link.parent.mkdir()
+        store.link(stored, link)
+        self.assertEqual(link.read_text(), 'classifier')
+
+        source.write_text('new classifier')
+        self.assertNotEqual(store.get('silva', source), stored)
+        self.assertEqual(len(store.versions('silva')), 2)
+
+    def test_d_output_ledger(self):
+        """ Test completed outputs are recorded and those modified afterwards are removed on restart """
+        metadata = self.path / '.snakemake' / 'metadata'
+        metadata.mkdir(parents=True)
+        outputs = {'tables/asv_table.qza': False, 'tables/taxonomy.qza': False, 'tables/taxa_barplot.qzv': True}
+        for path, incomplete in outputs.items():
+            (self.path / path).parent.mkdir(exist_ok=True)
+            (self.path / path).write_text(path)
+            record = metadata / urlsafe_b64encode(path.encode()).decode()
+            record.write_text(json.dumps({'rule': 'rule', 'incomplete': incomplete}))
+
+        ledger = OutputLedger(self.path)
+        self.assertEqual(sorted(ledger.record()), ['tables/asv_table.qza', 'tables/taxonomy.qza'])
+        self.assertEqual(ledger.verify(), [])
+
+        (self.path / 'tables/taxonomy.qza').write_text('modified')
+        self.assertEqual(ledger.verify(), ['tables/taxonomy.qza'])
+        self.assertFalse((self.path / 'tables/taxonomy.qza').exists())
+        self.assertTrue((self.path / 'tables/asv_table.qza').exists())
+        self.assertEqual(list(ledger.load()), ['tables/asv_table.qza'])
+
+    def test_e_command_line(self):
+        """ Test the script cached rules run, with the oldest python their conda environments use if it's installed """
+        python = which('python3.6')
+        if python is None or run([python, '--version'], stdout=DEVNULL, stderr=DEVNULL).returncode:
+            python = sys.executable
+        cache = [python, artifacts.__file__, '--cache-dir', str(self.path / 'cache')]
+        output = self.path / 'table_dada2.qza'
+        restore = cache + ['restore', '--rule', 'dada2_denoise', '--code', 'code', '--input', str(self.input),
+                           '--output', str(output), '--', '--p-trunc-len-f', '0']
+
+        missed = run(restore, stdout=PIPE, universal_newlines=True)
+        self.assertEqual(missed.returncode, 1)
+        key = missed.stdout.strip()
+        output.write_text('table')
+        self.assertEqual(run(cache + ['store', key, '--output', str(output)]).returncode, 0)
+
+        output.unlink()
+        self.assertEqual(run(restore).returncode, 0)
+        self.assertEqual(output.read_text(), 'table')
+
+    def test_f_shared_files(self):
+        """ Test restoring doesn't modify the stored outputs and that hashes are shared by hard links """
+        key = self.cache.key('dada2_denoise', 'code', [], [self.input])
+        stored = self.path / 'first' / 'table_dada2.qza'
+        stored.parent.mkdir()
+        stored.write_text('table')
+        self.cache.store(key, [stored])
+        mtime = stored.stat().st_mtime_ns
+
+        restored = self.path / 'second' / 'table_dada2.qza'
+        self.assertTrue(self.cache.restore(key, [restored]))
+        self.assertEqual(stored.stat().st_mtime_ns, mtime)
+        self.assertNotEqual(restored.stat().st_ino, stored.stat().st_ino)
+
+        link = self.path / 'linked_input.qza'
+        os.link(self.input, link)
+        self.cache.hash_file(self.input)
+        self.assertTrue(self.cache.memo(link.stat()).exists())
+        self.assertNotEqual(key, self.cache.key('dada2_denoise', 'code', [], [self.input], environment='upgraded'))
@@ -1,5 +1,6 @@
 from prettytable import PrettyTable, ALL
 from unittest import TestCase
+from types import SimpleNamespace
 import datetime
 import pymysql as pms
 import pandas as pd
@@ -7,6 +8,7 @@ import pandas as pd
 import mmeds.secrets as sec
 import mmeds.config as fig
 from mmeds.database.database import Database
+from mmeds.database.documents import ArtifactDoc
 from mmeds.database.sql_builder import SQLBuilder
 from mmeds.util import parse_ICD_codes, load_metadata
 from mmeds.logging import Logger
@@ -236,4 +238,24 @@ class DatabaseTests(TestCase):
             result = db.create_ids_file('Test_Single', 'aliquot')
         print(result)
 
+    def test_i_artifacts(self):
+        """ Test recording the artifacts of an analysis and finding them for later analyses """
+        analysis = SimpleNamespace(access_code='test_artifacts_analysis', study_code='test_artifacts_study',
+                                   owner=fig.TEST_USER, workflow_type='core_pipeline_taxonomic',
+                                   config={'taxonomic_database': 'silva'})
+        with Database(fig.TEST_DIR, user=user, owner=fig.TEST_USER, testing=testing) as db:
+            db.add_artifacts(analysis, [('/analysis/tables/asv_table.qza', 'FeatureTable[Frequency]'),
+                                        ('/analysis/tables/rep_seqs.qza', 'FeatureData[Sequence]')])
+            # Running the analysis again replaces its records
+            db.add_artifacts(analysis, [('/analysis/tables/asv_table.qza', 'FeatureTable[Frequency]'),
+                                        ('/analysis/tables/taxonomy.qza', 'FeatureData[Taxonomy]')])
 
+            artifacts = db.get_artifacts('test_artifacts_study')
+            self.assertEqual(sorted(artifact.kind for artifact in artifacts), ['asv_table', 'taxonomy'])
+            table = db.get_artifacts('test_artifacts_study', kind='asv_table').first()
+            self.assertEqual(table.path, '/analysis/tables/asv_table.qza')
+            self.assertEqual(table.params, {'taxonomic_database': 'silva'})
+            taxonomy = db.get_artifacts('test_artifacts_study', artifact_type='FeatureData[Taxonomy]')
+            self.assertEqual([artifact.kind for artifact in taxonomy], ['taxonomy'])
+            self.assertEqual(db.get_artifacts('test_artifacts_study', kind='rep_seqs').count(), 0)
+        ArtifactDoc.objects(analysis_code='test_artifacts_analysis').delete()
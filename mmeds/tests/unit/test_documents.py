@@ -1,4 +1,5 @@
 from unittest import TestCase, skip
+from tempfile import TemporaryDirectory
 from pathlib import Path
 import mongoengine as men
 
@@ -28,6 +29,18 @@ class DocumentsTests(TestCase):
         self.create_from_study()
         # self.create_from_analysis()
 
+    def test_file_index(self):
+        """ Test the file index is read again when it's been written by something else """
+        with TemporaryDirectory() as temp_dir:
+            index = Path(temp_dir) / 'file_index.tsv'
+            docs.write_file_index(index, 'header\n', {'mapping': 'mapping.tsv'})
+            # Rewritten elsewhere, e.g. by Analysis.write_file_locations
+            index.write_text('header\nKey\tPath\nmapping\tmapping.tsv\nsnakefile\tSnakefile\n')
+            docs.write_file_index(index, 'header\n', {'mapping': 'mapping.tsv', 'snakefile': 'Snakefile',
+                                                      'jobfile': 'jobfile.lsf'})
+            self.assertEqual(index.read_text().split('\n')[2:-1],
+                             ['mapping\tmapping.tsv', 'snakefile\tSnakefile', 'jobfile\tjobfile.lsf'])
+
     def create_from_study(self):
         """ Test creating a document """
         config = util.load_config(None, fig.TEST_METADATA, 'core_pipeline_taxonomic')
@@ -37,6 +50,12 @@ class DocumentsTests(TestCase):
         self.assertEqual(sd.owner, ad.owner)
         self.assertEqual(sd.access_code, ad.study_code)
 
+        # A colliding access code doesn't leave an analysis directory behind
+        analyses = sorted(Path(sd.path).iterdir())
+        with self.assertRaises(men.NotUniqueError):
+            sd.generate_MMEDSDoc('testDocument', 'qiime2', 'DADA2', config, 'test_documents')
+        self.assertEqual(sorted(Path(sd.path).iterdir()), analyses)
+
     def create_from_analysis(self):
         ad = docs.MMEDSDoc.objects(access_code='test_documents').first()
         ad2 = ad.generate_sub_analysis_doc(('Subject', 'Nationality'), 'American', 'child_code')
@@ -0,0 +1,136 @@
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from threading import Lock
+from pathlib import Path
+from time import sleep
+import os
+
+from mmeds.ipc import IPCServer, IPCClient
+from mmeds.spawn import WatcherClient, get_watcher_client
+from mmeds.error import WatcherRequestError, WatcherUnavailableError
+
+
+class IPCTests(TestCase):
+    """ Tests of the watcher's socket """
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / 'test.sock'
+        self.received = []
+        self.lock = Lock()
+        self.server = IPCServer(self.path, {'put': self.received.append}, {'db': self.lock})
+        self.server.start()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_a_request(self):
+        """ Test requests are handled and answered """
+        client = IPCClient(self.path)
+        item = ('upload-run', 'run_name', 'user_a', 'single_end', 'single_barcodes', {}, False)
+        self.assertIsNone(client.request('put', item, timeout=5))
+        self.assertEqual(self.received, [item])
+        with self.assertRaises(WatcherRequestError):
+            client.request('missing', timeout=5)
+
+    def test_b_publish(self):
+        """ Test subscribers receive published messages """
+        client = IPCClient(self.path)
+        status = client.subscribe('status')
+        self.server.publish('status', 'Analysis Queued')
+        self.assertEqual(status.get(timeout=5), 'Analysis Queued')
+
+    def test_c_lease(self):
+        """ Test leases are exclusive and released when their holder disconnects """
+        first = IPCClient(self.path)
+        second = IPCClient(self.path)
+        self.assertTrue(first.lease('db', 60, timeout=5))
+        self.assertFalse(second.lease('db', 60, timeout=5))
+
+        first.close()
+        # Give the server a moment to notice the disconnect
+        sleep(0.5)
+        self.assertTrue(second.lease('db', 60, timeout=5))
+        self.assertTrue(second.release('db', timeout=5))
+        self.assertFalse(self.lock.locked())
+
+    def test_d_expire(self):
+        """ Test leases that aren't renewed expire """
+        first = IPCClient(self.path)
+        second = IPCClient(self.path)
+        self.assertTrue(first.lease('db', 0.1, timeout=5))
+        sleep(1.5)
+        self.assertTrue(second.lease('db', 60, timeout=5))
+
+    def test_e_released_lease(self):
+        """ Test the server keeps running when a leased lock is released by something else """
+        first = IPCClient(self.path)
+        self.assertTrue(first.lease('db', 0.1, timeout=5))
+        self.lock.release()
+        sleep(1.5)
+        self.assertTrue(first.lease('db', 60, timeout=5))
+        self.assertTrue(first.release('db', timeout=5))
+        self.assertFalse(self.lock.locked())
+
+    def test_f_mode(self):
+        """ Test the socket is only accessible to its owner unless another mode is given """
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        shared = Path(self.temp_dir.name) / 'shared.sock'
+        IPCServer(shared, {}, {}, 0o660).start()
+        self.assertEqual(os.stat(shared).st_mode & 0o777, 0o660)
+
+    def watcher_client(self, backoff=(1, 60)):
+        """ Return a WatcherClient for a server at a new location that records the items put on it """
+        path = Path(self.temp_dir.name) / 'watcher.sock'
+        server = IPCServer(path, {'put': lambda item, key: self.received.append((item, key))}, {'db': Lock()})
+        return server, WatcherClient(path, timeout=5, backoff=backoff, lease=60)
+
+    def test_g_watcher_client(self):
+        """ Test items are put with their keys and the database lock is released when its block fails """
+        server, client = self.watcher_client()
+        server.start()
+        client.put('connected', key='user/connected')
+        self.assertEqual(self.received, [('connected', 'user/connected')])
+
+        other = WatcherClient(client.path, timeout=5)
+        with self.assertRaises(ValueError):
+            with client.db_lock():
+                # Held until the block exits
+                with self.assertRaises(WatcherUnavailableError):
+                    other.acquire_db_lock(timeout=0.5)
+                raise ValueError('Unable to generate ID')
+        with other.db_lock(timeout=0.5):
+            pass
+
+    def test_h_reconnect(self):
+        """ Test the watcher isn't contacted again until the backoff has passed and the backoff doubles """
+        server, client = self.watcher_client(backoff=(0.5, 1))
+        with self.assertRaises(WatcherUnavailableError):
+            client.put('connected')
+        self.assertEqual(client.backoff, 1)
+        server.start()
+        with self.assertRaisesRegex(WatcherUnavailableError, 'retrying'):
+            client.put('connected')
+        sleep(0.6)
+        client.put('connected')
+        self.assertEqual(self.received, [('connected', None)])
+        self.assertEqual(client.backoff, 0.5)
+
+    def test_i_fork(self):
+        """ Test forked processes make their own connection rather than using their parent's """
+        server, client = self.watcher_client()
+        server.start()
+        client.put('connected')
+        shared = get_watcher_client()
+        self.assertIs(get_watcher_client(), shared)
+        pid = os.fork()
+        if pid == 0:
+            # Report failures through the exit code, the child mustn't return to the test runner
+            try:
+                client.put('child')
+                os._exit(0 if get_watcher_client() is not shared else 1)
+            except BaseException:
+                os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        client.put('parent')
+        self.assertEqual([item for item, key in self.received], ['connected', 'child', 'parent'])
@@ -0,0 +1,78 @@
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from argparse import Namespace
+from pathlib import Path
+from io import StringIO
+from contextlib import redirect_stdout
+from time import sleep
+import os
+
+from mmeds.tools import lsf_submit, lsf_status
+
+
+class LSFTests(TestCase):
+    """ Tests of the scripts snakemake uses to submit, check on, and cancel cluster jobs """
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+        self.log_dir = self.path / 'cluster_logs'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def submit(self, script):
+        """ Run SCRIPT as a local job through lsf_submit.py and return its ID """
+        jobscript = self.path / 'jobscript.sh'
+        jobscript.write_text(script)
+        output = StringIO()
+        with redirect_stdout(output):
+            lsf_submit.main(['--local', '--queue', 'premium', '--project', 'acc_MMEDS', '--name', 'user-analysis',
+                             '--log-dir', str(self.log_dir), '--rule', 'dada2_denoise', '--threads', '2',
+                             '--mem-mb', '1000', '--runtime', '60', str(jobscript)])
+        return output.getvalue().strip()
+
+    def status(self, job_id):
+        return lsf_status.status(Namespace(job_ids=[job_id], log_dir=str(self.log_dir)))
+
+    def wait(self, job_id):
+        """ Wait for the job with JOB_ID to finish and return its status """
+        for i in range(50):
+            # Reap the job, unlike lsf_submit.py the tests are still running when it exits
+            try:
+                os.waitpid(int(job_id.split('-')[1]), os.WNOHANG)
+            except ChildProcessError:
+                pass
+            status = self.status(job_id)
+            if status != 'running':
+                return status
+            sleep(0.1)
+        return status
+
+    def test_a_bsub_command(self):
+        """ Test jobs reserve memory per core and write their logs by rule """
+        args = Namespace(queue='premium', project='acc_MMEDS', name='user-analysis', log_dir='cluster_logs',
+                         rule='dada2_denoise', threads=4, mem_mb=10000, runtime=120, jobscript='jobscript.sh')
+        command = lsf_submit.bsub_command(args)
+        self.assertEqual(command[:3], ['bsub', '-q', 'premium'])
+        self.assertIn('rusage[mem=2500] span[hosts=1]', command)
+        self.assertEqual(command[command.index('-J') + 1], 'user-analysis.dada2_denoise')
+        self.assertEqual(command[command.index('-W') + 1], '120')
+        self.assertEqual(command[command.index('-o') + 1], 'cluster_logs/dada2_denoise.%J.stdout')
+        self.assertEqual(command[-1], 'jobscript.sh')
+
+    def test_b_local_status(self):
+        """ Test the status of local jobs follows how they exit """
+        finished = self.submit('echo finished > {}\n'.format(self.path / 'output'))
+        self.assertTrue(finished.startswith('local-'))
+        self.assertEqual(self.wait(finished), 'success')
+        self.assertEqual((self.path / 'output').read_text(), 'finished\n')
+
+        self.assertEqual(self.wait(self.submit('exit 3\n')), 'failed')
+
+    def test_c_cancel(self):
+        """ Test cancelled jobs are stopped and reported as failed """
+        job_id = self.submit('sleep 30\n')
+        self.assertEqual(self.status(job_id), 'running')
+        self.assertEqual(lsf_status.main(['--log-dir', str(self.log_dir), 'cancel', job_id]), 0)
+        self.assertEqual(self.wait(job_id), 'failed')
@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from mmeds.metrics import MetricsRegistry
+
+
+class MetricsTests(TestCase):
+    """ Tests of the metrics registry """
+
+    def test_a_render(self):
+        """ Test metrics are rendered in the Prometheus text format """
+        registry = MetricsRegistry()
+        registry.describe('messages_total', 'counter', 'Messages received')
+        registry.inc('messages_total', type='upload')
+        registry.inc('messages_total', 2, type='upload')
+        registry.set('queue_depth', 4)
+        registry.observe('tick_seconds', 1.5)
+        registry.observe('tick_seconds', 0.5)
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP messages_total Messages received',
+            '# TYPE messages_total counter',
+            'messages_total{type="upload"} 3',
+            '# TYPE queue_depth gauge',
+            'queue_depth 4',
+            '# TYPE tick_seconds summary',
+            'tick_seconds_count 2',
+            'tick_seconds_sum 2.0',
+            '# HELP tick_seconds_max Largest value observed in tick_seconds',
+            '# TYPE tick_seconds_max gauge',
+            'tick_seconds_max 1.5'
+        ])
+
+    def test_b_health(self):
+        """ Test the health check reports the state of its callback """
+        registry = MetricsRegistry()
+        self.assertEqual(registry.health(), (True, {}))
+        registry.health_check = lambda: (False, {'seconds_since_tick': 600})
+        self.assertEqual(registry.health(), (False, {'seconds_since_tick': 600}))
@@ -0,0 +1,85 @@
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+from mmeds.scheduler import WorkScheduler, WorkJournal
+
+
+def analysis(user, number):
+    """ Create an analysis work item for USER """
+    return ('analysis', user, 'code_{}'.format(number), 'core_pipeline_taxonomic',
+            'default', 'test_analysis', None, {}, -1, False)
+
+
+class SchedulerTests(TestCase):
+    """ Tests of the Watcher's work scheduling """
+
+    def test_a_interactive_first(self):
+        """ Test emails are handled before queued batch work """
+        scheduler = WorkScheduler()
+        scheduler.put(analysis('user_a', 0))
+        scheduler.put(('email', 'user_c@email.com', 'user_c', 'upload', {}))
+        scheduler.put(('count', 'user_count'))
+
+        self.assertEqual(scheduler.get()[1][0], 'count')
+        self.assertEqual(scheduler.get()[1][0], 'email')
+        self.assertEqual(scheduler.get()[1][0], 'analysis')
+        self.assertEqual(scheduler.get(), (None, None))
+
+    def test_b_fair_share(self):
+        """ Test one user's backlog doesn't hold up another user """
+        scheduler = WorkScheduler()
+        for i in range(3):
+            scheduler.put(analysis('user_a', i))
+        scheduler.put(analysis('user_b', 3))
+
+        users = [scheduler.get()[1][1] for i in range(4)]
+        self.assertEqual(users, ['user_a', 'user_b', 'user_a', 'user_a'])
+
+    def test_c_skip_lane(self):
+        """ Test skipped lanes are held until they're allowed """
+        scheduler = WorkScheduler()
+        scheduler.put(('upload-run', 'run_name', 'user_a', 'single_end', 'single_barcodes', {}, False))
+
+        self.assertEqual(scheduler.get(skip=('upload',)), (None, None))
+        self.assertEqual(scheduler.metrics()['upload']['depth'], 1)
+        self.assertEqual(scheduler.get()[1][0], 'upload-run')
+        self.assertEqual(len(scheduler), 0)
+
+        # Generating IDs writes to the database so it waits for uploads too
+        scheduler.put(('upload-ids', 'user_b', 'code', 'aliquot_table', 'aliquot', True))
+        self.assertEqual(scheduler.get(skip=('upload',)), (None, None))
+
+    def test_d_journal(self):
+        """ Test unfinished work is kept in the journal until it's acknowledged """
+        with TemporaryDirectory() as temp_dir:
+            journal = WorkJournal(Path(temp_dir) / 'work.db')
+            first = journal.add(analysis('user_a', 0), 'key')
+            second = journal.add(('email', 'user_a@email.com', 'user_a', 'upload', {}))
+            # Work sent again with the same key isn't added twice, identical work without one is
+            self.assertIsNone(journal.add(analysis('user_a', 0), 'key'))
+            third = journal.add(('email', 'user_a@email.com', 'user_a', 'upload', {}))
+            self.assertNotEqual(second, third)
+            journal.ack(third)
+
+            journal.start(first, 'analysis_code')
+            journal.ack(second)
+
+            # Reopen the journal as the watcher would after a restart
+            journal = WorkJournal(Path(temp_dir) / 'work.db')
+            self.assertEqual(journal.pending(), [])
+            self.assertEqual(journal.started(), [(first, analysis('user_a', 0), 'analysis_code')])
+            journal.finish('analysis_code')
+            self.assertEqual(journal.started(), [])
+
+    def test_e_unget(self):
+        """ Test returning an item keeps its place and doesn't count as a wait """
+        scheduler = WorkScheduler()
+        scheduler.put(('upload-run', 'run_name', 'user_a', 'single_end', 'single_barcodes', {}, False), 1, 'first')
+        scheduler.put(('upload-run', 'run_name', 'user_a', 'single_end', 'single_barcodes', {}, False), 2, 'second')
+
+        self.assertEqual(scheduler.get()[0], 'first')
+        scheduler.unget()
+        self.assertEqual(len(scheduler.waits['upload']), 0)
+        self.assertEqual(scheduler.lanes['upload']['user_a'][0][:1], (1,))
+        self.assertEqual(scheduler.get()[0], 'first')
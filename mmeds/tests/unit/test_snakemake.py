@@ -2,8 +2,10 @@ from unittest import TestCase, expectedFailure
 from pathlib import Path
 import mmeds.config as fig
 from subprocess import run, CalledProcessError
+import json
+from yaml import safe_load
 
-from mmeds.util import setup_environment
+from mmeds.util import setup_environment, summarize_mapping_file
 from mmeds.logging import Logger
 
 class SnakemakeTests(TestCase):
@@ -20,20 +22,27 @@ class SnakemakeTests(TestCase):
         snakefile = path / 'Snakefile'
         dag = path / 'test_dag.pdf'
         rulegraph = path / 'test_rulegraph.pdf'
+        # Write what Analysis.create_snakemake_file provides the rules with
+        config = safe_load(next(path.glob('*config.yaml')).read_text())
+        columns = [column for key in ('classes', 'subclasses') if isinstance(config.get(key), list)
+                   for column in config[key]]
+        summary = path / 'tables' / 'mapping_summary.json'
+        summary.write_text(json.dumps(summarize_mapping_file(path / 'tables' / 'qiime_mapping_file.tsv', columns)))
+        snakemake = f"snakemake --config tools_dir={fig.TOOLS_DIR} artifact_cache_dir={fig.ARTIFACT_CACHE_DIR}"
         try:
             run(f"cp {path / f'{path.name}.Snakefile'} {snakefile}; \
                 sed -i 's|snakemake_dir|{fig.SNAKEMAKE_RULES_DIR}|g' {snakefile}",
                 shell=True, check=True)
-            run(f"cd {path}; snakemake --dag | dot -Tpdf > {dag}",
+            run(f"cd {path}; {snakemake} --dag | dot -Tpdf > {dag}",
                 shell=True, check=True, env=self.mmeds_env)
-            run(f"cd {path}; snakemake --rulegraph | dot -Tpdf > {rulegraph}",
+            run(f"cd {path}; {snakemake} --rulegraph | dot -Tpdf > {rulegraph}",
                 shell=True, check=True, env=self.mmeds_env)
-            run(f"cd {path}; snakemake -n",
+            run(f"cd {path}; {snakemake} -n",
                 shell=True, check=True, env=self.mmeds_env)
         except CalledProcessError as e:
             Logger.error(e)
             self.assertTrue(False)
-        run(f"rm -f {dag}; rm -f {rulegraph}; rm -f {snakefile}", shell=True)
+        run(f"rm -f {dag}; rm -f {rulegraph}; rm -f {snakefile}; rm -f {summary}", shell=True)
         return 0
 
 
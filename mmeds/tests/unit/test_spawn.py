@@ -1,5 +1,8 @@
 from unittest import TestCase, skip
 from time import sleep
+from queue import Empty
+from tempfile import TemporaryDirectory
+from subprocess import run
 
 from yaml import safe_load
 from pathlib import Path
@@ -9,6 +12,7 @@ from mmeds.logging import Logger
 from mmeds.database.database import Database
 import mmeds.config as fig
 import mmeds.spawn as sp
+from mmeds.scheduler import WorkJournal
 
 testing = True
 
@@ -19,18 +23,19 @@ class SpawnTests(TestCase):
     @classmethod
     def setUpClass(self):
         self.monitor = sp.Watcher()
-        self.monitor.connect()
-        self.q = self.monitor.get_queue()
-        self.pipe = self.monitor.get_pipe()
+        self.q = sp.get_watcher_client()
+        self.status = self.q.subscribe()
         self.infos = []
         self.analyses = []
 
     def receive_all_pipe_output(self, time):
         """ Wait a given number of seconds for all output from the Watcher to process """
         pipe_results = []
-        while self.pipe.poll(time):
-            pipe_results.append(self.pipe.recv())
-        return pipe_results
+        while True:
+            try:
+                pipe_results.append(self.status.get(timeout=time))
+            except Empty:
+                return pipe_results
 
     def test_a_upload_data(self):
         """ Test uploading data through the queue """
@@ -44,7 +49,7 @@ class SpawnTests(TestCase):
         # Recieve the process info dicts from Watcher
         # Sent one at time b/c only one upload can happen at a time
         for i in [0, 1]:
-            info = self.pipe.recv()
+            info = self.status.get()
             # Drop the is alive info as it may no longer be accurate
             del info['is_alive']
             # Check they match the contents of current_processes
@@ -55,7 +60,7 @@ class SpawnTests(TestCase):
             self.infos += procs
             self.assertEqual([info], procs)
             # Check the process exited with code 0
-            self.assertEqual(self.pipe.recv(), 0)
+            self.assertEqual(self.status.get(), 0)
 
         # Wait for watcher to update current_processes
         sleep(5)
@@ -113,15 +118,27 @@ class SpawnTests(TestCase):
         self.assertEqual(pipe_results.count(0), len(self.analyses))
 
     def test_d_node_analysis(self):
+        """ Test analyses run on the node wait until there are cores and memory free for them """
         Logger.info("node analysis")
+        # Work out how many of the analyses fit on the node at once
+        node = sp.NodeResources(fig.NODE_ANALYSIS_CORES, fig.NODE_ANALYSIS_MEMORY)
+        needs = node.estimate('core_pipeline_taxonomic', {})
+        running = 0
+        while running < 5 and node.fits(*needs):
+            node.reserve(running, *needs)
+            running += 1
+        node.release(0)
+        self.assertTrue(node.fits(*needs))
+
         for i in range(5):
             self.q.put(('analysis', self.infos[0]['owner'], self.infos[0]['access_code'], 'core_pipeline_taxonomic',
                         'default', 'test_analysis_node', None, {}, -1, True))
 
         pipe_results = self.receive_all_pipe_output(8)
         Logger.debug(f"PIPE RESULTS: {pipe_results}")
-        self.assertIn("Analysis Not Started", pipe_results)
-        self.assertEquals(pipe_results.count(0), 4)
+        # The rest wait and are started as the running analyses finish
+        self.assertEqual(pipe_results.count('Analysis Queued'), 5 - running)
+        self.assertEqual(pipe_results.count(0), 5)
 
     @skip("uploading ids outdated")
     def test_e_generate_ids(self):
@@ -161,10 +178,63 @@ class SpawnTests(TestCase):
         self.monitor.clean_temp_folders()
         self.assertFalse(temp_sub_dir.exists())
 
+    def test_h_recover_work(self):
+        """ Test an analysis whose process died while the watcher was down is restarted rather than run again """
+        proc = self.analyses[0]
+        with Database(testing=testing) as db:
+            doc = db.get_doc(proc['access_code'])
+        # The ID of a process that has exited
+        dead_pid = int(run(['sh', '-c', 'echo $$'], capture_output=True, text=True).stdout)
+        doc.update(is_alive=True, pid=dead_pid)
+
+        with TemporaryDirectory() as temp_dir:
+            self.monitor.journal = WorkJournal(Path(temp_dir) / 'journal.db')
+            analysis = ('analysis', doc.owner, doc.study_code, 'core_pipeline_taxonomic', 'default',
+                        'test_analysis', None, {}, -1, False)
+            ticket = self.monitor.journal.add(analysis)
+            self.monitor.journal.start(ticket, doc.access_code)
+            self.monitor.recover_work()
+
+            restart = ('restart', doc.owner, doc.access_code, False, doc.restart_stage or 0, -1)
+            self.assertEqual(self.monitor.scheduler.get()[1], restart)
+            self.assertEqual([item for _, item, _ in self.monitor.journal.pending()], [restart])
+            self.assertEqual(self.monitor.journal.started(), [])
+        doc.reload()
+        self.assertFalse(doc.is_alive)
+
+    def test_i_stats(self):
+        """ Test the stats count documents once their process succeeds and are only recounted periodically """
+        stat_file = fig.STAT_FILE
+        with TemporaryDirectory() as temp_dir:
+            fig.STAT_FILE = Path(temp_dir) / 'mmeds_stats.yaml'
+            try:
+                self.monitor.checked_stats = None
+                self.monitor.update_stats()
+                counted = dict(self.monitor.stats)
+                self.assertEqual(safe_load(fig.STAT_FILE.read_text()), counted)
+
+                self.monitor.count_finished('analysis', 0)
+                self.monitor.count_finished('upload', 1)
+                self.monitor.count_finished('restart', 0)
+                self.monitor.count_stat('user_count')
+                self.monitor.count_stat('missing_count')
+                expected = dict(counted, analysis_count=counted['analysis_count'] + 1,
+                                user_count=counted['user_count'] + 1)
+                self.assertEqual(safe_load(fig.STAT_FILE.read_text()), expected)
+
+                # Not recounted until the interval has passed
+                self.monitor.update_stats()
+                self.assertEqual(self.monitor.stats, expected)
+                self.monitor.checked_stats -= timedelta(seconds=fig.STATS_RECONCILE_SECONDS + 1)
+                self.monitor.update_stats()
+                self.assertEqual(self.monitor.stats, counted)
+            finally:
+                fig.STAT_FILE = stat_file
+
     def test_z_exit(self):
         Logger.error('Putting Terminate')
         self.q.put(('terminate'))
-        Logger.error('Waiting on pipe')
-        result = self.pipe.recv()
-        Logger.error('Got {} from pipe'.format(result))
+        Logger.error('Waiting on status')
+        result = self.status.get()
+        Logger.error('Got {} from status'.format(result))
         self.assertEqual(result, 'Watcher exiting')
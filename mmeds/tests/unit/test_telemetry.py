@@ -0,0 +1,48 @@
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from subprocess import Popen
+from pathlib import Path
+
+from mmeds.telemetry import read_benchmarks, summarize_benchmarks, ProcessTreeSampler
+
+HEADER = 's\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\tcpu_time\n'
+
+
+class TelemetryTests(TestCase):
+    """ Tests of the records of the time and resources analyses use """
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_a_read_benchmarks(self):
+        """ Test benchmark files are read and summarized by rule """
+        (self.path / 'dada2_denoise.run1.tsv').write_text(
+            HEADER + '120.5\t0:02:00\t900.0\t1200.0\t850.0\t860.0\t10.0\t5.0\t95.0\t110.0\n')
+        (self.path / 'dada2_denoise.run2.tsv').write_text(
+            HEADER + '60.5\t0:01:00\t1500.0\t1800.0\t1400.0\t1450.0\t10.0\t5.0\t90.0\t55.0\n')
+        (self.path / 'taxonomic_barplot.tsv').write_text(
+            HEADER + '5.0\t0:00:05\tNA\tNA\tNA\tNA\tNA\tNA\tNA\t4.0\n')
+
+        records = read_benchmarks(self.path)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['rule'], 'dada2_denoise')
+        self.assertEqual(records[0]['wildcards'], 'run1')
+        self.assertIsNone(records[2]['max_rss_mb'])
+
+        summary = summarize_benchmarks(records)
+        self.assertEqual(summary['dada2_denoise']['jobs'], 2)
+        self.assertEqual(summary['dada2_denoise']['max_seconds'], 120.5)
+        self.assertEqual(summary['dada2_denoise']['max_rss_mb'], 1500.0)
+        self.assertIsNone(summary['taxonomic_barplot']['max_rss_mb'])
+
+    def test_b_sample_process_tree(self):
+        """ Test the resources of a process and its children are sampled until it exits """
+        process = Popen(['bash', '-c', 'sleep 1 & sleep 1; wait'])
+        with ProcessTreeSampler(process.pid, 0.1) as sampler:
+            process.wait()
+        self.assertTrue(sampler.samples)
+        self.assertGreaterEqual(max(sample['processes'] for sample in sampler.samples), 2)
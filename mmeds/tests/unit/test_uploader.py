@@ -1,7 +1,11 @@
 from mmeds.database.database import upload_otu, upload_metadata
+from mmeds.database.metadata_uploader import MetaDataUploader, UploadCheckpoint
 from mmeds.authentication import add_user, remove_user
+from mmeds.util import quote_sql
 import mmeds.config as fig
 from unittest import TestCase, skip
+from tempfile import TemporaryDirectory
+from pathlib import Path
 
 testing = True
 
@@ -49,3 +53,92 @@ class UploaderTests(TestCase):
         # Not running this test, this functionality at present has been removed
         return
         assert 0 == upload_otu(self.test_otu)
+
+    def test_checkpoint(self):
+        """ Test the progress of an upload is saved and loaded again """
+        with TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / fig.UPLOAD_CHECKPOINT_FILE
+            checkpoint = UploadCheckpoint(path, {'study_name': 'Test_Checkpoint'})
+            checkpoint.update(pid=1, attempts=1)
+            checkpoint.complete('metadata')
+            checkpoint.start('table:Subjects', first_key=10)
+            checkpoint.complete('table:Lab', {0: 4, 1: 4})
+
+            loaded = UploadCheckpoint(path)
+            self.assertEqual(loaded.params, {'study_name': 'Test_Checkpoint'})
+            self.assertEqual(loaded.attempts, 1)
+            self.assertTrue(loaded.is_complete('metadata'))
+            self.assertFalse(loaded.is_complete('table:Subjects'))
+            self.assertEqual(loaded.started('table:Subjects'), {'first_key': 10})
+            self.assertEqual(loaded.get_ids('table:Lab'), {0: 4, 1: 4})
+
+            loaded.clear()
+            self.assertFalse(path.exists())
+
+    def test_resume(self):
+        """ Test an interrupted upload removes the rows it partially loaded and finishes when resumed """
+        first = MetaDataUploader(fig.TEST_SUBJECT_SHORT, 'human', fig.TEST_SPECIMEN_SHORT, self.user, 'qiime',
+                                 'Test_Resume', False, False, False, testing)
+
+        complete = first.checkpoint.complete
+
+        def interrupt(step, IDs=None):
+            """ Stop the upload once its first table has been loaded, before that's recorded """
+            if step.startswith('table:'):
+                raise InterruptedError(step)
+            complete(step, IDs)
+        first.checkpoint.complete = interrupt
+        with self.assertRaises(InterruptedError) as context:
+            first.run()
+        step = context.exception.args[0]
+        table = step.split(':')[1]
+
+        checkpoint = UploadCheckpoint(Path(first.mdata.path) / fig.UPLOAD_CHECKPOINT_FILE)
+        self.assertEqual(checkpoint.attempts, 1)
+        self.assertTrue(checkpoint.is_complete('document'))
+        first_key = checkpoint.started(step)['first_key']
+
+        second = MetaDataUploader(testing=testing, access_code=first.access_code, resume=True, **checkpoint.params)
+        sql = quote_sql('SELECT COUNT(*) FROM {table} WHERE {idtable} >= %(first_key)s',
+                        table=table, idtable='id' + table)
+
+        def loaded():
+            with second.db.cursor() as cursor:
+                cursor.execute(sql, {'first_key': first_key})
+                return cursor.fetchone()[0]
+        partial = loaded()
+        second.remove_partial_import(table)
+        self.assertEqual(loaded(), 0)
+
+        self.assertEqual(second.run(), 0)
+        self.assertEqual(loaded(), partial)
+        self.assertFalse(checkpoint.path.exists())
+
+    def test_resume_junction(self):
+        """ Test resuming an upload interrupted while filling a junction table doesn't load its pairs twice """
+        table = fig.JUNCTION_TABLES[0]
+        first = MetaDataUploader(fig.TEST_SUBJECT_SHORT, 'human', fig.TEST_SPECIMEN_SHORT, self.user, 'qiime',
+                                 'Test_Resume_Junction', False, False, False, testing)
+        sql = quote_sql('SELECT COUNT(*) FROM {table}', table=table)
+
+        def loaded():
+            with first.db.cursor() as cursor:
+                cursor.execute(sql)
+                return cursor.fetchone()[0]
+
+        complete = first.checkpoint.complete
+
+        def interrupt(step, IDs=None):
+            """ Stop the upload once the junction table has been loaded, before that's recorded """
+            if step == 'junction:{}'.format(table):
+                raise InterruptedError(step)
+            complete(step, IDs)
+        first.checkpoint.complete = interrupt
+        with self.assertRaises(InterruptedError):
+            first.run()
+        partial = loaded()
+
+        checkpoint = UploadCheckpoint(Path(first.mdata.path) / fig.UPLOAD_CHECKPOINT_FILE)
+        second = MetaDataUploader(testing=testing, access_code=first.access_code, resume=True, **checkpoint.params)
+        self.assertEqual(second.run(), 0)
+        self.assertEqual(loaded(), partial)
@@ -1,10 +1,11 @@
 from unittest import TestCase, skip
 from mmeds import util
-from mmeds.error import InvalidConfigError, InvalidSQLError
+from mmeds.error import InvalidConfigError, InvalidSQLError, GraphRenderError
 from mmeds.validate import validate_mapping_file
 from pathlib import Path
 from pytest import raises
 from tempfile import gettempdir
+from zipfile import ZipFile
 from tidylib import tidy_document
 from pandas import read_csv, DataFrame, MultiIndex
 from numpy import nan
@@ -297,3 +298,95 @@ class UtilTests(TestCase):
 
         df = util.concatenate_metadata_subsets(entries, paths)
         subj_df, spec_df = util.split_metadata(df, 'human', new_study_name="New_Test_Study")
+
+    def test_r_dag_to_rulegraph(self):
+        """ Test merging the jobs of a snakemake DAG into its rules """
+        dag = '\n'.join([
+            'digraph snakemake_dag {',
+            '    graph[bgcolor=white, margin=0];',
+            '\t0[label = "all", color = "0.00 0.6 0.85", style="rounded"];',
+            '\t1[label = "demux\\nrun: run1", color = "0.33 0.6 0.85", style="rounded"];',
+            '\t2[label = "demux\\nrun: run2", color = "0.33 0.6 0.85", style="rounded"];',
+            '\t3[label = "merge", color = "0.66 0.6 0.85", style="rounded"];',
+            '\t1 -> 3',
+            '\t2 -> 3',
+            '\t3 -> 0',
+            '}'
+        ])
+        rulegraph = util.dag_to_rulegraph(dag)
+        assert '\t1[label = "demux", color = "0.33 0.6 0.85", style="rounded"];' in rulegraph
+        assert '\t2[' not in rulegraph
+        assert rulegraph.count('1 -> 3') == 1
+        assert '3 -> 0' in rulegraph
+        assert rulegraph.startswith('digraph snakemake_dag {\n    graph[')
+        assert rulegraph.endswith('}\n')
+
+    def test_s_summarize_mapping_file(self):
+        """ Test summarizing the sample groups of a mapping file for snakemake """
+        mapping_file = Path(gettempdir()) / 'summarize_mapping_file.tsv'
+        mapping_file.write_text('\n'.join([
+            '#SampleID\tBodySite\tAge',
+            '#q2:types\tcategorical\tcategorical',
+            'A\tgut\t1',
+            'B\tskin\t',
+            'C\tgut\t2'
+        ]) + '\n')
+        summary = util.summarize_mapping_file(mapping_file, ['BodySite', 'Age', 'Missing'])
+        assert summary['samples'] == 3
+        assert summary['columns']['BodySite'] == {'gut': 2, 'skin': 1}
+        assert summary['columns']['Age'] == {'1.0': 1, '2.0': 1}
+        assert 'Missing' not in summary['columns']
+        mapping_file.unlink()
+
+    def test_t_get_artifact_type(self):
+        """ Test reading the semantic type of a QIIME artifact """
+        artifact = Path(gettempdir()) / 'get_artifact_type.qza'
+        with ZipFile(artifact, 'w') as archive:
+            archive.writestr('uuid/metadata.yaml', 'uuid: uuid\ntype: FeatureTable[Frequency]\n')
+            archive.writestr('uuid/provenance/metadata.yaml', 'uuid: uuid\ntype: SampleData[SequencesWithQuality]\n')
+        assert util.get_artifact_type(artifact) == 'FeatureTable[Frequency]'
+
+        artifact.write_text('not an artifact')
+        assert util.get_artifact_type(artifact) is None
+        artifact.unlink()
+        assert util.get_artifact_type(artifact) is None
+
+    def test_u_render_snakemake_graph_error(self):
+        """ Test graphs Graphviz can't render raise a clear error and don't leave a partial PDF """
+        graph_dir = Path(gettempdir()) / 'render_snakemake_graph'
+        graph_dir.mkdir(exist_ok=True)
+        graph_file = graph_dir / 'snakemake_dag.pdf'
+        assert not util.render_snakemake_graph(graph_file)
+
+        (graph_dir / 'snakemake_dag.dot').write_text('digraph snakemake_dag {\n\t0 -> \n')
+        with raises(GraphRenderError) as e:
+            util.render_snakemake_graph(graph_file)
+        assert 'snakemake_dag.pdf' in e.value.message
+        assert list(graph_dir.iterdir()) == [graph_dir / 'snakemake_dag.dot']
+        (graph_dir / 'snakemake_dag.dot').unlink()
+        graph_dir.rmdir()
+
+    def test_v_load_mmeds_stats(self):
+        """ Test the stats file is only read again once it's been replaced """
+        stat_file = fig.STAT_FILE
+        fig.STAT_FILE = Path(gettempdir()) / 'load_mmeds_stats.yaml'
+        try:
+            if fig.STAT_FILE.exists():
+                fig.STAT_FILE.unlink()
+            assert util.load_mmeds_stats() == {}
+            fig.STAT_FILE.write_text('study_count: 1\n')
+            stats = util.load_mmeds_stats()
+            assert stats == {'study_count': 1}
+            stats['study_count'] = 3
+            assert util.load_mmeds_stats() == {'study_count': 1}
+
+            mtime = fig.STAT_FILE.stat().st_mtime_ns
+            fig.STAT_FILE.write_text('study_count: 2\n')
+            os.utime(fig.STAT_FILE, ns=(mtime, mtime))
+            assert util.load_mmeds_stats() == {'study_count': 1}
+            os.utime(fig.STAT_FILE, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+            assert util.load_mmeds_stats() == {'study_count': 2}
+        finally:
+            if fig.STAT_FILE.exists():
+                fig.STAT_FILE.unlink()
+            fig.STAT_FILE = stat_file
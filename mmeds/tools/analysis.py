@@ -1,6 +1,6 @@
 from pathlib import Path
-from subprocess import run, CalledProcessError
-from shutil import copy, rmtree
+from subprocess import run, Popen, CalledProcessError
+from shutil import rmtree
 from time import sleep
 from copy import copy as classcopy
 from copy import deepcopy
@@ -8,14 +8,21 @@ from ppretty import ppretty
 from collections import defaultdict
 from datetime import datetime
 import pandas as pd
+import yaml
+import json
 
 from mmeds.database.database import Database
+from mmeds.artifacts import ReferenceStore, OutputLedger
+from mmeds.telemetry import ProcessTreeSampler, read_benchmarks
 from mmeds.util import (create_qiime_from_mmeds, write_config,
                         load_metadata, write_metadata, camel_case,
-                        get_file_index_entry_location, get_mapping_file_subset)
+                        get_file_index_entry_location, get_mapping_file_subset, get_artifact_type,
+                        replace_if_changed, update_symlink, summarize_mapping_file)
 from mmeds.error import AnalysisError, MissingFileError
 from mmeds.config import (COL_TO_TABLE, JOB_TEMPLATE, WORKFLOWS, SNAKEMAKE_WORKFLOWS_DIR,
-                          SNAKEMAKE_RULES_DIR, TAXONOMIC_DATABASES)
+                          SNAKEMAKE_RULES_DIR, TAXONOMIC_DATABASES, REFERENCE_STORE_DIR, TOOLS_DIR, ARTIFACT_CACHE_DIR,
+                          CLUSTER_PER_RULE, CLUSTER_MAX_JOBS, CLUSTER_MAX_THREADS, CLUSTER_QUEUE,
+                          CLUSTER_PROJECT, ANALYSIS_SAMPLE_SECONDS, REFERENCE_ARTIFACT_TYPES)
 from mmeds.logging import Logger
 
 import multiprocessing as mp
@@ -75,6 +82,8 @@ class Analysis(mp.Process):
         self.study_code = study_code
         self.sequencing_runs = runs
         self.num_jobs = min([threads, mp.cpu_count()])
+        # Analyses sent to the cluster submit each rule as a separate job
+        self.per_rule = CLUSTER_PER_RULE and run_on_node == -1
 
     def __str__(self):
         """ Provides a nicely formatted string representation of a Tool process """
@@ -169,10 +178,51 @@ class Analysis(mp.Process):
             'path': self.path,
             'nodes': self.num_jobs,
             'memory': 50000,
-            'queue': 'premium'
+            'queue': CLUSTER_QUEUE
         }
+        # The job only runs snakemake itself, which submits the work as separate jobs
+        if self.per_rule:
+            params.update(nodes=1, memory=4000)
         return params
 
+    def write_cluster_profile(self):
+        """
+        Write the snakemake profile that submits each rule as its own job, reserving the threads,
+        memory, and runtime the rule declares. When testing the jobs are run locally instead.
+        """
+        submit = ' '.join([
+            'python', str(TOOLS_DIR / 'lsf_submit.py'),
+            '--local' if self.testing else '',
+            '--queue', CLUSTER_QUEUE,
+            '--project', CLUSTER_PROJECT,
+            '--name', '{}-{}'.format(self.owner, self.doc.name),
+            '--log-dir', 'cluster_logs',
+            '--rule {rule} --threads {threads} --mem-mb {resources.mem_mb} --runtime {resources.runtime}'
+        ])
+        status = 'python {} --log-dir cluster_logs'.format(TOOLS_DIR / 'lsf_status.py')
+        profile = {
+            'cluster': submit,
+            # Without these jobs that LSF kills would be waited on forever
+            'cluster-status': status + ' status',
+            'cluster-cancel': status + ' cancel',
+            'jobs': CLUSTER_MAX_JOBS,
+            # The core budget of each job, rules scale their threads up to it
+            'cores': CLUSTER_MAX_THREADS,
+            'use-conda': True,
+            # Re-run jobs that were interrupted, e.g. by the analysis being restarted
+            'rerun-incomplete': True,
+            # Tells the rules each job has its own cores rather than sharing the analysis'
+            'config': ['cluster_jobs=True'],
+            # Give the shared filesystem time to show the outputs of jobs that ran elsewhere
+            'latency-wait': 60,
+            'default-resources': ['mem_mb=4000', 'runtime=60', 'tmpdir="tmp_dir"']
+        }
+        profile_dir = self.path / 'cluster_profile'
+        profile_dir.mkdir(exist_ok=True)
+        self.add_path(profile_dir, key='cluster_profile')
+        with open(profile_dir / 'config.yaml', 'w') as f:
+            yaml.safe_dump(profile, f)
+
     def queue_analysis(self, workflow_type):
         """
         Add an analysis of the specified type to the watcher queue
@@ -206,52 +256,82 @@ class Analysis(mp.Process):
 
         # Create the Qiime mapping file
         qiime_file = self.get_file("tables_dir", True) / 'qiime_mapping_file.tsv'
-        create_qiime_from_mmeds(mmeds_file, qiime_file, self.doc.workflow_type)
+        temp_file = qiime_file.with_name('.qiime_mapping_file.tsv.tmp')
+        create_qiime_from_mmeds(mmeds_file, temp_file, self.doc.workflow_type)
+        replace_if_changed(temp_file, qiime_file)
 
         # Add the mapping file to the MetaData object
         self.add_path(qiime_file, key='mapping')
 
     def create_snakemake_file(self):
-        """ Copy a snakemake Snakefile to be used for analysis """
+        """ Copy a snakemake Snakefile to be used for analysis, with a summary of the mapping file for its rules """
         workflow_file = SNAKEMAKE_WORKFLOWS_DIR / f"{self.workflow_type}.Snakefile"
         # Open file for copying
         with open(workflow_file, "rt") as f:
             workflow_text = f.read()
 
-        # Specify directory with snakemake rules
-        workflow_text = workflow_text.format(snakemake_dir=SNAKEMAKE_RULES_DIR)
+        # Specify directory with snakemake rules and the locations the rules need from the config
+        workflow_text = workflow_text.format(snakemake_dir=SNAKEMAKE_RULES_DIR, tools_dir=TOOLS_DIR,
+                                             artifact_cache_dir=ARTIFACT_CACHE_DIR)
 
         # Write new Snakefile in analysis directory
         snakefile = self.path / "Snakefile"
         self.add_path(snakefile, key="snakefile")
-        with open(snakefile, "wt") as f:
+        with open(self.path / ".Snakefile.tmp", "wt") as f:
             f.write(workflow_text)
-
-    def copy_taxonomic_database(self):
-        """ Copy in the database (e.g. greengenes, silva) to be used for classification"""
+        replace_if_changed(self.path / ".Snakefile.tmp", snakefile)
+
+        # Summarize the mapping file once here rather than in every snakemake process
+        columns = [column for key in ('classes', 'subclasses') if isinstance(self.doc.config.get(key), list)
+                   for column in self.doc.config[key]]
+        summary = summarize_mapping_file(self.get_file('mapping', True), columns)
+        summary_file = self.get_file('tables_dir', True) / 'mapping_summary.json'
+        self.add_path(summary_file, key='mapping_summary')
+        with open(summary_file.with_name('.mapping_summary.json.tmp'), 'w') as f:
+            json.dump(summary, f)
+        replace_if_changed(summary_file.with_name('.mapping_summary.json.tmp'), summary_file)
+
+    def link_taxonomic_database(self):
+        """ Link in the database (e.g. greengenes, silva) to be used for classification from the reference store """
         database_file = TAXONOMIC_DATABASES[self.config["taxonomic_database"]]
-        database_copy = self.get_file("tables_dir", True) / database_file.name
-        self.add_path(database_copy, key="taxonomic_database")
-        copy(database_file, database_copy)
+        database_link = self.get_file("tables_dir", True) / database_file.name
+        self.add_path(database_link, key="taxonomic_database")
+        store = ReferenceStore(REFERENCE_STORE_DIR)
+        store.link(store.get(self.config["taxonomic_database"], database_file), database_link)
 
     def link_feature_tables(self):
         """ Symlink to feature tables that were generated in a previous analysis """
+        tables_dir = self.get_file("tables_dir", True)
         with Database(owner=self.owner, testing=self.testing) as db:
-            previous_analyses = list(db.get_all_analyses_from_study(self.study_code))
-
+            for table in self.config["tables"]:
+                self.add_path(tables_dir / f"{table}.qza", key=table)
+                # Use the most recent table that's still on disk
+                table_file = next((Path(artifact.path) for artifact in db.get_artifacts(self.study_code, table)
+                                   if Path(artifact.path).exists()), None)
+
+                # Analyses that finished before artifacts were recorded have to be searched
+                if table_file is None:
+                    for doc in db.get_all_analyses_from_study(self.study_code).only('path'):
+                        table_file = next(Path(doc.path).glob(f"**/{table}.qza"), None)
+                        if table_file is not None:
+                            break
+
+                if table_file is None:
+                    raise MissingFileError(f"No file named {table}.qza in previous analyses of study "
+                                           f"{self.doc.study_name}")
+                update_symlink(self.get_file(table, True), table_file)
+
+    def register_artifacts(self):
+        """ Record the artifacts this analysis produced so later analyses can find them without searching """
         tables_dir = self.get_file("tables_dir", True)
-        for table in self.config["tables"]:
-            self.add_path(tables_dir / f"{table}.qza", key=table)
-            table_files = []
-            for doc in previous_analyses:
-                analysis_dir = Path(doc["path"])
-                table_files += list(analysis_dir.glob(f"**/{table}.qza"))
-
-            if len(table_files) < 1:
-                raise MissingFileError(f"No file named {table}.qza in previous analyses of study {self.doc.study_name}")
-
-            #TODO: Handle more than 1 matching file
-            self.get_file(table, True).symlink_to(table_files[0])
+        # Tables linked from previous analyses are already recorded
+        artifacts = [(path, get_artifact_type(path)) for path in sorted(tables_dir.glob('*.qza'))
+                     if not path.is_symlink()]
+        # Reference databases are linked in from the reference store rather than produced by the analysis
+        artifacts = [(path, artifact_type) for path, artifact_type in artifacts
+                     if artifact_type not in REFERENCE_ARTIFACT_TYPES]
+        with Database(owner=self.owner, testing=self.testing) as db:
+            db.add_artifacts(self.doc, artifacts)
 
     def split_by_sequencing_run(self):
         """ Separate metadata into sub-folders for each sequencing run """
@@ -271,12 +351,14 @@ class Analysis(mp.Process):
             # Create symlinks to each file of each sequencing run
             for f in self.sequencing_runs[run]:
                 self.add_path(working_dir / f"{f}", ".fastq.gz", key=f'{f}_{run}')
-                self.get_file(f"{f}_{run}", True).symlink_to(self.sequencing_runs[run][f])
+                update_symlink(self.get_file(f"{f}_{run}", True), self.sequencing_runs[run][f])
 
             # Create sub-mapping file that only includes samples for this sequencing run
             self.add_path(run_dir / f"qiime_mapping_file_{run}", ".tsv", key=f"mapping_{run}")
             df = get_mapping_file_subset(self.get_file("mapping", True), run)
-            df.to_csv(self.get_file(f"mapping_{run}", True), sep='\t', index=False)
+            temp_file = run_dir / f".qiime_mapping_file_{run}.tsv.tmp"
+            df.to_csv(temp_file, sep='\t', index=False)
+            replace_if_changed(temp_file, self.get_file(f"mapping_{run}", True))
 
     def make_analysis_dirs(self):
         self.add_path(self.path / 'tables', key="tables_dir")
@@ -315,6 +397,13 @@ class Analysis(mp.Process):
 
         self.make_analysis_dirs()
 
+        # When restarting, make sure the outputs already completed haven't changed since
+        self.ledger = OutputLedger(self.path)
+        self.add_path(self.ledger.ledger_file, key='output_ledger', full_path=True)
+        if self.restart_stage != 0:
+            changed = self.ledger.verify()
+            Logger.debug('{}: {} completed outputs have changed and will be re-created'.format(self.name, len(changed)))
+
         # This is somewhere issues can arrive. If there are problematic differences
         # between the config file as it was uploaded, and what the analysis is running
         # from, `write_config` likely had something to do with it.
@@ -326,7 +415,7 @@ class Analysis(mp.Process):
             self.split_by_sequencing_run()
 
         if "taxonomic_database" in WORKFLOWS[self.workflow_type]["parameters"]:
-            self.copy_taxonomic_database()
+            self.link_taxonomic_database()
 
         if "tables" in WORKFLOWS[self.workflow_type]["parameters"]:
             self.link_feature_tables()
@@ -342,9 +431,18 @@ class Analysis(mp.Process):
             self.jobtext.append("sleep 2")
         self.jobtext.append("ml anaconda3/2024.06")
         self.jobtext.append("conda activate mmeds_test")
-        self.jobtext.append("snakemake --dag | dot -Tpdf >| snakemake_dag.pdf")
-        self.jobtext.append("snakemake --rulegraph | dot -Tpdf >| snakemake_rulegraph.pdf")
-        self.jobtext.append(f"snakemake --use-conda --cores {self.num_jobs} --default-resource tmpdir=\"tmp_dir\"")
+        # Dump the DAG in the background rather than delaying the analysis. It's rendered when it's downloaded.
+        self.jobtext.append("(snakemake --dag >| .snakemake_dag.dot && mv .snakemake_dag.dot snakemake_dag.dot) "
+                            "2>| snakemake_dag.log &")
+        self.add_path('snakemake_dag', '.pdf')
+        self.add_path('snakemake_rulegraph', '.pdf')
+        if self.per_rule:
+            self.write_cluster_profile()
+            self.jobtext.append("snakemake --profile cluster_profile")
+        else:
+            self.jobtext.append(f"snakemake --use-conda --cores {self.num_jobs} --rerun-incomplete "
+                                "--default-resource tmpdir=\"tmp_dir\"")
+        self.jobtext.append('wait')
         self.jobtext.append('echo "MMEDS_FINISHED"')
 
         submitfile = self.path / 'submitfile'
@@ -405,8 +503,11 @@ class Analysis(mp.Process):
                     Logger.debug(f"Jobfile:\n{f.read()}")
                 # Send the output to the error log
                 with open(self.get_file('errorlog', True), 'w+', buffering=1) as f:
-                    # Run the command
-                    run([jobfile], stdout=f, stderr=f)
+                    # Run the command, sampling the resources it uses until it finishes
+                    process = Popen([jobfile], stdout=f, stderr=f)
+                    with ProcessTreeSampler(process.pid, ANALYSIS_SAMPLE_SECONDS) as sampler:
+                        process.wait()
+                self.update_doc(resource_samples=sampler.samples)
                 with open(self.get_file('errorlog', True), 'r') as f:
                     Logger.debug(f"Job stdout/err:\n{f.read()}")
                 Logger.debug('I {} have finished running'.format(self.name))
@@ -434,6 +535,8 @@ class Analysis(mp.Process):
 
     def post_analysis(self):
         """ Perform checking and house keeping once analysis finishes """
+        self.collect_benchmarks()
+        completed = self.ledger.record()
 
         log_text = self.get_file('errorlog', True).read_text()
         # Raise an error if the final command doesn't run
@@ -445,6 +548,9 @@ class Analysis(mp.Process):
             for i in range(1, 6):
                 if 'MMEDS_STAGE_{}'.format(i) in log_text:
                     stage = i
+            # Keep the completed outputs when restarting rather than starting over
+            if completed:
+                stage = max(stage, 1)
             self.update_doc(restart_stage=stage)
 
             # TODO: Find a use for this, disabled because it deletes files we want
@@ -494,16 +600,27 @@ class Analysis(mp.Process):
             self.queue.put(email)
 
         else:
+            # The analysis' results are there even if they can't be recorded for later analyses
+            try:
+                self.register_artifacts()
+            except Exception as e:
+                Logger.error('{}: unable to register artifacts: {}: {}'.format(self.name, type(e).__name__, e))
             email = ('email', self.doc.email, self.doc.owner, 'analysis_done',
                      dict(code=self.doc.access_code,
                           analysis='{}-{}'.format(self.doc.workflow_type, self.doc.analysis_type),
                           study=self.doc.study_name))
+            self.update_doc(restart_stage=-1)  # Indicates analysis finished successfully
         self.queue.put(email)
-        self.update_doc(restart_stage=-1)  # Indicates analysis finished successfully
         # If testing, no files have been generated
         if not self.testing:
             self.move_user_files()
 
+    def collect_benchmarks(self):
+        """ Store the benchmarks written by the analysis' snakemake rules in its document """
+        benchmarks = read_benchmarks(self.path / 'benchmarks')
+        Logger.debug('{}: collected {} rule benchmarks'.format(self.name, len(benchmarks)))
+        self.update_doc(rule_benchmarks=benchmarks)
+
     def run(self):
         """
         Overrides Process.run()
@@ -0,0 +1,84 @@
+"""
+Reports the status of, and cancels, the jobs submitted by lsf_submit.py. Used as the cluster status
+and cancel commands of the profile analyses write when each rule is run as its own job, so jobs LSF
+kills, e.g. for exceeding their memory or runtime, are reported as failed rather than waited on forever.
+
+Jobs run with --local are identified as local-<PID> and write their exit code to the log directory.
+
+Snakemake runs this from the analysis' environment so it only depends on the standard library.
+"""
+import os
+import sys
+import signal
+import argparse
+from pathlib import Path
+from subprocess import run, PIPE, DEVNULL
+
+# The LSF job states that mean the job hasn't finished yet
+LSF_RUNNING = {'PEND', 'RUN', 'PSUSP', 'USUSP', 'SSUSP', 'WAIT', 'PROV'}
+
+
+def local_status(job_id, log_dir):
+    """ Return the status of the job run on this machine with JOB_ID """
+    exit_file = Path(log_dir) / '{}.exit'.format(job_id)
+    if exit_file.exists():
+        return 'success' if exit_file.read_text().strip() == '0' else 'failed'
+    try:
+        os.kill(int(job_id.split('-')[1]), 0)
+    except ProcessLookupError:
+        # Killed before it could record how it exited
+        return 'failed'
+    return 'running'
+
+
+def lsf_status(job_id):
+    """ Return the status of the LSF job with JOB_ID """
+    result = run(['bjobs', '-noheader', '-o', 'stat', job_id], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    state = result.stdout.strip()
+    # LSF forgets jobs some time after they finish, far longer than snakemake waits between checks
+    if 'not found' in result.stdout + result.stderr:
+        return 'failed'
+    # If LSF can't be reached check again next time rather than failing the job
+    if result.returncode or not state or state in LSF_RUNNING:
+        return 'running'
+    return 'success' if state == 'DONE' else 'failed'
+
+
+def status(args):
+    """ Return the status of the job, as snakemake expects it: running, success, or failed """
+    job_id = args.job_ids[0]
+    return local_status(job_id, args.log_dir) if job_id.startswith('local-') else lsf_status(job_id)
+
+
+def cancel(args):
+    """ Stop the jobs with JOB_IDS """
+    lsf_jobs = []
+    for job_id in args.job_ids:
+        if job_id.startswith('local-'):
+            try:
+                # Local jobs are started in their own session so the whole group can be stopped
+                os.killpg(int(job_id.split('-')[1]), signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        else:
+            lsf_jobs.append(job_id)
+    if lsf_jobs:
+        run(['bkill'] + lsf_jobs, stdout=DEVNULL, stderr=DEVNULL)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Check on or cancel snakemake jobs submitted to LSF')
+    parser.add_argument('--log-dir', default='cluster_logs', help='The directory jobs write their output to')
+    parser.add_argument('command', choices=['status', 'cancel'], help='Print the status of a job or cancel jobs')
+    parser.add_argument('job_ids', nargs='+', help='The IDs printed when the jobs were submitted')
+    args = parser.parse_args(args)
+
+    if args.command == 'status':
+        print(status(args))
+    else:
+        cancel(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Submits a single snakemake job to LSF, used as the cluster command of the profile analyses
+write when each rule is run as its own job. Prints the LSF job ID for snakemake to track.
+
+With --local the job is run in the background on this machine instead, standing in for LSF
+so the cluster execution path can be run without access to the cluster. The status of jobs
+is checked, and jobs cancelled, by lsf_status.py.
+
+Snakemake runs this from the analysis' environment so it only depends on the standard library.
+"""
+import re
+import sys
+import argparse
+from math import ceil
+from pathlib import Path
+from subprocess import run, Popen, PIPE, DEVNULL
+
+
+def bsub_command(args):
+    """ Return the bsub command that submits the job """
+    log_dir = Path(args.log_dir)
+    # LSF reserves memory per core
+    memory = ceil(args.mem_mb / args.threads)
+    return [
+        'bsub',
+        '-q', args.queue,
+        '-P', args.project,
+        '-J', '{}.{}'.format(args.name, args.rule),
+        '-n', str(args.threads),
+        '-R', 'rusage[mem={}] span[hosts=1]'.format(memory),
+        '-W', str(args.runtime),
+        '-o', str(log_dir / '{}.%J.stdout'.format(args.rule)),
+        '-eo', str(log_dir / '{}.%J.stderr'.format(args.rule)),
+        args.jobscript
+    ]
+
+
+def submit(args):
+    """ Submit the job with bsub and return its ID """
+    Path(args.log_dir).mkdir(parents=True, exist_ok=True)
+    # Analyses' environments may have python as old as 3.6, which doesn't have capture_output
+    output = run(bsub_command(args), check=True, stdout=PIPE, universal_newlines=True).stdout
+    # bsub responds with "Job <ID> is submitted to queue <QUEUE>."
+    return re.search(r'Job <(\d+)>', output).group(1)
+
+
+def submit_local(args):
+    """ Start the job in the background on this machine and return an ID for it """
+    log_dir = Path(args.log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    # Record the exit code of the job where lsf_status.py can find it, $$ is the ID returned
+    command = ['bash', '-c', 'bash "$0"; echo $? > "$1/local-$$.exit"', args.jobscript, str(log_dir)]
+    with open(log_dir / '{}.local.stdout'.format(args.rule), 'a') as log:
+        process = Popen(command, stdin=DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    return 'local-{}'.format(process.pid)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Submit a snakemake job to LSF')
+    parser.add_argument('--local', action='store_true', help='Run the job on this machine instead of submitting it')
+    parser.add_argument('--queue', required=True, help='The LSF queue to submit to')
+    parser.add_argument('--project', required=True, help='The LSF project to charge the job to')
+    parser.add_argument('--name', required=True, help='The name of the analysis the job is part of')
+    parser.add_argument('--log-dir', required=True, help='The directory to write the job\'s output to')
+    parser.add_argument('--rule', required=True, help='The rule the job runs')
+    parser.add_argument('--threads', type=int, required=True, help='The number of cores to reserve')
+    parser.add_argument('--mem-mb', type=int, required=True, help='The total MB of memory to reserve')
+    parser.add_argument('--runtime', type=int, required=True, help='The minutes the job may run for')
+    parser.add_argument('jobscript', help='The job script written by snakemake')
+    args = parser.parse_args(args)
+
+    print(submit_local(args) if args.local else submit(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,5 @@
 from collections import defaultdict, OrderedDict
-from mmeds.error import InvalidConfigError, InvalidSQLError, InvalidModuleError, EmailError
+from mmeds.error import InvalidConfigError, InvalidSQLError, InvalidModuleError, EmailError, GraphRenderError
 from operator import itemgetter
 from subprocess import run
 from pathlib import Path
@@ -10,6 +10,8 @@ from tempfile import gettempdir
 from re import sub
 from time import sleep
 from shutil import copy
+from filecmp import cmp
+from zipfile import ZipFile, BadZipFile
 
 import yaml
 import gzip
@@ -19,7 +21,7 @@ import numpy as np
 import Levenshtein as lev
 import mmeds.config as fig
 from mmeds.logging import Logger
-from subprocess import CalledProcessError
+from subprocess import CalledProcessError, TimeoutExpired
 
 
 ###########
@@ -128,13 +130,23 @@ def simplified_to_full(file_fp, output_fp, metadata_type, subject_type='human'):
     return renamed_df
 
 
+# The last stats loaded and the modification time of the stats file they were loaded from
+_mmeds_stats = {'mtime': None, 'stats': {}}
+
+
 def load_mmeds_stats():
-    """ Load the values from the mmeds stats file. Used to give the stats on the homepage. """
-    if Path(fig.STAT_FILE).exists():
-        stats = yaml.safe_load(fig.STAT_FILE.read_text())
-    else:
-        stats = {}
-    return stats
+    """
+    Load the values from the mmeds stats file. Used to give the stats on the homepage.
+    The file is only read again once the Watcher has replaced it.
+    """
+    try:
+        mtime = Path(fig.STAT_FILE).stat().st_mtime
+    except FileNotFoundError:
+        return {}
+    if not _mmeds_stats['mtime'] == mtime:
+        _mmeds_stats['stats'] = yaml.safe_load(fig.STAT_FILE.read_text())
+        _mmeds_stats['mtime'] = mtime
+    return dict(_mmeds_stats['stats'])
 
 
 def load_subject_template(subject_type):
@@ -375,9 +387,11 @@ def parse_parameters(config, metadata, workflow_type, ignore_bad_cols=False):
     """
     # Ignore the 'all' keys
     diff = {x for x in set(config.keys()).difference(fig.WORKFLOWS[workflow_type]["parameters"])
-            if '_all' not in x}
+            if '_all' not in x and x not in fig.OPTIONAL_CONFIG_PARAMETERS}
     if diff:
         raise InvalidConfigError('Invalid parameter(s) {} in config file'.format(diff))
+    if not isinstance(config.get('resources', {}), dict):
+        raise InvalidConfigError('resources in config file must map rule names to their threads and mem_mb')
     try:
         # Parse the values/levels to be included in the analysis
         for option in fig.WORKFLOWS[workflow_type]["parameters"]:
@@ -465,6 +479,28 @@ def get_valid_columns(metadata_file, option, ignore_bad_cols=False):
     return summary_cols, col_types
 
 
+def replace_if_changed(new_file, path):
+    """
+    Move NEW_FILE to PATH unless PATH already has the same contents, in which case NEW_FILE is
+    removed. Leaving unchanged files in place keeps snakemake from re-running the rules that use them.
+    """
+    new_file, path = Path(new_file), Path(path)
+    if path.is_file() and cmp(new_file, path, shallow=False):
+        new_file.unlink()
+    else:
+        os.replace(new_file, path)
+
+
+def update_symlink(link, target):
+    """ Point LINK at TARGET, leaving it untouched if it already does """
+    link = Path(link)
+    if link.is_symlink() and os.readlink(link) == str(target):
+        return
+    if link.exists() or link.is_symlink():
+        link.unlink()
+    link.symlink_to(target)
+
+
 def write_config(config, path):
     """ Write out the config file being used to the working directory. """
     config_text = {}
@@ -484,8 +520,9 @@ def write_config(config, path):
                 config_text[key] = 'none'
         else:
             config_text[key] = value
-    with open(path / 'config_file.yaml', 'w') as f:
+    with open(path / '.config_file.yaml.tmp', 'w') as f:
         yaml.dump(config_text, f)
+    replace_if_changed(path / '.config_file.yaml.tmp', path / 'config_file.yaml')
 
 
 def copy_metadata(metadata_file, metadata_copy):
@@ -827,12 +864,12 @@ def send_email(toaddr, user, message='upload', testing=False, **kwargs):
                'If you did not do this contact us immediately.\n\nBest,\nMmeds Team\n\n' +\
                'If you have any issues please email: {cemail} with a description of your problem.\n'
         subject = 'Error During Analysis'
-    elif message == 'too_many_on_node':
-        body = 'Hello {user},\nThere was an issue starting requested {analysis} analysis.\n' +\
-               'There are too many analyses already running on the main node.\n' +\
-               'Either submit a new analysis to the queue or wait until others finish.\n\nBest,\nMmeds Team\n\n' +\
+    elif message == 'analysis_queued':
+        body = 'Hello {user},\nYour requested {analysis} analysis is waiting to start.\n' +\
+               'The main node is busy with other analyses, yours will start automatically once\n' +\
+               'enough resources are free. You will receive another email when it starts.\n\nBest,\nMmeds Team\n\n' +\
                'If you have any issues please email: {cemail} with a description of your problem.\n'
-        subject = 'Analysis Not Started'
+        subject = 'Analysis Queued'
     elif message == 'watcher_termination':
         body = 'Hello Admin,\nThe watcher process on minerva has been terminated and needs to be restarted.\n' +\
                'Please delegate or do this as soon as possible.\n\nBest,\nMmeds Team\n\n' +\
@@ -1410,6 +1447,100 @@ def validate_demultiplex(demux_file, for_barcodes, rev_barcodes, map_file, log_d
     return ret_val
 
 
+def get_artifact_type(artifact):
+    """
+    Return the semantic type of the QIIME ARTIFACT, e.g. FeatureTable[Frequency], from the
+    metadata stored inside it. Returns None if it isn't a valid artifact.
+    """
+    try:
+        with ZipFile(artifact) as archive:
+            metadata = next(name for name in archive.namelist() if name.count('/') == 1 and
+                            name.endswith('/metadata.yaml'))
+            return yaml.safe_load(archive.read(metadata))['type']
+    except (OSError, BadZipFile, StopIteration, KeyError, TypeError, yaml.YAMLError):
+        return None
+
+
+# The keys of the snakemake graphs in an analysis' files, which are rendered on request
+SNAKEMAKE_GRAPHS = ('snakemake_dag', 'snakemake_rulegraph')
+
+
+def dag_to_rulegraph(dag):
+    """
+    Convert the DAG of jobs snakemake writes with --dag to the graph of rules it writes with
+    --rulegraph, by merging each rule's jobs into a single node.
+    :dag: The text of the DAG in dot format.
+    """
+    header, nodes, edges = [], {}, []
+    # The first node seen for each rule, which the rule's other nodes are merged into
+    rule_nodes = {}
+    for line in dag.splitlines():
+        node = re.match(r'\s*(\d+)\[label = "(.*?)(?:\\n.*?)?"(.*)$', line)
+        edge = re.match(r'\s*(\d+) -> (\d+)', line)
+        if node:
+            ident, rule, rest = node.groups()
+            nodes[ident] = rule_nodes.setdefault(rule, (ident, '\t{}[label = "{}"{}'.format(ident, rule, rest)))
+        elif edge:
+            edges.append(edge.groups())
+        elif line.strip() != '}':
+            header.append(line)
+
+    lines = header + [text for ident, text in rule_nodes.values()]
+    merged = []
+    for source, target in edges:
+        edge = (nodes[source][0], nodes[target][0])
+        if edge[0] != edge[1] and edge not in merged:
+            merged.append(edge)
+    lines += ['\t{} -> {}'.format(source, target) for source, target in merged]
+    return '\n'.join(lines + ['}']) + '\n'
+
+
+def render_snakemake_graph(graph_file):
+    """
+    Render GRAPH_FILE, an analysis' snakemake_dag.pdf or snakemake_rulegraph.pdf, from the
+    DAG dumped to snakemake_dag.dot while the analysis ran. Both are rendered from the one
+    dump so snakemake doesn't have to rebuild the DAG. Returns False if there's no dump.
+    Raises a GraphRenderError if Graphviz fails or takes longer than GRAPH_RENDER_TIMEOUT.
+    """
+    graph_file = Path(graph_file)
+    dag_file = graph_file.with_name('snakemake_dag.dot')
+    if not dag_file.exists() or not dag_file.stat().st_size:
+        return False
+    if graph_file.exists() and graph_file.stat().st_mtime >= dag_file.stat().st_mtime:
+        return True
+
+    graph = dag_file.read_text()
+    if 'rulegraph' in graph_file.name:
+        graph = dag_to_rulegraph(graph)
+    # Render to a temporary file so a partial PDF is never served
+    temp = graph_file.with_name('.{}.tmp'.format(graph_file.name))
+    try:
+        run(['dot', '-Tpdf', '-o', str(temp)], input=graph, text=True, check=True, timeout=fig.GRAPH_RENDER_TIMEOUT)
+    except (CalledProcessError, TimeoutExpired, FileNotFoundError) as e:
+        if temp.exists():
+            temp.unlink()
+        raise GraphRenderError('Unable to create {}: {}'.format(graph_file.name, e))
+    temp.rename(graph_file)
+    return True
+
+
+def summarize_mapping_file(mapping_file, columns):
+    """
+    Summarize the qiime MAPPING_FILE for the snakemake rules, so they don't need to parse it themselves.
+    Returns the number of samples and, for each of COLUMNS in the mapping file, the number of samples
+    with each of its values, in the order the values first appear. Missing values are left out.
+    """
+    metadata = pd.read_csv(mapping_file, sep='\t', header=[0], skiprows=[1])
+    summary = {'samples': len(metadata), 'columns': {}}
+    for column in columns:
+        if column not in metadata.columns:
+            continue
+        counts = metadata[column].value_counts()
+        summary['columns'][column] = {str(value): int(counts[value]) for value in metadata[column].unique()
+                                      if str(value) != 'nan'}
+    return summary
+
+
 def get_mapping_file_subset(metadata, selection, column="RawDataProtocolID"):
     """ Create a sub-mapping file with only a certain selection included. For use splitting sequencing runs. """
     Logger.debug(metadata)
@@ -1680,6 +1811,8 @@ def get_file_index_entry_location(path, tool, entry, testing=False):
         index = path / f"{tool}_{highest}" / "file_index.tsv"
         if index.exists():
             df = pd.read_csv(index, sep='\t', skiprows=[0], header=[0], index_col=0)
+            # The index is a journal, the last line for a key is its current path
+            df = df[~df.index.duplicated(keep='last')]
             if entry in df.index:
                 entry_exists = True
                 out_path = df.at[entry, "Path"]
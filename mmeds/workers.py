@@ -0,0 +1,189 @@
+import warnings
+from time import time, sleep
+from multiprocessing import get_context
+
+import mmeds.config as fig
+from mmeds.database.database import Database
+from mmeds.database.documents import clear_file_indexes
+from mmeds.database.metadata_uploader import MetaDataUploader
+from mmeds.database.data_uploader import DataUploader
+from mmeds.database.metadata_adder import MetaDataAdder
+from mmeds.error import InvalidUploadError, MissingUploadError
+from mmeds.logging import Logger
+
+# The uploaders a worker can run, by name
+UPLOADERS = {uploader.__name__: uploader for uploader in (MetaDataUploader, DataUploader, MetaDataAdder)}
+
+# Workers are started fresh rather than forked, so they don't share the watcher's database connections
+CONTEXT = get_context('spawn')
+
+
+class UploadWorker(CONTEXT.Process):
+    """
+    A long running process that runs upload jobs one at a time. Jobs are run in the worker itself
+    rather than in a new process, so they start with the modules, config, and mongo connection
+    the worker already has loaded. A worker exits after a failed job so the next job doesn't
+    inherit any state it left behind, or after MAX_JOBS jobs.
+    """
+    def __init__(self, testing, max_jobs):
+        """
+        :testing: A boolean. If true run in testing configuration, otherwise run in deployment configuration.
+        :max_jobs: An int. The number of jobs to run before exiting.
+        """
+        super().__init__(daemon=True)
+        self.testing = testing
+        self.max_jobs = max_jobs
+        self.conn, self.worker_conn = CONTEXT.Pipe()
+
+    def run(self):
+        """ Run jobs as they're received. Messages about each job are sent back as it starts and finishes. """
+        warnings.simplefilter('ignore')
+        for _ in range(self.max_jobs):
+            job = self.worker_conn.recv()
+            if job is None:
+                break
+            job_id, uploader_type, args, kwargs = job
+
+            try:
+                uploader = UPLOADERS[uploader_type](*args, **kwargs)
+            except Exception as e:
+                Logger.error('Failed to create {} for job {}: {}'.format(uploader_type, job_id, e))
+                self.worker_conn.send(('failed', job_id, str(e)))
+                break
+            self.worker_conn.send(('started', job_id, uploader.access_code))
+
+            exit_code = 0
+            try:
+                uploader.run()
+            except Exception as e:
+                Logger.error('Upload {} failed: {}'.format(uploader.access_code, e))
+                exit_code = 1
+                mark_failed(uploader.access_code, self.testing)
+            finally:
+                close_connections(uploader)
+                # Other processes may have changed the analyses' files since
+                clear_file_indexes()
+            self.worker_conn.send(('finished', job_id, exit_code))
+            if exit_code:
+                break
+
+
+def close_connections(uploader):
+    """ Close the MySQL connection UPLOADER opened, each job opens its own """
+    db = getattr(uploader, 'db', None)
+    if db is not None and db.open:
+        db.close()
+
+
+def mark_failed(access_code, testing):
+    """ Record on the document for ACCESS_CODE that its upload failed """
+    try:
+        with Database(testing=testing) as db:
+            db.get_doc(access_code, False).update(is_alive=False, exit_code=1)
+    except MissingUploadError:
+        pass
+
+
+class PooledUpload:
+    """
+    Stands in for an uploader process while its job runs in the UploadPool. Provides the parts
+    of the Process interface the Watcher relies on.
+    """
+    def __init__(self, pool, job_id, access_code, timeout):
+        self.pool = pool
+        self.job_id = job_id
+        self.access_code = access_code
+        self.started = time()
+        self.timeout = timeout
+        self.exitcode = None
+
+    def is_alive(self):
+        self.pool.poll()
+        return self.exitcode is None
+
+    def join(self):
+        while self.is_alive():
+            sleep(0.1)
+
+
+class UploadPool:
+    """
+    A pool of UploadWorkers, started ahead of time, that the Watcher sends uploads to.
+    """
+    def __init__(self, testing, size=fig.UPLOAD_WORKERS, max_jobs=fig.UPLOAD_WORKER_JOBS):
+        """
+        :testing: A boolean. If true run in testing configuration, otherwise run in deployment configuration.
+        :size: An int. The number of workers to keep ready.
+        :max_jobs: An int. The number of jobs each worker runs before it's replaced.
+        """
+        self.testing = testing
+        self.size = size
+        self.max_jobs = max_jobs
+        self.workers = []
+        # The job each busy worker is running
+        self.running = {}
+        self.count = 0
+
+    def start(self):
+        """ Start workers until the pool is full """
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
+        while len(self.workers) < self.size:
+            worker = UploadWorker(self.testing, self.max_jobs)
+            worker.start()
+            # Only the worker holds its end, so the pool sees the pipe close when the worker exits
+            worker.worker_conn.close()
+            self.workers.append(worker)
+
+    def submit(self, uploader_type, *args, **kwargs):
+        """
+        Run an uploader of UPLOADER_TYPE, created with ARGS and KWARGS, on an idle worker.
+        Waits until the uploader has been created and returns a PooledUpload for it.
+        Raises an InvalidUploadError if the uploader can't be created.
+        """
+        self.count += 1
+        for attempt in range(self.size + 1):
+            self.poll()
+            self.start()
+            worker = next(worker for worker in self.workers if worker not in self.running)
+            try:
+                worker.conn.send((self.count, uploader_type, args, kwargs))
+                status, job_id, value = worker.conn.recv()
+                break
+            except (EOFError, OSError):
+                # The worker exited, e.g. after its last job, before it could take this one
+                Logger.error('Upload worker {} exited, retrying on another'.format(worker.pid))
+                worker.join(1)
+                self.workers.remove(worker)
+        else:
+            raise InvalidUploadError('Unable to start {}: no upload worker took the job'.format(uploader_type))
+        if status == 'failed':
+            raise InvalidUploadError('Unable to start {}: {}'.format(uploader_type, value))
+
+        job = PooledUpload(self, job_id, value, fig.UPLOAD_TIMEOUTS[uploader_type])
+        self.running[worker] = job
+        return job
+
+    def poll(self):
+        """ Collect the results of finished jobs and kill any that have run past their timeout """
+        for worker, job in list(self.running.items()):
+            if worker.conn.poll():
+                status, job_id, job.exitcode = worker.conn.recv()
+            elif not worker.is_alive():
+                # The worker died without reporting back
+                job.exitcode = 1
+                mark_failed(job.access_code, self.testing)
+            elif time() - job.started > job.timeout:
+                Logger.error('Upload {} exceeded its timeout, stopping it'.format(job.access_code))
+                worker.terminate()
+                job.exitcode = 1
+                mark_failed(job.access_code, self.testing)
+            if job.exitcode is not None:
+                del self.running[worker]
+
+    def stop(self):
+        """ Tell idle workers to exit and stop any still running jobs """
+        for worker in self.workers:
+            if worker in self.running:
+                worker.terminate()
+            elif worker.is_alive():
+                worker.conn.send(None)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import click
+from datetime import datetime, timedelta
+from prettytable import PrettyTable
+from mmeds.database.database import Database
+from mmeds.telemetry import summarize_benchmarks
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+def format_value(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('-w', '--workflow', default=None, help='Only include analyses of this workflow type')
+@click.option('-d', '--days', default=None, type=int, help='Only include analyses from the last DAYS days')
+@click.option('-s', '--split', default=None, type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Compare the analyses created before and after this date, e.g. a tool upgrade')
+@click.option('-t', '--testing', is_flag=True, help='Report on the testing database')
+def benchmark_report(workflow, days, split, testing):
+    """
+    Summarize the time and memory used by each snakemake rule across the analyses that have been run
+    """
+    since = datetime.now() - timedelta(days=days) if days is not None else None
+    with Database(testing=testing) as db:
+        analyses = [(doc.created, doc.rule_benchmarks) for doc in db.get_benchmarked_analyses(workflow, since)]
+
+    records = [record for created, benchmarks in analyses for record in benchmarks]
+    print('{} jobs from {} analyses'.format(len(records), len(analyses)))
+    summary = summarize_benchmarks(records)
+
+    if split is None:
+        table = PrettyTable(['Rule', 'Jobs', 'Median seconds', 'Max seconds', 'Max RSS (MB)', 'Mean CPU seconds'])
+        for rule, stats in summary.items():
+            table.add_row([rule, stats['jobs']] + [format_value(stats[key]) for key in
+                          ('median_seconds', 'max_seconds', 'max_rss_mb', 'mean_cpu_seconds')])
+    else:
+        before = summarize_benchmarks([record for created, benchmarks in analyses if created < split
+                                       for record in benchmarks])
+        after = summarize_benchmarks([record for created, benchmarks in analyses if created >= split
+                                      for record in benchmarks])
+        table = PrettyTable(['Rule', 'Jobs before', 'Jobs after', 'Median seconds before', 'Median seconds after',
+                             'Change', 'Max RSS before (MB)', 'Max RSS after (MB)'])
+        for rule in summary:
+            old = before.get(rule, {})
+            new = after.get(rule, {})
+            change = None
+            if old.get('median_seconds') and new.get('median_seconds') is not None:
+                change = new['median_seconds'] / old['median_seconds']
+            table.add_row([rule, old.get('jobs', 0), new.get('jobs', 0),
+                           format_value(old.get('median_seconds')), format_value(new.get('median_seconds')),
+                           '-' if change is None else '{:.2f}x'.format(change),
+                           format_value(old.get('max_rss_mb')), format_value(new.get('max_rss_mb'))])
+    table.align['Rule'] = 'l'
+    print(table)
+
+
+if __name__ == '__main__':
+    benchmark_report()
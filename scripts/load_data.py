@@ -5,7 +5,7 @@ from pathlib import Path
 import mmeds.util as util
 import mmeds.config as fig
 import mmeds.secrets as sec
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from mmeds.authentication import add_user
 
 
@@ -22,8 +22,8 @@ def load(input_zip):
     # Ensure the reupload user exists
     add_user(fig.REUPLOAD_USER, sec.REUPLOAD_PASS, fig.TEST_EMAIL)
 
-    # Open watcher queue
-    queue = get_queue()
+    # Connect to the watcher
+    queue = get_watcher_client()
 
     # Unzip archive
     zip_path = Path(input_zip)
@@ -45,15 +45,5 @@ def load(input_zip):
     print("Reupload complete.")
 
 
-def get_queue():
-    """ Creates a watcher queue to be sent to the upload functions in util.py. Those functions
-            cannot create their own Watcher queue due to their needing a recursive import
-    """
-    watcher = Watcher()
-    watcher.connect()
-    queue = watcher.get_queue()
-    return queue
-
-
 if __name__ == '__main__':
     load()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+import click
+from mmeds.database.database import Database
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('-c', '--create', is_flag=True, help='Build any of the declared indexes that are missing')
+@click.option('-t', '--testing', is_flag=True, help='Check the testing database')
+def mongo_indexes(create, testing):
+    """
+    Verify the indexes declared on MMEDSDoc exist in the mongo database, optionally creating them
+    """
+    with Database(testing=testing) as db:
+        difference = db.check_mongo_indexes(create)
+
+    for index in difference['missing']:
+        print('Missing index: {}{}'.format(index, ' (created)' if create else ''))
+    for index in difference['extra']:
+        print('Undeclared index: {}'.format(index))
+    if not difference['missing'] and not difference['extra']:
+        print('All indexes match')
+
+
+if __name__ == '__main__':
+    mongo_indexes()
@@ -5,7 +5,7 @@ from pathlib import Path
 from subprocess import run, CalledProcessError
 from mmeds.summary import summarize_qiime
 from mmeds.database.database import Database
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from mmeds.util import setup_environment, run_analysis, start_analysis_local
 import mmeds.config as fig
 
@@ -27,7 +27,7 @@ def run_analysis(study_name, analysis_name, workflow_type, user, config):
     """
     Submits an analysis process for running on a study
     """
-    q = get_queue()
+    q = get_watcher_client()
     runs = {}
     analysis_type = 'default'
     with Database(testing=fig.TESTING) as db:
@@ -39,15 +39,6 @@ def run_analysis(study_name, analysis_name, workflow_type, user, config):
     ret = start_analysis_local(q, access_code, analysis_name, workflow_type, user, config, runs, analysis_type)
     assert ret == 0
 
-def get_queue():
-    """ Creates a watcher queue to be sent to the analysis function in util.py. Those functions
-    cannot create their own Watcher queue due to their needing a recursive import
-    """
-    watcher = Watcher()
-    watcher.connect()
-    queue = watcher.get_queue()
-    return queue
-
 
 if __name__ == '__main__':
     run_analysis()
@@ -2,7 +2,7 @@
 
 import click
 import mmeds.util as util
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 from pathlib import Path
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -19,7 +19,7 @@ def upload_sequencing_run(sequencing_run_name, forward_reads, reverse_reads, for
     """
     Uploads a sequencing run directly from the command line, bypassing the server
     """
-    q = get_queue()
+    q = get_watcher_client()
 
     datafiles = {'forward': str(Path(forward_reads).resolve())}
     if reverse_reads:
@@ -40,15 +40,5 @@ def upload_sequencing_run(sequencing_run_name, forward_reads, reverse_reads, for
     assert result == 0
 
 
-def get_queue():
-    """ Creates a watcher queue to be sent to the analysis function in util.py. Those functions
-    cannot create their own Watcher queue due to their needing a recursive import
-    """
-    watcher = Watcher()
-    watcher.connect()
-    queue = watcher.get_queue()
-    return queue
-
-
 if __name__ == '__main__':
     upload_sequencing_run()
@@ -2,7 +2,7 @@
 
 import click
 import mmeds.util as util
-from mmeds.spawn import Watcher
+from mmeds.spawn import get_watcher_client
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -18,21 +18,11 @@ def upload_study(study_name, i_subject, i_specimen, user, meta_study):
     Uploads a study directly from the command line, bypassing the server
     """
     print(meta_study)
-    q = get_queue()
+    q = get_watcher_client()
     subject_type = util.get_subject_type(i_subject)
     result = util.upload_study_local(q, study_name, i_subject, subject_type, i_specimen, user, meta_study)
     assert result == 0
 
 
-def get_queue():
-    """ Creates a watcher queue to be sent to the analysis function in util.py. Those functions
-    cannot create their own Watcher queue due to their needing a recursive import
-    """
-    watcher = Watcher()
-    watcher.connect()
-    queue = watcher.get_queue()
-    return queue
-
-
 if __name__ == '__main__':
     upload_study()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import click
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+
+import mmeds.config as fig
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('-m', '--metrics', is_flag=True, help='Print all of the watcher metrics instead')
+@click.option('-t', '--timeout', default=10, help='Seconds to wait for the watcher to respond')
+def watcher_health(metrics, timeout):
+    """
+    Check the health of the running watcher. Exits with a non-zero status if it's unhealthy or unreachable.
+    """
+    host, port = fig.WATCHER_METRICS_ADDRESS
+    url = 'http://{}:{}/{}'.format(host, port, 'metrics' if metrics else 'health')
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            body = response.read().decode()
+    except HTTPError as e:
+        # Unhealthy watchers respond with an error status
+        body = e.read().decode()
+    except URLError as e:
+        print('Unable to reach the watcher: {}'.format(e.reason))
+        sys.exit(2)
+
+    if metrics:
+        print(body, end='')
+        return
+    health = json.loads(body)
+    for key, value in health.items():
+        print('{}: {}'.format(key, value))
+    if not health['healthy']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    watcher_health()